@@ -0,0 +1,94 @@
+"""Compares sending a batch of emails one at a time (the old loop rendering and posting
+each email in turn) against queueing them in the outbox and sending them with
+send_queued_emails, against a local fake SendGrid that answers after --latency seconds.
+The database is a scratch sqlite file.
+
+Run from the api directory:
+    python -m benchmarks.email_dispatch --emails 200 --latency 0.1 --workers 8
+"""
+import os
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
+
+from database import db
+from flask import Flask
+from yelp_beans import send_email
+from yelp_beans.send_email import EmailSender
+from yelp_beans.send_email import build_message
+from yelp_beans.send_email import queue_emails
+from yelp_beans.send_email import render_email
+from yelp_beans.send_email import send_queued_emails
+
+
+def legacy_send_emails(sender, emails):
+    for email, subject, template_filename, template_arguments in emails:
+        sender.send(build_message(email, subject, render_email(template_filename, template_arguments)))
+
+
+def start_server(latency):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            time.sleep(latency)
+            self.send_response(202)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--emails", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    server = start_server(args.latency)
+    secrets = SimpleNamespace(send_grid_api_key="key", send_grid_sender="beans@example.com", project="beans")
+    sender = EmailSender(api_key="key", host=f"http://127.0.0.1:{server.server_port}", pool_size=args.workers)
+    emails = [(f"user{i}@example.com", "Hi", "welcome_email.html", {"first_name": f"User{i}"}) for i in range(args.emails)]
+
+    scratch = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+    scratch.close()
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{scratch.name}"
+    db.init_app(app)
+    try:
+        with app.app_context(), mock.patch.object(send_email, "get_secrets", return_value=secrets), mock.patch.object(
+            send_email, "get_email_sender", return_value=sender
+        ), mock.patch.object(send_email, "get_config", return_value={"email_workers": args.workers}):
+            db.create_all()
+            start = time.perf_counter()
+            legacy_send_emails(sender, emails)
+            serial = time.perf_counter() - start
+
+            start = time.perf_counter()
+            queue_emails("benchmark", emails)
+            sent = send_queued_emails()
+            outbox = time.perf_counter() - start
+            assert sent == len(emails)
+            db.drop_all()
+    finally:
+        server.shutdown()
+        os.unlink(scratch.name)
+
+    print(f"{'one at a time s':>18} {serial:>8.2f}")
+    print(f"{'outbox s':>18} {outbox:>8.2f} ({serial / outbox:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Compares rendering the email templates the old way (a new Jinja environment, so a fresh
+load and compile, for every email) against the cached templates in send_email.
+
+Run from the api directory:
+    python -m benchmarks.email_templates --emails 2000
+The cold start rows show a new process loading the templates with and without the
+bytecode cache on disk (email_template_cache_dir).
+"""
+import tempfile
+import time
+from argparse import ArgumentParser
+from types import SimpleNamespace
+from unittest import mock
+
+from jinja2 import Environment
+from jinja2 import PackageLoader
+from yelp_beans import send_email
+from yelp_beans.send_email import render_email
+
+TEMPLATES = ["match_email.html", "weekly_opt_in_email.html", "unmatched_email.html", "welcome_email.html"]
+
+
+def make_arguments(index):
+    participant = SimpleNamespace(
+        first_name=f"First{index}",
+        last_name=f"Last{index}",
+        photo_url="https://example.com/photo.png",
+        meta_data={"business_title": "Engineer", "company_profile_url": "https://example.com", "department": "Beans"},
+    )
+    return {
+        "user": participant,
+        "participants": [participant, participant],
+        "first_name": participant.first_name,
+        "project": "beans",
+        "office": "SF",
+        "location": "8th floor",
+        "meeting_title": "Coffee",
+        "meeting_day": "Friday",
+        "meeting_time": "03:00 PM PST",
+        "meeting_url": "https://example.com/meeting_request/1",
+        "link_to_change_pref": "https://example.com/",
+        "meeting_start_day": "Friday",
+        "meeting_start_date": "01/20/2017",
+        "meeting_start_time": "03:00 PM PST",
+        "meeting_end_time": "03:30 PM PST",
+        "calendar_invite_url": "https://www.google.com/calendar/render",
+    }
+
+
+def legacy_render_email(template_filename, template_arguments):
+    env = Environment(loader=PackageLoader("yelp_beans", "templates"))
+    template = env.get_template(template_filename)
+    return template.render(template_arguments)
+
+
+def clear_caches():
+    send_email.get_template_environment.cache_clear()
+    send_email.get_email_template.cache_clear()
+
+
+def throughput(render, emails):
+    start = time.perf_counter()
+    for index in range(emails):
+        render(TEMPLATES[index % len(TEMPLATES)], make_arguments(index))
+    return emails / (time.perf_counter() - start)
+
+
+def cold_start(config):
+    with mock.patch.object(send_email, "get_config", return_value=config):
+        clear_caches()
+        start = time.perf_counter()
+        for template in TEMPLATES:
+            send_email.get_email_template(template)
+        elapsed = time.perf_counter() - start
+    clear_caches()
+    return elapsed
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--emails", type=int, default=2000)
+    args = parser.parse_args()
+
+    legacy = throughput(legacy_render_email, args.emails)
+    with mock.patch.object(send_email, "get_config", return_value={}):
+        clear_caches()
+        cached = throughput(render_email, args.emails)
+    print(f"{'renders/s legacy':>22} {legacy:>10.0f}")
+    print(f"{'renders/s cached':>22} {cached:>10.0f} ({cached / legacy:.1f}x)")
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        no_cache = cold_start({})
+        cold_start({"email_template_cache_dir": cache_dir})
+        warm_cache = cold_start({"email_template_cache_dir": cache_dir})
+    print(f"{'cold start compile ms':>22} {no_cache * 1000:>10.2f}")
+    print(f"{'cold start bytecode ms':>22} {warm_cache * 1000:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Compares the memory of reading a synthetic employee directory the old way (json.load,
+_parse into a second list of dicts, copied again by /tasks/populate_employees) against
+JSONFileDataProvider.ingest, a list of compact Employee records sharing their metadata, and
+against streaming the records in batches, the way sync_employees reads them.
+Peak is the most memory used while reading, held is what the result still takes up.
+
+Run from the api directory:
+    python -m benchmarks.employee_ingestion --employees 100000 --batch-size 1000
+"""
+import itertools
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+from yelp_beans.data_providers.json_file_data_provider import JSONFileDataProvider
+
+
+def legacy_parse(data):
+    employees = []
+    for employee in data:
+        user = {
+            "email": employee.get("email"),
+            "first_name": employee.get("first_name"),
+            "last_name": employee.get("last_name"),
+            "photo_url": employee.get("photo_url"),
+        }
+        remaining_keys = set(employee.keys()) - set(user.keys())
+        user["metadata"] = {attr: employee[attr] for attr in remaining_keys}
+        employees.append(user)
+    return employees
+
+
+def legacy_ingest(path, batch_size):
+    with open(path, "rb") as json_file:
+        data = json.load(json_file)
+    employees = legacy_parse(data)
+    return [employee for employee in employees]
+
+
+def compact_ingest(path, batch_size):
+    return JSONFileDataProvider(path=path).ingest()
+
+
+def streaming_ingest(path, batch_size):
+    employees = JSONFileDataProvider(path=path).stream()
+    count = 0
+    while batch := list(itertools.islice(employees, batch_size)):
+        count += len(batch)
+    return range(count)
+
+
+def write_directory(path, employees):
+    with open(path, "w") as json_file:
+        json_file.write("[")
+        for i in range(employees):
+            if i:
+                json_file.write(",")
+            employee = {
+                "email": f"user{i}@yelp.com",
+                "first_name": f"First{i}",
+                "last_name": f"Last{i}",
+                "photo_url": f"https://s3-media4.fl.yelpcdn.com/assets/photos/{i}.png",
+                "department": f"Department {i % 40}",
+                "business_title": f"Title {i % 300}",
+                "office": f"Office {i % 25}",
+                "manager": f"Manager {i % 5000}",
+                "floor": str(i % 12),
+                "desk": str(i % 400),
+            }
+            json.dump(employee, json_file)
+        json_file.write("]")
+
+
+def measure(ingest, path, batch_size):
+    tracemalloc.start()
+    start = time.perf_counter()
+    employees = ingest(path, batch_size)
+    elapsed = time.perf_counter() - start
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(employees), elapsed, peak / 2**20, held / 2**20
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--employees", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "employees.json")
+        write_directory(path, args.employees)
+        print(f"{args.employees} employees, {os.path.getsize(path) / 2**20:.1f} MiB of json")
+        print(f"{'':>10} {'seconds':>8} {'peak MiB':>9} {'held MiB':>9}")
+        for name, ingest in [("legacy", legacy_ingest), ("compact", compact_ingest), ("streaming", streaming_ingest)]:
+            count, elapsed, peak, held = measure(ingest, path, args.batch_size)
+            assert count == args.employees
+            print(f"{name:>10} {elapsed:>8.2f} {peak:>9.1f} {held:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""Compares the final group cost and runtime of the group matching annealer against the
+implementations it replaced, on synthetic populations with meeting history.
+
+- original: 100 iterations, full rescoring of a copied state, the old acceptance rule
+- previous: incremental swap deltas with the old temperature and acceptance rule
+- exponential / adaptive: Metropolis acceptance with the new cooling schedules
+- local_search: Kernighan-Lin style swaps between groups (local_search_groups)
+
+Run from the api directory:
+    python -m benchmarks.group_annealing --sizes 60,200,1000 --group-size 4 --trace trace.csv
+"""
+import csv
+import itertools
+import random
+import time
+from argparse import ArgumentParser
+from statistics import mean
+from types import SimpleNamespace
+
+from yelp_beans.matching.group_match import DEFAULT_ANNEALING_ITERATIONS
+from yelp_beans.matching.group_match import Annealing
+from yelp_beans.matching.group_match import State
+from yelp_beans.matching.group_match import get_user_weights
+from yelp_beans.matching.group_match import local_search_groups
+
+STARTING_WEIGHT = 10
+NEGATIVE_WEIGHT = 5
+
+
+def make_adj_matrix(size, group_size, weeks, seed):
+    """Weights for a population that has already been put in random groups for some weeks"""
+    rng = random.Random(seed)
+    users = [SimpleNamespace(id=user_id) for user_id in range(size)]
+    counts = {}
+    for _ in range(weeks):
+        ids = list(range(size))
+        rng.shuffle(ids)
+        for start in range(0, size - group_size + 1, group_size):
+            for pair in itertools.combinations(sorted(ids[start : start + group_size]), 2):
+                counts[pair] = counts.get(pair, 0) + 1
+    return get_user_weights(users, counts, STARTING_WEIGHT, NEGATIVE_WEIGHT)
+
+
+def original_annealing(size, group_size, adj_matrix, seed, max_iterations=100):
+    rng = random.Random(seed)
+    ids = list(range(size))
+    rng.shuffle(ids)
+
+    def cost(ids):
+        return sum(
+            adj_matrix[a][b]
+            for start in range(0, size, group_size)
+            for a, b in itertools.combinations(ids[start : start + group_size], 2)
+        )
+
+    best_cost = prev_cost = cost(ids)
+    for iteration in range(max_iterations):
+        temp = 1.0 - (max_iterations - iteration) / (max_iterations + iteration)
+        x, y = rng.sample(range(size), 2)
+        curr_ids = ids[:]
+        curr_ids[x], curr_ids[y] = curr_ids[y], curr_ids[x]
+        curr_cost = cost(curr_ids)
+        best_cost = max(best_cost, curr_cost)
+        if curr_cost > prev_cost or 1.0 * curr_cost / (prev_cost + 1) * temp < rng.random():
+            prev_cost, ids = curr_cost, curr_ids
+    return best_cost, max_iterations
+
+
+def previous_annealing(size, group_size, adj_matrix, seed, max_iterations=DEFAULT_ANNEALING_ITERATIONS):
+    rng = random.Random(seed)
+    ids = list(range(size))
+    rng.shuffle(ids)
+    state = State(size, group_size, ids)
+    state.track_group_costs(adj_matrix)
+    weights = adj_matrix.tolist()
+
+    best_cost = prev_cost = sum(state.group_costs)
+    for iteration in range(max_iterations):
+        temp = 1.0 - (max_iterations - iteration) / (max_iterations + iteration)
+        x, y = state.get_random_swap(rng)
+        delta_x, delta_y = state.get_swap_delta(x, y, weights)
+        curr_cost = prev_cost + delta_x + delta_y
+        # the old rule divides by the cost, which breaks once costs go negative
+        if curr_cost > prev_cost or (prev_cost != -1 and 1.0 * curr_cost / (prev_cost + 1) * temp < rng.random()):
+            state.swap(x, y, delta_x, delta_y)
+            prev_cost = curr_cost
+            best_cost = max(best_cost, curr_cost)
+    return best_cost, max_iterations
+
+
+def new_annealing(schedule, traces):
+    def run(size, group_size, adj_matrix, seed):
+        annealing = Annealing(size, group_size, adj_matrix, seed=seed, schedule=schedule)
+        annealing.simulated_annealing()
+        traces.extend((schedule, size, seed, *point) for point in annealing.trace)
+        return annealing.best_cost, annealing.iterations
+
+    return run
+
+
+def local_search(size, group_size, adj_matrix, seed):
+    cost, _ = local_search_groups(size, group_size, adj_matrix, seed=seed)
+    return cost, None
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="60,200,1000", help="comma separated population sizes")
+    parser.add_argument("--group-size", type=int, default=4)
+    parser.add_argument("--weeks", type=int, default=40, help="weeks of meeting history to generate")
+    parser.add_argument("--seeds", type=int, default=3, help="runs per implementation, results are averaged")
+    parser.add_argument("--trace", help="write the cost versus iteration trace of the new schedules to this csv file")
+    args = parser.parse_args()
+
+    traces = []
+    implementations = (
+        ("original", original_annealing),
+        ("previous", previous_annealing),
+        ("exponential", new_annealing("exponential", traces)),
+        ("adaptive", new_annealing("adaptive", traces)),
+        ("local_search", local_search),
+    )
+
+    print(f"{'users':>6} {'annealer':>13} {'cost':>12} {'iterations':>11} {'seconds':>8}")
+    for size in [int(size) for size in args.sizes.split(",")]:
+        adj_matrix = make_adj_matrix(size, args.group_size, args.weeks, seed=size)
+        for name, implementation in implementations:
+            costs, iterations, elapsed = [], [], []
+            for seed in range(args.seeds):
+                start = time.perf_counter()
+                cost, iteration_count = implementation(size, args.group_size, adj_matrix, seed)
+                elapsed.append(time.perf_counter() - start)
+                costs.append(cost)
+                iterations.append(iteration_count)
+            iterations_str = "-" if None in iterations else f"{mean(iterations):.0f}"
+            print(f"{size:>6} {name:>13} {mean(costs):>12.1f} {iterations_str:>11} {mean(elapsed):>8.2f}", flush=True)
+
+    if args.trace:
+        with open(args.trace, "w", newline="") as trace_file:
+            writer = csv.writer(trace_file)
+            writer.writerow(("schedule", "users", "seed", "iteration", "cost", "best_cost", "temperature"))
+            writer.writerows(traces)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Compares building the pair matching candidate edges the old way (all pairs as a set
+minus the disallowed set) against the bucketed generator in pair_match.
+
+Run from the api directory:
+    python -m benchmarks.pair_candidate_graph --sizes 1000,5000,20000
+"""
+import itertools
+import random
+import resource
+import time
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from types import SimpleNamespace
+
+from yelp_beans.matching.pair_match import get_allowed_meetings
+
+
+def make_population(size, departments, history_ratio, seed):
+    rng = random.Random(seed)
+    users = [SimpleNamespace(id=user_id, meta_data={"department": f"dept{rng.randrange(departments)}"}) for user_id in range(size)]
+    # roughly what ten weeks of pair meetings leave behind
+    history = set()
+    for _ in range(int(size * history_ratio)):
+        history.add(tuple(sorted(rng.sample(range(size), 2))))
+    spec = SimpleNamespace(meeting_subscription=SimpleNamespace(dept_rules=[SimpleNamespace(name="department")]))
+    return users, history, spec
+
+
+def legacy_allowed_meetings(users, prev_meeting_tuples, spec):
+    userids = sorted([user.id for user in users])
+    id_to_user = {user.id: user for user in users}
+    all_pairs = {pair for pair in itertools.combinations(userids, 2)}
+    pairs = prev_meeting_tuples
+    for rule in spec.meeting_subscription.dept_rules:
+        pairs = pairs.union(
+            {pair for pair in all_pairs if id_to_user[pair[0]].meta_data[rule.name] == id_to_user[pair[1]].meta_data[rule.name]}
+        )
+    return all_pairs - pairs
+
+
+def count_sparse(users, history, spec):
+    counter = itertools.count()
+    deque(zip(get_allowed_meetings(users, history, spec), counter), maxlen=0)
+    return next(counter)
+
+
+def count_legacy(users, history, spec):
+    return len(legacy_allowed_meetings(users, history, spec))
+
+
+def measure(builder, size, departments, history_ratio, seed):
+    # each measurement runs in a fresh process so the peak rss belongs to one builder
+    users, history, spec = make_population(size, departments, history_ratio, seed)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    edges = builder(users, history, spec)
+    elapsed = time.perf_counter() - start
+    peak_kib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+    return edges, elapsed, peak_kib
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1000,5000,20000", help="comma separated population sizes")
+    parser.add_argument("--departments", type=int, default=40)
+    parser.add_argument("--history-ratio", type=float, default=5.0, help="previous meetings per user")
+    parser.add_argument("--legacy-limit", type=int, default=5000, help="skip the old builder above this size")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'users':>8} {'builder':>8} {'edges':>12} {'seconds':>9} {'peak MiB':>9}")
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn"), max_tasks_per_child=1) as executor:
+        for size in [int(size) for size in args.sizes.split(",")]:
+            builders = [("sparse", count_sparse)]
+            if size <= args.legacy_limit:
+                builders.append(("legacy", count_legacy))
+
+            for name, builder in builders:
+                future = executor.submit(measure, builder, size, args.departments, args.history_ratio, args.seed)
+                edges, elapsed, peak_kib = future.result()
+                print(f"{size:>8} {name:>8} {edges:>12} {elapsed:>9.2f} {peak_kib / 1024:>9.1f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
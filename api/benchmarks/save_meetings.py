@@ -0,0 +1,94 @@
+"""Compares persisting a week of matches the old way (one commit per meeting, participants
+added through the ORM) against the single transaction bulk insert in match_utils.
+
+Run from the api directory:
+    python -m benchmarks.save_meetings --meetings 200,1000 --group-size 2
+Pass --database-url to run against something other than a scratch sqlite file, e.g. a
+local postgres. The tables are created and dropped by the benchmark.
+"""
+import logging
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+from datetime import datetime
+
+from database import db
+from flask import Flask
+from yelp_beans.matching.match_utils import save_meetings
+from yelp_beans.models import Meeting
+from yelp_beans.models import MeetingParticipant
+from yelp_beans.models import MeetingSpec
+from yelp_beans.models import MeetingSubscription
+from yelp_beans.models import User
+
+
+def legacy_save_meetings(matches, spec):
+    for match in matches:
+        matched_users = [user for user in match if isinstance(user, User)]
+        meeting_key = Meeting(meeting_spec=spec)
+        db.session.add(meeting_key)
+        for user in matched_users:
+            db.session.add(MeetingParticipant(meeting=meeting_key, user=user))
+        db.session.commit()
+        logging.info(meeting_key)
+        logging.info(", ".join(user.get_username() for user in matched_users))
+
+
+def make_week(meetings, group_size):
+    subscription = MeetingSubscription(title="benchmark")
+    spec = MeetingSpec(meeting_subscription=subscription, datetime=datetime.now())
+    users = [User(email=f"user{i}@yelp.com", meta_data={}) for i in range(meetings * group_size)]
+    db.session.add(spec)
+    db.session.add_all(users)
+    db.session.commit()
+    # match_employees hands over users freshly loaded by a query, not expired instances
+    users = User.query.order_by(User.id).all()
+    matches = [tuple(users[i : i + group_size]) for i in range(0, len(users), group_size)]
+    return matches, spec
+
+
+def measure(saver, meetings, group_size):
+    db.drop_all()
+    db.create_all()
+    matches, spec = make_week(meetings, group_size)
+    start = time.perf_counter()
+    saver(matches, spec)
+    elapsed = time.perf_counter() - start
+    assert Meeting.query.count() == meetings
+    assert MeetingParticipant.query.count() == meetings * group_size
+    return elapsed
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--meetings", default="200,1000", help="comma separated number of meetings per week")
+    parser.add_argument("--group-size", type=int, default=2)
+    parser.add_argument("--database-url", default=None, help="defaults to a scratch sqlite file")
+    args = parser.parse_args()
+
+    scratch = None
+    database_url = args.database_url
+    if database_url is None:
+        scratch = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+        scratch.close()
+        database_url = f"sqlite:///{scratch.name}"
+
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+    db.init_app(app)
+    try:
+        with app.app_context():
+            print(f"{'meetings':>9} {'legacy s':>10} {'bulk s':>10} {'speedup':>8}")
+            for meetings in [int(size) for size in args.meetings.split(",")]:
+                legacy = measure(legacy_save_meetings, meetings, args.group_size)
+                bulk = measure(save_meetings, meetings, args.group_size)
+                print(f"{meetings:>9} {legacy:>10.3f} {bulk:>10.3f} {legacy / bulk:>7.1f}x")
+            db.drop_all()
+    finally:
+        if scratch is not None:
+            os.unlink(scratch.name)
+
+
+if __name__ == "__main__":
+    main()
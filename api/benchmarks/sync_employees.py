@@ -0,0 +1,119 @@
+"""Compares a daily employee sync the old way (every User loaded and rewritten) against
+the fingerprinting sync_employees, when only a few employees changed since the last sync.
+
+Run from the api directory:
+    python -m benchmarks.sync_employees --employees 10000,50000 --changed 0.01
+Pass --database-url to run against something other than a scratch sqlite file, e.g. a
+local postgres. The tables are created and dropped by the benchmark.
+"""
+import copy
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+from unittest import mock
+
+from database import db
+from flask import Flask
+from yelp_beans.logic import user as user_logic
+from yelp_beans.logic.user import hash_employee_data
+from yelp_beans.logic.user import sync_employees
+from yelp_beans.logic.user import validate_employee_data
+from yelp_beans.models import User
+
+
+def legacy_sync_employees(employee_data):
+    validate_employee_data(employee_data)
+    remote_employee_data = hash_employee_data(employee_data)
+    local_employee_data = {employee.email: employee for employee in User.query.all()}
+    local_employees = set(local_employee_data)
+    remote_employees = set(remote_employee_data)
+
+    for email in remote_employees - local_employees:
+        employee = remote_employee_data[email]
+        db.session.add(
+            User(
+                email=employee["email"],
+                first_name=employee["first_name"],
+                last_name=employee["last_name"],
+                photo_url=employee["photo_url"],
+                meta_data=employee["metadata"],
+                subscription_preferences=[],
+            )
+        )
+    db.session.commit()
+    for email in local_employees - remote_employees:
+        local_employee_data[email].terminated = True
+    db.session.commit()
+    for email in remote_employees & local_employees:
+        local_employee, remote_employee = local_employee_data[email], remote_employee_data[email]
+        local_employee.first_name = remote_employee["first_name"]
+        local_employee.last_name = remote_employee["last_name"]
+        local_employee.photo_url = remote_employee["photo_url"]
+        local_employee.meta_data = remote_employee["metadata"]
+        local_employee.terminated = False
+    db.session.commit()
+
+
+def make_directory(employees):
+    return [
+        {
+            "email": f"user{i}@yelp.com",
+            "first_name": f"First{i}",
+            "last_name": f"Last{i}",
+            "photo_url": f"https://cdn.yelp.com/{i}.png",
+            "metadata": {"department": f"Department{i % 50}", "title": f"Title{i % 200}", "floor": str(i % 12)},
+        }
+        for i in range(employees)
+    ]
+
+
+def measure(syncer, directory, changed):
+    db.drop_all()
+    db.create_all()
+    sync_employees(copy.deepcopy(directory))
+    db.session.expunge_all()
+
+    today = copy.deepcopy(directory)
+    for employee in today[: int(len(today) * changed)]:
+        employee["metadata"]["title"] = "Promoted"
+    start = time.perf_counter()
+    syncer(today)
+    elapsed = time.perf_counter() - start
+    assert User.query.filter(User.meta_data.is_not(None)).count() == len(directory)
+    return elapsed
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--employees", default="10000,50000", help="comma separated directory sizes")
+    parser.add_argument("--changed", type=float, default=0.01, help="share of employees changed since the last sync")
+    parser.add_argument("--database-url", default=None, help="defaults to a scratch sqlite file")
+    args = parser.parse_args()
+
+    scratch = None
+    database_url = args.database_url
+    if database_url is None:
+        scratch = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+        scratch.close()
+        database_url = f"sqlite:///{scratch.name}"
+
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+    db.init_app(app)
+    try:
+        with app.app_context(), mock.patch.object(user_logic, "get_config", return_value={}):
+            print(f"{'employees':>10} {'legacy s':>10} {'sync s':>10} {'speedup':>8}")
+            for employees in [int(size) for size in args.employees.split(",")]:
+                directory = make_directory(employees)
+                legacy = measure(legacy_sync_employees, directory, args.changed)
+                fingerprinted = measure(sync_employees, directory, args.changed)
+                print(f"{employees:>10} {legacy:>10.3f} {fingerprinted:>10.3f} {legacy / fingerprinted:>7.1f}x")
+            db.drop_all()
+    finally:
+        if scratch is not None:
+            os.unlink(scratch.name)
+
+
+if __name__ == "__main__":
+    main()
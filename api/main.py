@@ -23,5 +23,29 @@ def create_dev_data_entrypoint():
     create_dev_data(db.session)
 
 
+@app.cli.command("backfill-pair-history")
+def backfill_pair_history_entrypoint():
+    """Rebuild the pair history used for matching from all saved meetings"""
+    from yelp_beans.matching.match_utils import rebuild_pair_history
+
+    rebuild_pair_history()
+
+
+@app.cli.command("backfill-local-slots")
+def backfill_local_slots_entrypoint():
+    """Compute the local weekday and minute slot of existing subscription datetimes and specs"""
+    from yelp_beans.logic.subscription import backfill_local_slots
+
+    backfill_local_slots()
+
+
+@app.cli.command("dedupe-meeting-requests")
+def dedupe_meeting_requests_entrypoint():
+    """Delete duplicate meeting requests and add the unique index they would break"""
+    from yelp_beans.logic.meeting_request import dedupe_meeting_requests
+
+    dedupe_meeting_requests()
+
+
 if __name__ == "__main__":
     app.run()
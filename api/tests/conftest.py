@@ -1,6 +1,7 @@
 import logging
 import time
 from collections import namedtuple
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
 from unittest import mock
@@ -10,6 +11,7 @@ from database import db
 from factory import create_app
 from pytz import timezone
 from pytz import utc
+from sqlalchemy import event
 from yelp_beans import send_email
 from yelp_beans.logic.subscription import get_specs_from_subscription
 from yelp_beans.logic.subscription import store_specs_from_subscription
@@ -47,8 +49,11 @@ def mock_config():
 @pytest.fixture(scope="session", autouse=True)
 def sendgrid_mock():
     """This is active to prevent from sending a emails when testing"""
-    with mock.patch.object(send_email, "send_single_email"):
-        yield
+    secrets = send_email.Secrets(send_grid_api_key="test", send_grid_sender="beans@yelp.com", project="beans-test")
+    with mock.patch.object(send_email, "get_secrets", return_value=secrets), mock.patch.object(
+        send_email, "get_email_sender"
+    ) as get_email_sender:
+        yield get_email_sender.return_value
 
 
 @pytest.fixture()
@@ -75,6 +80,29 @@ def session(app):
         yield db.session
 
 
+@pytest.fixture
+def statement_counter(session):
+    """
+    Records the statements sent to the database inside `with statement_counter() as statements:`,
+    the first word of each, e.g. SELECT.
+    """
+
+    @contextmanager
+    def count_statements():
+        statements = []
+
+        def record_statement(conn, cursor, statement, *args):
+            statements.append(statement.split()[0])
+
+        event.listen(db.engine, "before_cursor_execute", record_statement)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record_statement)
+
+    return count_statements
+
+
 @pytest.fixture
 def subscription(session):
     yield _subscription(session)
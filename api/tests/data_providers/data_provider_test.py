@@ -1,6 +1,10 @@
 import json
 
+import pytest
 from yelp_beans.data_providers.data_provider import DataProvider
+from yelp_beans.data_providers.data_provider import Employee
+from yelp_beans.data_providers.data_provider import InternTable
+from yelp_beans.data_providers.data_provider import iter_json_array
 
 
 def test_parse(employees):
@@ -15,3 +19,90 @@ def test_parse(employees):
         "illustrations/mascots/darwin@2x.png"
     )
     assert result[0]["metadata"] == {}
+
+
+def test_parse_shares_metadata():
+    result = DataProvider()._parse(
+        [
+            {"email": "a@yelp.com", "department": "Engineering", "floor": 1, "remote": True, "teams": ["beans"]},
+            {"email": "b@yelp.com", "department": "Engineering", "floor": True, "remote": 1, "teams": ["beans"]},
+        ]
+    )
+
+    a, b = result
+    assert isinstance(a, Employee)
+    assert a["metadata"] == {"department": "Engineering", "floor": 1, "remote": True, "teams": ["beans"]}
+    assert b["metadata"] == {"department": "Engineering", "floor": True, "remote": 1, "teams": ["beans"]}
+    assert a.metadata_items[0] is b.metadata_items[0]
+    assert type(b["metadata"]["floor"]) is bool
+    with pytest.raises(KeyError):
+        a["department"]
+
+
+def test_parse_keeps_interned_pairs_bounded():
+    interned = InternTable(size=3)
+    provider = DataProvider()
+
+    employees = [
+        provider._parse_employee({"email": f"{i}@yelp.com", "department": "Engineering", "desk": i}, interned) for i in range(100)
+    ]
+
+    assert len(interned.pairs) == 3
+    # the pair every employee has stays shared, the desks seen once are dropped
+    assert all(employee.metadata_items[0] is employees[0].metadata_items[0] for employee in employees)
+    assert [employee["metadata"]["desk"] for employee in employees] == list(range(100))
+
+
+def test_stream(employees):
+    class ListDataProvider(DataProvider):
+        def _fetch(self, data):
+            return json.loads(employees)
+
+    result = list(ListDataProvider().stream())
+    assert result == DataProvider()._parse(json.loads(employees))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 1000])
+def test_iter_json_array(chunk_size):
+    records = [{"email": "darwin@yelp.com", "name": "Dårwin 🐶"}, 12345, [1.5, None], "x,]"]
+    data = json.dumps(records, ensure_ascii=False).encode()
+
+    chunks = [data[i : i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+    assert list(iter_json_array(chunks)) == records
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        "[1.5]",
+        "[-25000000000.0]",
+        '[1e3 , true,false, null, -0.25E-2, "Dårwin", {"a": [1.5, null]}, 12345]',
+    ],
+)
+def test_iter_json_array_split_anywhere(data):
+    records = json.loads(data)
+    encoded = data.encode()
+
+    for split in range(len(encoded) + 1):
+        assert list(iter_json_array([encoded[:split], encoded[split:]])) == records
+        assert list(iter_json_array([data[:split], data[split:]])) == records
+    assert list(iter_json_array([encoded[i : i + 1] for i in range(len(encoded))])) == records
+
+
+def test_iter_json_array_is_lazy():
+    def chunks():
+        yield '[{"a": 1}, {"a"'
+        raise AssertionError("read too far")
+
+    assert next(iter_json_array(chunks())) == {"a": 1}
+
+
+@pytest.mark.parametrize("data", ["", "{}", "[1, 2", "[1 2]", "[1,, 2]", "[1] 2", '[{"a": }]'])
+def test_iter_json_array_invalid(data):
+    with pytest.raises(ValueError):
+        list(iter_json_array([data]))
+
+
+def test_iter_json_array_empty():
+    assert list(iter_json_array([" [ ", " ] "])) == []
@@ -1,10 +1,20 @@
+import gzip
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
 from unittest import mock
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
 
 import pytest
 import requests_mock
 from yelp_beans.data_providers import restful_json_data_provider
+from yelp_beans.data_providers.data_provider import SourceUnchanged
 
 MOCK_URL = "mock://example.com"
+PAGED_URL = "http://example.com/employees"
 
 
 @pytest.fixture
@@ -34,3 +44,193 @@ def test_fetch(data_provider, employees):
         m.get(MOCK_URL, text=employees)
         result = data_provider._fetch(None)
         assert len(result) == 1
+
+
+class EmployeeDirectoryHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if server.pages is not None:
+            self.send_page()
+            return
+        if server.statuses:
+            self.send_response(server.statuses.pop(0))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.headers.get("If-None-Match") == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = server.body.encode()
+        self.send_response(200)
+        self.send_header("ETag", server.etag)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_page(self):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        time.sleep(server.delay)
+        with server.lock:
+            server.in_flight -= 1
+        query = parse_qs(urlparse(self.path).query)
+        number = int(query["page"][0])
+        if server.page_cap is None:
+            page = server.pages[number - 1] if number <= len(server.pages) else []
+        else:
+            # the server ignores page_size past its own cap
+            page_size = min(int(query["page_size"][0]), server.page_cap)
+            page = server.records[(number - 1) * page_size : number * page_size]
+        body = json.dumps({"results": page, "total": server.total}).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def directory_server(employees):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), EmployeeDirectoryHandler)
+    server.requests = []
+    server.statuses = []
+    server.pages = None
+    server.records = []
+    server.page_cap = None
+    server.total = None
+    server.lock = threading.Lock()
+    server.in_flight = 0
+    server.max_in_flight = 0
+    server.delay = 0
+    server.body = employees
+    server.etag = '"v1"'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_conditional_fetch(directory_server, tmp_path):
+    def provider():
+        return restful_json_data_provider.RestfulJSONDataProvider(
+            f"http://127.0.0.1:{directory_server.server_port}/employees",
+            cache_dir=str(tmp_path),
+        )
+
+    assert len(list(provider().stream())) == 1
+    assert "If-None-Match" not in directory_server.requests[-1]
+
+    # not synced yet, the unchanged data is read from the snapshot
+    assert len(list(provider().stream())) == 1
+    assert directory_server.requests[-1]["If-None-Match"] == '"v1"'
+
+    provider().mark_synced()
+    with pytest.raises(SourceUnchanged):
+        list(provider().stream())
+
+    directory_server.body = "[]"
+    directory_server.etag = '"v2"'
+    assert list(provider().stream()) == []
+    assert len(directory_server.requests) == 4
+
+
+def test_fetch_retries_compressed(directory_server):
+    directory_server.statuses = [503, 502]
+    data_provider = restful_json_data_provider.RestfulJSONDataProvider(
+        f"http://127.0.0.1:{directory_server.server_port}/employees"
+    )
+
+    assert len(data_provider._fetch(None)) == 1
+    assert len(directory_server.requests) == 3
+    assert "gzip" in directory_server.requests[-1]["Accept-Encoding"]
+
+
+def _pages(records, page_size):
+    return [records[i : i + page_size] for i in range(0, len(records), page_size)]
+
+
+@pytest.mark.parametrize("employee_count", [5, 6])
+def test_fetch_numbered_pages(employee_count):
+    records = [{"email": f"{i}@yelp.com"} for i in range(employee_count)]
+    pages = _pages(records, 2)
+
+    def page(request, context):
+        number = int(request.qs["page"][0])
+        assert request.qs["page_size"] == ["2"]
+        return {"employees": pages[number - 1] if number <= len(pages) else []}
+
+    data_provider = restful_json_data_provider.RestfulJSONDataProvider(
+        PAGED_URL, pagination="page", records_key="employees", page_size=2, workers=3
+    )
+    with requests_mock.mock() as m:
+        m.get(PAGED_URL, json=page)
+        assert list(data_provider._fetch_records(None)) == records
+
+
+def test_fetch_numbered_pages_concurrently(directory_server):
+    directory_server.delay = 0.1
+    directory_server.pages = _pages([{"email": f"{i}@yelp.com"} for i in range(10)], 2)
+    data_provider = restful_json_data_provider.RestfulJSONDataProvider(
+        f"http://127.0.0.1:{directory_server.server_port}/employees", pagination="page", page_size=2, workers=3
+    )
+
+    start = time.monotonic()
+    records = list(data_provider._fetch_records(None))
+
+    assert records == [record for page in directory_server.pages for record in page]
+    # 6 pages, the last one empty, fetched 3 at a time
+    assert len(directory_server.requests) <= 8
+    assert time.monotonic() - start < 0.45
+    assert directory_server.max_in_flight == 3
+
+
+@pytest.mark.parametrize("total_key", [None, "total"])
+def test_fetch_numbered_pages_capped_by_server(directory_server, total_key):
+    directory_server.pages = []
+    directory_server.records = [{"email": f"{i}@yelp.com"} for i in range(250)]
+    directory_server.page_cap = 100
+    directory_server.total = 250
+    data_provider = restful_json_data_provider.RestfulJSONDataProvider(
+        f"http://127.0.0.1:{directory_server.server_port}/employees",
+        pagination="page",
+        page_size=500,
+        total_key=total_key,
+        workers=1,
+    )
+
+    assert list(data_provider._fetch_records(None)) == directory_server.records
+    if total_key:
+        # stopped at the total, without fetching an empty page
+        assert len(directory_server.requests) == 3
+    else:
+        assert len(directory_server.requests) == 4
+
+
+def test_fetch_cursor_pages():
+    records = [{"email": f"{i}@yelp.com"} for i in range(5)]
+    pages = _pages(records, 2)
+
+    def page(request, context):
+        number = int(request.qs.get("cursor", ["0"])[0])
+        return {"results": pages[number], "next_cursor": str(number + 1) if number + 1 < len(pages) else None}
+
+    data_provider = restful_json_data_provider.RestfulJSONDataProvider(PAGED_URL, pagination="cursor", page_size=2)
+    with requests_mock.mock() as m:
+        m.get(PAGED_URL, json=page)
+        assert [employee["email"] for employee in data_provider.stream()] == [record["email"] for record in records]
+        assert m.call_count == 3
+
+
+def test_unknown_pagination():
+    with pytest.raises(ValueError):
+        restful_json_data_provider.RestfulJSONDataProvider(MOCK_URL, pagination="offset")
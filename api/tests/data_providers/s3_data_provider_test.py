@@ -0,0 +1,67 @@
+import io
+from unittest import mock
+
+import pytest
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+from yelp_beans.data_providers import s3_data_provider
+from yelp_beans.data_providers.data_provider import SourceUnchanged
+
+
+class FakeS3:
+    """Stands in for the boto3 s3 resource, serving one object with conditional gets"""
+
+    def __init__(self, body, etag):
+        self.body = body
+        self.etag = etag
+        self.requests = []
+
+    def Object(self, bucket_name, key):
+        return self
+
+    def get(self, **kwargs):
+        self.requests.append(kwargs)
+        if kwargs.get("IfNoneMatch") == self.etag:
+            raise ClientError(
+                {"Error": {"Code": "304", "Message": "Not Modified"}, "ResponseMetadata": {"HTTPStatusCode": 304}},
+                "GetObject",
+            )
+        body = self.body.encode()
+        return {"Body": StreamingBody(io.BytesIO(body), len(body)), "ETag": self.etag}
+
+
+@pytest.fixture
+def s3(employees):
+    s3 = FakeS3(employees, '"v1"')
+    with mock.patch.object(s3_data_provider.S3DataProvider, "_obtain_s3_connection", return_value=s3):
+        yield s3
+
+
+def test_fetch(s3):
+    data_provider = s3_data_provider.S3DataProvider(bucket_name="bucket", key="employees.json")
+    assert len(data_provider._fetch(None)) == 1
+    assert s3.requests == [{}]
+
+
+def test_conditional_fetch(s3, tmp_path):
+    def provider():
+        return s3_data_provider.S3DataProvider(bucket_name="bucket", key="employees.json", cache_dir=str(tmp_path))
+
+    assert len(list(provider().stream())) == 1
+    assert len(list(provider().stream())) == 1
+    provider().mark_synced()
+    with pytest.raises(SourceUnchanged):
+        list(provider().stream())
+    assert s3.requests == [{}, {"IfNoneMatch": '"v1"'}, {"IfNoneMatch": '"v1"'}]
+
+    s3.body = "[]"
+    s3.etag = '"v2"'
+    assert list(provider().stream()) == []
+
+
+def test_fetch_errors(s3, tmp_path):
+    s3.get = mock.Mock(
+        side_effect=ClientError({"Error": {"Code": "AccessDenied"}, "ResponseMetadata": {"HTTPStatusCode": 403}}, "GetObject")
+    )
+    with pytest.raises(ClientError):
+        list(s3_data_provider.S3DataProvider(bucket_name="bucket", key="employees.json", cache_dir=str(tmp_path)).stream())
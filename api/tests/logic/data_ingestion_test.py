@@ -4,3 +4,8 @@ from yelp_beans.logic.data_ingestion import DataIngestion
 def test_ingest():
     result = DataIngestion().ingest()
     assert len(result) == 1
+
+
+def test_stream():
+    result = list(DataIngestion().stream())
+    assert result == DataIngestion().ingest()
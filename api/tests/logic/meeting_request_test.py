@@ -1,5 +1,12 @@
+import pytest
+from database import db
+from sqlalchemy.exc import IntegrityError
+from yelp_beans.logic.meeting_request import create_auto_opt_in_meeting_requests
+from yelp_beans.logic.meeting_request import dedupe_meeting_requests
 from yelp_beans.logic.meeting_request import query_meeting_request
+from yelp_beans.logic.meeting_request import query_users_for_matching
 from yelp_beans.logic.meeting_request import store_meeting_request
+from yelp_beans.logic.user import user_preference
 from yelp_beans.models import MeetingRequest
 from yelp_beans.models import User
 from yelp_beans.models import UserSubscriptionPreferences
@@ -35,3 +42,92 @@ def test_query_meeting_request(database, session):
     result = query_meeting_request(spec, user)
 
     assert result == mr
+
+
+def test_query_users_for_matching(database, session, statement_counter):
+    spec = database.specs[0]
+
+    def add_requests(start, stop):
+        for i in range(start, stop):
+            pref = UserSubscriptionPreferences(subscription_id=database.sub.id, preference=database.prefs[i % 2])
+            user = User(email=f"{i}@yelp.com", meta_data={"department": "dept"}, subscription_preferences=[pref])
+            session.add_all([pref, user, MeetingRequest(user=user, meeting_spec=spec)])
+        session.commit()
+
+    def load_users():
+        # the spec itself is loaded up front so only the loader is counted
+        assert spec.id
+        with statement_counter() as statements:
+            users = query_users_for_matching(spec)
+            preferences = [user_preference(user, spec) for user in users]
+        return users, preferences, len(statements)
+
+    add_requests(0, 2)
+    users, preferences, few_statements = load_users()
+    assert {user.email for user in users} == {"0@yelp.com", "1@yelp.com"}
+    assert all(preference is not None for preference in preferences)
+
+    add_requests(2, 30)
+    session.expire_all()
+    users, preferences, many_statements = load_users()
+    assert len(users) == 30
+    assert {preference.preference_id for preference in preferences} == {pref.id for pref in database.prefs}
+    assert many_statements == few_statements == 2
+
+
+def test_create_auto_opt_in_meeting_requests(database, session):
+    users = []
+    for i, (preference, auto_opt_in) in enumerate(
+        [(database.prefs[0], True), (database.prefs[0], True), (database.prefs[0], False)]
+    ):
+        pref = UserSubscriptionPreferences(subscription_id=database.sub.id, preference=preference, auto_opt_in=auto_opt_in)
+        user = User(email=f"{i}@yelp.com", meta_data={"department": "dept"}, subscription_preferences=[pref])
+        session.add_all([pref, user])
+        users.append(user)
+    session.commit()
+    spec = next(spec for spec in database.specs if spec.local_minute == database.prefs[0].local_minute)
+    # the first user already opted in by hand
+    session.add(MeetingRequest(user=users[0], meeting_spec=spec))
+    session.commit()
+
+    assert create_auto_opt_in_meeting_requests(database.specs) == 1
+    assert create_auto_opt_in_meeting_requests(database.specs) == 0
+    assert create_auto_opt_in_meeting_requests([]) == 0
+
+    requests = {(request.meeting_spec_id, request.user_id) for request in MeetingRequest.query.all()}
+    assert requests == {(spec.id, users[0].id), (spec.id, users[1].id)}
+
+
+def test_meeting_request_is_unique_per_spec_and_user(database, session):
+    user = User(email="a@yelp.com", meta_data={"department": "dept"})
+    session.add_all([user, MeetingRequest(user=user, meeting_spec=database.specs[0])])
+    session.commit()
+
+    session.add(MeetingRequest(user=user, meeting_spec=database.specs[0]))
+    with pytest.raises(IntegrityError):
+        session.commit()
+    session.rollback()
+
+
+def test_dedupe_meeting_requests(database, session):
+    unique_index = next(index for index in MeetingRequest.__table__.indexes if index.unique)
+    unique_index.drop(db.engine)
+    users = [User(email=f"{i}@yelp.com", meta_data={"department": "dept"}) for i in range(2)]
+    session.add_all(users)
+    session.add_all([MeetingRequest(user=user, meeting_spec=spec) for spec in database.specs for user in users * 2])
+    session.commit()
+    first_ids = {
+        (spec.id, user.id): min(request.id for request in MeetingRequest.query.filter_by(meeting_spec_id=spec.id, user_id=user.id))
+        for spec in database.specs
+        for user in users
+    }
+
+    assert dedupe_meeting_requests() == len(first_ids)
+
+    requests = {(request.meeting_spec_id, request.user_id): request.id for request in MeetingRequest.query.all()}
+    assert requests == first_ids
+    session.add(MeetingRequest(user=users[0], meeting_spec=database.specs[0]))
+    with pytest.raises(IntegrityError):
+        session.commit()
+    session.rollback()
+    assert dedupe_meeting_requests() == 0
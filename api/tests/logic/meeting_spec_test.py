@@ -1,5 +1,12 @@
+from datetime import datetime
+
+from sqlalchemy import update
 from yelp_beans.logic.meeting_spec import get_meeting_datetime
 from yelp_beans.logic.meeting_spec import get_users_from_spec
+from yelp_beans.models import MeetingSpec
+from yelp_beans.models import SubscriptionDateTime
+from yelp_beans.models import User
+from yelp_beans.models import UserSubscriptionPreferences
 
 
 def test_get_users_from_spec(database, fake_user):
@@ -14,3 +21,65 @@ def test_get_users_from_spec_excluding_users_with_auto_opt_in_enabled(database,
 
 def test_get_meeting_datetime(database, subscription):
     assert get_meeting_datetime(database.specs[0]).hour == 15
+
+
+def test_get_users_from_spec_matches_time_slot(database, session, statement_counter):
+    # prefs[0] is 15:00 and prefs[1] is 11:00 Pacific, on the same day
+    spec_by_hour = {get_meeting_datetime(spec).hour: spec for spec in database.specs}
+    users = []
+    for i, preference in enumerate([database.prefs[0]] * 3 + [database.prefs[1]] * 2):
+        user_pref = UserSubscriptionPreferences(subscription_id=database.sub.id, preference=preference, auto_opt_in=i == 0)
+        user = User(email=f"{i}@yelp.com", meta_data={"department": "dept"}, subscription_preferences=[user_pref])
+        session.add_all([user_pref, user])
+        users.append(user)
+    session.commit()
+    assert all(spec.meeting_subscription for spec in database.specs)
+
+    with statement_counter() as statements:
+        afternoon = get_users_from_spec(spec_by_hour[15])
+        morning = get_users_from_spec(spec_by_hour[11])
+        afternoon_without_auto_opt_in = get_users_from_spec(spec_by_hour[15], exclude_user_prefs_with_auto_opt_in=True)
+
+    assert {user.id for user in afternoon} == {user.id for user in users[:3]}
+    assert {user.id for user in morning} == {user.id for user in users[3:]}
+    assert {user.id for user in afternoon_without_auto_opt_in} == {user.id for user in users[1:3]}
+    assert len(statements) == 3
+
+
+def test_get_users_from_spec_across_daylight_saving(database, fake_user, session):
+    # the preference was created in January (PST), this spec is 15:00 PDT on a Friday in July
+    spec = MeetingSpec(meeting_subscription=database.sub, datetime=datetime(2017, 7, 21, 22, 0))
+    session.add(spec)
+    session.commit()
+
+    assert (spec.local_weekday, spec.local_minute) == (database.prefs[0].local_weekday, database.prefs[0].local_minute)
+    assert get_users_from_spec(spec) == [fake_user]
+
+
+def test_get_users_from_spec_before_backfill(database, fake_user, session):
+    # a Monday 09:00 preference and the Friday 15:00 spec, both saved before the local slots existed
+    monday = SubscriptionDateTime(datetime=datetime(2017, 1, 16, 17, 0))
+    user_pref = UserSubscriptionPreferences(subscription_id=database.sub.id, preference=monday)
+    monday_user = User(email="monday@yelp.com", meta_data={"department": "dept"}, subscription_preferences=[user_pref])
+    session.add_all([monday, user_pref, monday_user])
+    session.commit()
+    spec = database.specs[0]
+    for model, instance in [(SubscriptionDateTime, monday), (MeetingSpec, spec)]:
+        session.execute(
+            update(model).where(model.id == instance.id).values(local_weekday=None, local_minute=None, local_timezone=None)
+        )
+    session.commit()
+    assert spec.local_weekday is None
+
+    assert get_users_from_spec(spec) == [fake_user]
+
+
+def test_local_slot_follows_subscription_timezone(database, session):
+    preference = database.prefs[0]
+    assert (preference.local_weekday, preference.local_minute, preference.local_timezone) == (4, 15 * 60, "America/Los_Angeles")
+
+    database.sub.timezone = "America/New_York"
+    session.commit()
+
+    assert (preference.local_weekday, preference.local_minute, preference.local_timezone) == (4, 18 * 60, "America/New_York")
+    assert all(spec.local_timezone == "America/New_York" for spec in MeetingSpec.query.all())
@@ -1,7 +1,9 @@
 from datetime import datetime
 
 import pytest
+from database import db
 from yelp_beans.logic.meeting_spec import get_meeting_datetime
+from yelp_beans.logic.subscription import backfill_local_slots
 from yelp_beans.logic.subscription import filter_subscriptions_by_user_data
 from yelp_beans.logic.subscription import get_specs_from_subscription
 from yelp_beans.logic.subscription import get_subscription_dates
@@ -218,3 +220,19 @@ def test_filter_subscriptions_by_user_data_none_when_rules_exist(database, sessi
 
     assert len(subscriptions) == 1
     assert subscriptions[0]["id"] == database.sub.id
+
+
+def test_backfill_local_slots(database, session):
+    # rows written before the columns existed have no local slot
+    session.execute(db.update(SubscriptionDateTime).values(local_weekday=None, local_minute=None, local_timezone=None))
+    session.execute(db.update(MeetingSpec).values(local_weekday=None, local_minute=None, local_timezone=None))
+    session.commit()
+    assert database.prefs[0].local_weekday is None
+
+    assert backfill_local_slots() == len(database.prefs) + len(database.specs)
+
+    assert {(pref.local_weekday, pref.local_minute, pref.local_timezone) for pref in database.prefs} == {
+        (4, 15 * 60, "America/Los_Angeles"),
+        (4, 11 * 60, "America/Los_Angeles"),
+    }
+    assert all(spec.local_timezone == "America/Los_Angeles" for spec in MeetingSpec.query.all())
@@ -1,12 +1,12 @@
+import copy
+
 import pytest
+from yelp_beans.data_providers.data_provider import DataProvider
 from yelp_beans.logic.user import add_preferences
-from yelp_beans.logic.user import create_new_employees_from_list
 from yelp_beans.logic.user import hash_employee_data
 from yelp_beans.logic.user import is_valid_user_subscription_preference
-from yelp_beans.logic.user import mark_termed_employees
 from yelp_beans.logic.user import remove_preferences
 from yelp_beans.logic.user import sync_employees
-from yelp_beans.logic.user import update_current_employees
 from yelp_beans.logic.user import user_preference
 from yelp_beans.logic.user import validate_employee_data
 from yelp_beans.models import MeetingSpec
@@ -62,6 +62,97 @@ def test_sync_updates_current_employee(database, data_source):
     assert user.meta_data["department"] == "Design"
 
 
+@pytest.fixture
+def sync_statements(statement_counter):
+    def sync(employee_data, **kwargs):
+        with statement_counter() as statements:
+            result = sync_employees(copy.deepcopy(employee_data), **kwargs)
+        return result, statements
+
+    return sync
+
+
+def test_sync_only_writes_changed_employees(session, data_source, sync_statements):
+    result, _ = sync_statements(data_source)
+    assert (result.added, result.updated, result.unchanged, result.termed) == (2, 0, 0, 0)
+    assert set(result.timings) == {"validate", "load", "add", "update", "terminate"}
+
+    result, statements = sync_statements(data_source)
+    assert (result.added, result.updated, result.unchanged, result.termed) == (0, 0, 2, 0)
+    assert statements == ["SELECT", "SELECT"]
+
+    data_source[0]["metadata"]["department"] = "Design"
+    result, statements = sync_statements(data_source)
+    assert (result.added, result.updated, result.unchanged, result.termed) == (0, 1, 1, 0)
+    assert statements.count("UPDATE") == 1
+    assert User.query.filter(User.email == "samsmith@yelp.com").one().meta_data["department"] == "Design"
+
+    result, _ = sync_statements(data_source[1:])
+    assert (result.added, result.updated, result.unchanged, result.termed) == (0, 0, 1, 1)
+    # already termed employees are left alone, and updated when they come back
+    result, statements = sync_statements(data_source[1:])
+    assert (result.unchanged, result.termed) == (1, 0)
+    assert statements == ["SELECT", "SELECT"]
+    result, _ = sync_statements(data_source)
+    assert (result.updated, result.unchanged) == (1, 1)
+    assert not User.query.filter(User.email == "samsmith@yelp.com").one().terminated
+
+
+def test_sync_writes_in_batches(session, data_source, sync_statements):
+    result, statements = sync_statements(data_source, batch_size=1)
+    assert result.added == 2
+    assert statements.count("INSERT") == 2
+
+    result, statements = sync_statements([], batch_size=1)
+    assert result.termed == 2
+    assert statements.count("UPDATE") == 2
+    assert all(user.terminated for user in User.query.all())
+
+
+def test_sync_streams_employees_in_batches(session, data_source):
+    def employees():
+        yield from copy.deepcopy(data_source)
+        # the same employee again in a later batch is updated, not added twice
+        yield {**copy.deepcopy(data_source[0]), "first_name": "John"}
+
+    result = sync_employees(employees(), batch_size=2)
+
+    assert (result.added, result.updated, result.unchanged) == (2, 1, 0)
+    assert User.query.count() == 2
+    assert User.query.filter(User.email == "samsmith@yelp.com").one().first_name == "John"
+
+
+def test_sync_is_all_or_nothing(session, data_source):
+    sync_employees(copy.deepcopy(data_source))
+
+    def employees():
+        yield {**copy.deepcopy(data_source[0]), "first_name": "John"}
+        yield {"email": "new@yelp.com", "first_name": "New", "last_name": "Hire", "photo_url": None, "metadata": {}}
+        # invalid, after the batches above were written
+        yield {"email": "broken@yelp.com"}
+
+    with pytest.raises(KeyError):
+        sync_employees(employees(), batch_size=1)
+
+    assert User.query.count() == 2
+    assert User.query.filter(User.email == "samsmith@yelp.com").one().first_name == "Sam"
+    assert not any(user.terminated for user in User.query.all())
+
+
+def test_sync_parsed_employees(session, data_source):
+    raw_employees = [
+        {key: value for key, value in employee.items() if key != "metadata"} | employee["metadata"] for employee in data_source
+    ]
+
+    result = sync_employees(DataProvider()._parse(raw_employees))
+
+    assert result.added == 2
+    user = User.query.filter(User.email == "samsmith@yelp.com").one()
+    assert user.meta_data == data_source[0]["metadata"]
+    # the same employees as dicts have the same fingerprint
+    assert sync_employees(data_source).unchanged == 2
+
+
 def test_hash_employee_data(data_source, data_source_by_key):
     """
     Given a json object, return a dictionary by email of users.
@@ -103,13 +194,13 @@ def test_validate_employee_data(data_source):
 
 
 def test_mark_terminated_employees(database, fake_user):
-    mark_termed_employees([fake_user])
+    sync_employees([])
     user = User.query.one()
     assert user.terminated
 
 
 def test_create_new_employees_from_list(session, data_source):
-    create_new_employees_from_list(data_source)
+    sync_employees(data_source)
     user = User.query.filter(User.email == "samsmith@yelp.com").one()
     assert user.email == "samsmith@yelp.com"
     assert user.meta_data == {
@@ -122,7 +213,7 @@ def test_create_new_employees_from_list(session, data_source):
 
 
 def test_update_current_employees(session, data_source):
-    create_new_employees_from_list(data_source)
+    sync_employees(copy.deepcopy(data_source))
     user = User.query.filter(User.email == "samsmith@yelp.com").one()
     assert user.photo_url == "www.cdn.com/SamSmith.png"
     assert user.meta_data == {
@@ -133,14 +224,13 @@ def test_update_current_employees(session, data_source):
         "manager": "Bo Demillo",
     }
 
-    local_data_employee = {user.email: user for user in User.query.all()}
     remote_data_employee = hash_employee_data(data_source)
 
     remote_data_employee["samsmith@yelp.com"]["photo_url"] = "new"
     remote_data_employee["samsmith@yelp.com"]["department"] = "Sales"
     remote_data_employee["samsmith@yelp.com"]["metadata"]["department"] = "Sales"
 
-    update_current_employees(local_data_employee, remote_data_employee)
+    sync_employees(remote_data_employee.values())
     user = User.query.filter(User.email == "samsmith@yelp.com").one()
     assert user.photo_url == "new"
     assert user.meta_data["department"] == "Sales"
@@ -0,0 +1,80 @@
+from datetime import datetime
+from datetime import timedelta
+
+import pytest
+from yelp_beans.matching.engines import MATCHING_ENGINES
+from yelp_beans.matching.engines import run_engine
+from yelp_beans.matching.match import generate_meetings
+from yelp_beans.models import MeetingSpec
+from yelp_beans.models import MeetingSubscription
+from yelp_beans.models import SubscriptionDateTime
+from yelp_beans.models import User
+from yelp_beans.models import UserSubscriptionPreferences
+
+
+def _spec_with_users(session, num_users, **subscription_kwargs):
+    pref_1 = SubscriptionDateTime(datetime=datetime.now() - timedelta(weeks=1))
+    subscription = MeetingSubscription(title="all engineering weekly", datetime=[pref_1], **subscription_kwargs)
+    user_pref = UserSubscriptionPreferences(preference=pref_1, subscription=subscription)
+    meeting_spec = MeetingSpec(meeting_subscription=subscription, datetime=pref_1.datetime)
+    session.add(pref_1)
+    session.add(subscription)
+    session.add(user_pref)
+    session.add(meeting_spec)
+
+    users = []
+    for i in range(num_users):
+        user = User(email=f"{i}@yelp.com", meta_data={"department": f"dept{i}"}, subscription_preferences=[user_pref])
+        session.add(user)
+        users.append(user)
+    session.commit()
+    return meeting_spec, users
+
+
+def test_registered_engines():
+    assert {"exact", "greedy", "budgeted", "local_search"} <= set(MATCHING_ENGINES)
+
+
+@pytest.mark.parametrize("engine", ("exact", "greedy", "budgeted"))
+def test_run_engine_pairs(session, engine):
+    meeting_spec, users = _spec_with_users(session, 9, matching_time_budget=1.0)
+
+    result = run_engine(engine, users, meeting_spec, set())
+    assert result.engine == engine
+    assert result.size == 4
+    assert result.weight == 4.0
+    assert result.elapsed >= 0
+    assert len(result.unmatched) == 1
+
+
+@pytest.mark.parametrize("engine", ("exact", "greedy", "budgeted", "local_search"))
+def test_run_engine_groups(session, engine):
+    meeting_spec, users = _spec_with_users(session, 9)
+
+    result = run_engine(engine, users, meeting_spec, group_size=3)
+    assert result.size == 3
+    # nobody has met before, so every pair in a group keeps the starting weight
+    assert result.weight == 3 * 3 * 10
+    assert result.unmatched == []
+
+
+def test_run_engine_unknown(session):
+    meeting_spec, users = _spec_with_users(session, 2)
+    with pytest.raises(ValueError):
+        run_engine("unknown", users, meeting_spec)
+
+
+def test_generate_meetings_uses_subscription_engine(session, monkeypatch):
+    meeting_spec, users = _spec_with_users(session, 4, matching_engine="greedy")
+    calls = []
+    greedy_engine = MATCHING_ENGINES["greedy"]
+
+    def engine(*args):
+        calls.append(args)
+        return greedy_engine(*args)
+
+    monkeypatch.setitem(MATCHING_ENGINES, "greedy", engine)
+    matches, unmatched = generate_meetings(users, meeting_spec, set())
+    assert len(calls) == 1
+    assert len(matches) == 2
+    assert unmatched == []
@@ -1,10 +1,19 @@
+import itertools
+import time
 from datetime import datetime
 from datetime import timedelta
 
+import numpy as np
+import pytest
+from yelp_beans.matching.group_match import Annealing
+from yelp_beans.matching.group_match import State
 from yelp_beans.matching.group_match import generate_group_meetings
 from yelp_beans.matching.group_match import generate_groups
 from yelp_beans.matching.group_match import get_previous_meetings_counts
 from yelp_beans.matching.group_match import get_user_weights
+from yelp_beans.matching.group_match import local_search_groups
+from yelp_beans.matching.group_match import run_annealing_chains
+from yelp_beans.matching.match_utils import rebuild_pair_history
 from yelp_beans.models import Meeting
 from yelp_beans.models import MeetingParticipant
 from yelp_beans.models import MeetingSpec
@@ -117,6 +126,7 @@ def test_get_previous_meetings_counts(session):
     session.add(mp1)
     session.add(mp2)
     session.commit()
+    rebuild_pair_history()
 
     assert get_previous_meetings_counts([user1, user2], subscription) == {(user1.id, user2.id): 1}
 
@@ -142,7 +152,140 @@ def test_get_user_weights(session):
     session.add(mp1)
     session.add(mp2)
     session.commit()
+    rebuild_pair_history()
 
     previous_meetings_count = get_previous_meetings_counts([user1, user2], subscription)
 
-    assert get_user_weights([user1, user2], previous_meetings_count, 10, 5) == [[0, 5], [5, 0]]
+    assert get_user_weights([user1, user2], previous_meetings_count, 10, 5).tolist() == [[0, 5], [5, 0]]
+
+
+def test_get_user_weights_scatter():
+    users = [User(id=7), User(id=3), User(id=5)]
+    # the pair with user 9 is not in this spec and is ignored
+    weights = get_user_weights(users, {(3, 7): 2, (5, 7): 1, (3, 9): 4}, 10, 3)
+    assert weights.tolist() == [[0, 4, 7], [4, 0, 10], [7, 10, 0]]
+
+
+def test_state_get_cost():
+    adj_matrix = np.arange(49, dtype=float).reshape(7, 7)
+    adj_matrix = adj_matrix + adj_matrix.T
+    np.fill_diagonal(adj_matrix, 0)
+    ids = [4, 0, 6, 2, 1, 5, 3]
+    state = State(7, 3, ids)
+
+    expected = sum(adj_matrix[a][b] for i in range(0, len(ids), 3) for a, b in itertools.combinations(ids[i : i + 3], 2))
+    assert state.get_cost(adj_matrix) == expected
+
+
+def test_state_swap_delta_matches_full_cost():
+    rng = np.random.default_rng(0)
+    adj_matrix = rng.integers(-10, 10, size=(11, 11)).astype(float)
+    adj_matrix = adj_matrix + adj_matrix.T
+    np.fill_diagonal(adj_matrix, 0)
+    weights = adj_matrix.tolist()
+    state = State(11, 3, list(range(11)))
+    state.track_group_costs(adj_matrix)
+
+    for x, y in [(0, 4), (2, 10), (9, 1), (3, 5), (6, 7), (10, 0)]:
+        cost = state.get_cost(adj_matrix)
+        delta_x, delta_y = state.get_swap_delta(x, y, weights)
+        state.swap(x, y, delta_x, delta_y)
+        assert state.get_cost(adj_matrix) == cost + delta_x + delta_y
+        assert sum(state.group_costs) == state.get_cost(adj_matrix)
+
+
+def _random_adj_matrix(size, seed):
+    rng = np.random.default_rng(seed)
+    adj_matrix = rng.integers(0, 10, size=(size, size)).astype(float)
+    adj_matrix = adj_matrix + adj_matrix.T
+    np.fill_diagonal(adj_matrix, 0)
+    return adj_matrix
+
+
+def test_run_annealing_chains_reproducible():
+    adj_matrix = _random_adj_matrix(30, 0)
+    first = run_annealing_chains(30, 3, adj_matrix, chains=3, seed=42, max_iterations=2000)
+    second = run_annealing_chains(30, 3, adj_matrix, chains=3, seed=42, max_iterations=2000)
+    pooled = run_annealing_chains(30, 3, adj_matrix, chains=3, processes=2, seed=42, max_iterations=2000)
+    assert first == second == pooled
+    assert sorted(first) == list(range(30))
+
+
+def test_run_annealing_chains_keeps_best_chain():
+    adj_matrix = _random_adj_matrix(30, 1)
+    single = run_annealing_chains(30, 3, adj_matrix, chains=1, seed=7, max_iterations=500)
+    multi = run_annealing_chains(30, 3, adj_matrix, chains=4, seed=7, max_iterations=500)
+    # the first chain of both runs uses the same seed, so extra chains can only help
+    assert State(30, 3, multi).get_cost(adj_matrix) >= State(30, 3, single).get_cost(adj_matrix)
+
+
+def test_annealing_time_budget():
+    annealing = Annealing(30, 3, _random_adj_matrix(30, 2), max_iterations=10**9, time_budget=0.1, seed=0)
+    start = time.monotonic()
+    ids = annealing.simulated_annealing()
+    assert time.monotonic() - start < 5
+    assert sorted(ids) == list(range(30))
+    assert annealing.best_cost == State(30, 3, ids).get_cost(annealing.adj_matrix)
+
+
+@pytest.mark.parametrize("schedule", Annealing.SCHEDULES)
+def test_annealing_schedules(schedule):
+    adj_matrix = _random_adj_matrix(30, 3)
+    annealing = Annealing(30, 3, adj_matrix, max_iterations=20000, seed=0, schedule=schedule)
+    ids = annealing.simulated_annealing()
+
+    assert annealing.best_cost == State(30, 3, ids).get_cost(adj_matrix)
+    assert annealing.trace[-1][0] == annealing.iterations
+    assert [point[2] for point in annealing.trace] == sorted(point[2] for point in annealing.trace)
+    # better than the average shuffle
+    assert annealing.best_cost > np.mean(
+        [State(30, 3, list(np.random.default_rng(seed).permutation(30))).get_cost(adj_matrix) for seed in range(10)]
+    )
+
+
+def test_annealing_invalid_schedule():
+    with pytest.raises(ValueError):
+        Annealing(30, 3, _random_adj_matrix(30, 3), schedule="linear")
+
+
+def test_annealing_stops_on_plateau():
+    # everyone weighs the same, so the first state is already the best
+    adj_matrix = np.full((30, 30), 10.0)
+    np.fill_diagonal(adj_matrix, 0)
+    annealing = Annealing(30, 3, adj_matrix, max_iterations=100000, seed=0, patience=5000)
+    annealing.simulated_annealing()
+    assert annealing.iterations <= 7000
+
+
+def test_annealing_negative_weights():
+    adj_matrix = -_random_adj_matrix(12, 4)
+    annealing = Annealing(12, 3, adj_matrix, max_iterations=5000, seed=0)
+    ids = annealing.simulated_annealing()
+    assert annealing.best_cost == State(12, 3, ids).get_cost(adj_matrix)
+
+
+def test_local_search_groups_finds_clusters():
+    # two clusters of three people who have never met each other
+    adj_matrix = np.full((6, 6), -5.0)
+    for cluster in ([0, 2, 4], [1, 3, 5]):
+        adj_matrix[np.ix_(cluster, cluster)] = 10
+    np.fill_diagonal(adj_matrix, 0)
+
+    cost, ids = local_search_groups(6, 3, adj_matrix, seed=0)
+    assert cost == 60
+    assert {frozenset(ids[:3]), frozenset(ids[3:])} == {frozenset([0, 2, 4]), frozenset([1, 3, 5])}
+
+
+def test_local_search_groups_leftover():
+    adj_matrix = _random_adj_matrix(32, 5)
+    cost, ids = local_search_groups(32, 3, adj_matrix, seed=0)
+    assert sorted(ids) == list(range(32))
+    groups = [ids[start : start + 3] for start in range(0, 30, 3)]
+    assert cost == sum(adj_matrix[a][b] for group in groups for a, b in itertools.combinations(group, 2))
+
+    # no single swap, including with the two people left over, improves the groups
+    for x, y in itertools.combinations(range(32), 2):
+        swapped = ids[:]
+        swapped[x], swapped[y] = swapped[y], swapped[x]
+        swapped_groups = [swapped[start : start + 3] for start in range(0, 30, 3)]
+        assert sum(adj_matrix[a][b] for group in swapped_groups for a, b in itertools.combinations(group, 2)) <= cost
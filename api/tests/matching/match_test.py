@@ -2,9 +2,14 @@ import itertools
 from datetime import datetime
 from datetime import timedelta
 
+import factory
+import pytest
+from database import db
 from yelp_beans.logic.subscription import get_specs_from_subscription
 from yelp_beans.logic.subscription import store_specs_from_subscription
 from yelp_beans.matching.match import generate_meetings
+from yelp_beans.matching.match import match_specs
+from yelp_beans.matching.match_utils import rebuild_pair_history
 from yelp_beans.models import Meeting
 from yelp_beans.models import MeetingParticipant
 from yelp_beans.models import MeetingRequest
@@ -230,9 +235,48 @@ def test_previous_meeting_penalty(session):
 
     session.commit()
 
+    rebuild_pair_history()
+
     for run in range(10):
         matches, unmatched = generate_meetings(users, meeting_spec1, prev_meeting_tuples=None, group_size=3)
         assert len(matches) == 6
         assert len(unmatched) == 2
         for matched_group in matches:
             assert not (users[0] in matched_group and users[1] in matched_group)
+
+
+@pytest.fixture
+def file_session(tmp_path, monkeypatch):
+    # worker processes open their own connections, which an in memory database does not survive
+    monkeypatch.setattr(factory, "get_config", lambda: {"DATABASE_URL_PROD": f"sqlite:///{tmp_path / 'beans.db'}"})
+    app = factory.create_app()
+    with app.app_context():
+        yield db.session
+        db.session.remove()
+
+
+def test_match_specs_parallel(file_session):
+    subscription = MeetingSubscription(title="all engineering weekly", size=2, timezone="America/Los_Angeles")
+    specs = [MeetingSpec(meeting_subscription=subscription, datetime=datetime.now() + timedelta(days=day)) for day in range(3)]
+    users = [User(email=f"{i}@yelp.com", meta_data={"department": f"dept{i}"}) for i in range(7)]
+    file_session.add_all([subscription, *specs, *users])
+    file_session.add_all(
+        [MeetingRequest(user=user, meeting_spec=spec) for spec in specs for user in users[: 3 + 2 * specs.index(spec)]]
+    )
+    file_session.commit()
+
+    def as_ids(results):
+        return [
+            (
+                {frozenset(user.id for user in match if isinstance(user, User)) for match in matches},
+                {user.id for user in unmatched},
+            )
+            for matches, unmatched in results
+        ]
+
+    serial = match_specs(specs)
+    parallel = match_specs(specs, processes=2)
+
+    assert as_ids(parallel) == as_ids(serial)
+    assert [len(matches) for matches, _ in parallel] == [1, 2, 3]
+    assert all(isinstance(user, User) for matches, _ in parallel for match in matches for user in match)
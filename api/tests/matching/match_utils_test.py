@@ -1,15 +1,20 @@
 from datetime import datetime
 from datetime import timedelta
 
+import pytest
+from database import db
+from sqlalchemy import delete
+from sqlalchemy.exc import IntegrityError
 from yelp_beans.matching.match import generate_meetings
-from yelp_beans.matching.match_utils import get_counts_for_pairs
-from yelp_beans.matching.match_utils import get_previous_meetings
+from yelp_beans.matching.match_utils import get_pair_history
+from yelp_beans.matching.match_utils import rebuild_pair_history
 from yelp_beans.matching.match_utils import save_meetings
 from yelp_beans.models import Meeting
 from yelp_beans.models import MeetingParticipant
 from yelp_beans.models import MeetingRequest
 from yelp_beans.models import MeetingSpec
 from yelp_beans.models import MeetingSubscription
+from yelp_beans.models import PairHistory
 from yelp_beans.models import SubscriptionDateTime
 from yelp_beans.models import User
 from yelp_beans.models import UserSubscriptionPreferences
@@ -17,13 +22,6 @@ from yelp_beans.models import UserSubscriptionPreferences
 MEETING_COOLDOWN_WEEKS = 10
 
 
-def test_pair_to_counts():
-    pairs = [("user1", "user2"), ("user1", "user2"), ("user2", "user3")]
-    counts = get_counts_for_pairs(pairs)
-    assert counts[("user2", "user3")] == 1
-    assert counts[("user1", "user2")] == 2
-
-
 def test_generate_save_meetings(session, subscription):
     pref_1 = SubscriptionDateTime(datetime=datetime.now() - timedelta(weeks=MEETING_COOLDOWN_WEEKS - 1))
     subscription = MeetingSubscription(title="all engineering weekly", datetime=[pref_1])
@@ -54,7 +52,52 @@ def test_generate_save_meetings(session, subscription):
     assert participants == [user1, user2]
 
 
-def test_get_previous_meetings(session):
+def test_save_meetings_groups(session, subscription):
+    meeting_spec = MeetingSpec(meeting_subscription=subscription, datetime=datetime.now())
+    users = [User(email=f"{i}@yelp.com", meta_data={"department": f"dept{i}"}) for i in range(6)]
+    session.add(meeting_spec)
+    session.add_all(users)
+    session.commit()
+
+    meeting_ids = save_meetings([users[:3], users[3:] + [None]], meeting_spec)
+
+    assert len(meeting_ids) == 2
+    meetings = Meeting.query.order_by(Meeting.id).all()
+    assert [meeting.id for meeting in meetings] == meeting_ids
+    assert all(meeting.meeting_spec == meeting_spec and not meeting.cancelled for meeting in meetings)
+    for meeting_id, group in zip(meeting_ids, [users[:3], users[3:]]):
+        participants = MeetingParticipant.query.filter(MeetingParticipant.meeting_id == meeting_id).all()
+        assert sorted(participant.user_id for participant in participants) == [user.id for user in group]
+
+
+def test_save_meetings_no_matches(session, subscription):
+    meeting_spec = MeetingSpec(meeting_subscription=subscription, datetime=datetime.now())
+    session.add(meeting_spec)
+    session.commit()
+
+    assert save_meetings([], meeting_spec) == []
+    assert Meeting.query.count() == 0
+
+
+def test_save_meetings_is_all_or_nothing(session, subscription):
+    meeting_spec = MeetingSpec(meeting_subscription=subscription, datetime=datetime.now())
+    user1 = User(email="a@yelp.com", meta_data={"department": "dept"})
+    user2 = User(email="b@yelp.com", meta_data={"department": "dept2"})
+    session.add(meeting_spec)
+    session.add(user1)
+    session.add(user2)
+    session.commit()
+    # never flushed, so its participant row violates the not null constraint
+    unsaved = User(email="c@yelp.com", meta_data={"department": "dept3"})
+
+    with pytest.raises(IntegrityError):
+        save_meetings([(user1, user2), (user1, unsaved)], meeting_spec)
+
+    assert Meeting.query.count() == 0
+    assert MeetingParticipant.query.count() == 0
+
+
+def test_get_pair_history(session):
     pref_1 = SubscriptionDateTime(datetime=datetime.now() - timedelta(weeks=MEETING_COOLDOWN_WEEKS - 1))
     subscription = MeetingSubscription(title="all engineering weekly", datetime=[pref_1])
     user_pref = UserSubscriptionPreferences(preference=pref_1, subscription=subscription)
@@ -76,10 +119,12 @@ def test_get_previous_meetings(session):
     session.add(mp2)
     session.commit()
 
-    assert get_previous_meetings(subscription) == set([(user1.id, user2.id)])
+    rebuild_pair_history()
+
+    assert get_pair_history(subscription) == {(user1.id, user2.id): 1}
 
 
-def test_get_previous_meetings_multi_subscription(session):
+def test_get_pair_history_multi_subscription(session):
     pref_1 = SubscriptionDateTime(datetime=datetime.now() - timedelta(weeks=MEETING_COOLDOWN_WEEKS - 1))
     subscription1 = MeetingSubscription(title="all engineering weekly", datetime=[pref_1])
     subscription2 = MeetingSubscription(title="all sales weekly", datetime=[pref_1])
@@ -105,11 +150,13 @@ def test_get_previous_meetings_multi_subscription(session):
     session.add(mp2)
     session.commit()
 
-    assert get_previous_meetings(subscription1) == set([(user1.id, user2.id)])
-    assert get_previous_meetings(subscription2) == set([])
+    rebuild_pair_history()
+
+    assert get_pair_history(subscription1) == {(user1.id, user2.id): 1}
+    assert get_pair_history(subscription2) == {}
 
 
-def test_get_previous_multi_meetings(session):
+def test_get_pair_history_multi_meetings(session):
     pref_1 = SubscriptionDateTime(datetime=datetime.now() - timedelta(weeks=MEETING_COOLDOWN_WEEKS - 1))
     subscription = MeetingSubscription(title="all engineering weekly", datetime=[pref_1])
     user_pref = UserSubscriptionPreferences(preference=pref_1, subscription=subscription)
@@ -137,10 +184,12 @@ def test_get_previous_multi_meetings(session):
     session.add(mp4)
     session.commit()
 
-    assert get_previous_meetings(subscription) == set([(user1.id, user2.id), (user1.id, user2.id)])
+    rebuild_pair_history()
 
+    assert get_pair_history(subscription) == {(user1.id, user2.id): 2}
 
-def test_get_previous_meetings_no_specs(database_no_specs, session):
+
+def test_get_pair_history_no_specs(database_no_specs, session):
     pref_1 = SubscriptionDateTime(datetime=datetime.now() - timedelta(weeks=MEETING_COOLDOWN_WEEKS + 1))
     subscription = MeetingSubscription(title="all engineering weekly", datetime=[pref_1])
     user_pref = UserSubscriptionPreferences(preference=pref_1, subscription=subscription)
@@ -162,4 +211,120 @@ def test_get_previous_meetings_no_specs(database_no_specs, session):
     session.add(mp2)
     session.commit()
 
-    assert get_previous_meetings(subscription) == set([])
+    rebuild_pair_history()
+
+    assert get_pair_history(subscription) == {}
+
+
+def test_get_pair_history_single_query(session, subscription, statement_counter):
+    meeting_spec = MeetingSpec(meeting_subscription=subscription, datetime=datetime.now() - timedelta(weeks=1))
+    old_spec = MeetingSpec(
+        meeting_subscription=subscription, datetime=datetime.now() - timedelta(weeks=MEETING_COOLDOWN_WEEKS + 1)
+    )
+    users = [User(email=f"{i}@yelp.com", meta_data={"department": f"dept{i}"}) for i in range(5)]
+    group = Meeting(meeting_spec=meeting_spec)
+    old_pair = Meeting(meeting_spec=old_spec)
+    session.add_all(users)
+    session.add_all([meeting_spec, old_spec, group, old_pair])
+    session.add_all([MeetingParticipant(meeting=group, user=user) for user in reversed(users[:3])])
+    session.add_all([MeetingParticipant(meeting=old_pair, user=user) for user in users[3:]])
+    session.commit()
+    rebuild_pair_history()
+    # load the committed subscription up front so only get_pair_history is counted
+    assert subscription.id
+
+    with statement_counter() as statements:
+        pair_history = get_pair_history(subscription, cooldown=MEETING_COOLDOWN_WEEKS)
+
+    user1, user2, user3 = (user.id for user in users[:3])
+    assert pair_history == {(user1, user2): 1, (user1, user3): 1, (user2, user3): 1}
+    assert len(statements) == 1
+
+
+def test_save_meetings_updates_pair_history(session, subscription):
+    last_week = MeetingSpec(meeting_subscription=subscription, datetime=datetime.now() - timedelta(weeks=1))
+    this_week = MeetingSpec(meeting_subscription=subscription, datetime=datetime.now())
+    users = [User(email=f"{i}@yelp.com", meta_data={"department": f"dept{i}"}) for i in range(3)]
+    session.add_all([last_week, this_week, *users])
+    session.commit()
+    user1, user2, user3 = users
+
+    save_meetings([(user2, user1)], last_week)
+    save_meetings([(user1, user2, user3)], this_week)
+
+    history = {(row.user_a_id, row.user_b_id, row.met): row.count for row in PairHistory.query.all()}
+    assert history == {
+        (user1.id, user2.id, last_week.datetime): 1,
+        (user1.id, user2.id, this_week.datetime): 1,
+        (user1.id, user3.id, this_week.datetime): 1,
+        (user2.id, user3.id, this_week.datetime): 1,
+    }
+    assert get_pair_history(subscription, cooldown=MEETING_COOLDOWN_WEEKS) == {
+        (user1.id, user2.id): 2,
+        (user1.id, user3.id): 1,
+        (user2.id, user3.id): 1,
+    }
+
+
+def test_get_pair_history_cooldown(session, subscription):
+    other_subscription = MeetingSubscription(title="other")
+    recent_spec = MeetingSpec(meeting_subscription=subscription, datetime=datetime.now() - timedelta(weeks=1))
+    old_spec = MeetingSpec(
+        meeting_subscription=subscription, datetime=datetime.now() - timedelta(weeks=MEETING_COOLDOWN_WEEKS + 1)
+    )
+    other_spec = MeetingSpec(meeting_subscription=other_subscription, datetime=datetime.now())
+    users = [User(email=f"{i}@yelp.com", meta_data={"department": f"dept{i}"}) for i in range(4)]
+    session.add_all([recent_spec, old_spec, other_spec, *users])
+    session.commit()
+
+    save_meetings([(users[0], users[1])], recent_spec)
+    save_meetings([(users[2], users[3])], old_spec)
+    save_meetings([(users[0], users[2])], other_spec)
+
+    assert get_pair_history(subscription, cooldown=MEETING_COOLDOWN_WEEKS) == {(users[0].id, users[1].id): 1}
+
+
+def test_get_pair_history_counts_meetings_in_cooldown_only(session, subscription):
+    specs = [
+        MeetingSpec(meeting_subscription=subscription, datetime=datetime.now() - timedelta(weeks=weeks))
+        for weeks in (30, 20, MEETING_COOLDOWN_WEEKS + 1, MEETING_COOLDOWN_WEEKS - 1, 1)
+    ]
+    users = [User(email=f"{i}@yelp.com", meta_data={"department": f"dept{i}"}) for i in range(3)]
+    session.add_all([*specs, *users])
+    session.commit()
+    user1, user2, user3 = users
+
+    # user1 and user2 met 30, 20, 11 and 1 weeks ago, user1 and user3 9 and 1 weeks ago
+    for spec in specs[:3]:
+        save_meetings([(user1, user2)], spec)
+    save_meetings([(user1, user3)], specs[3])
+    save_meetings([(user1, user2), (user1, user3)], specs[4])
+
+    assert get_pair_history(subscription, cooldown=MEETING_COOLDOWN_WEEKS) == {
+        (user1.id, user2.id): 1,
+        (user1.id, user3.id): 2,
+    }
+    assert get_pair_history(subscription, cooldown=40) == {(user1.id, user2.id): 4, (user1.id, user3.id): 2}
+
+
+def test_rebuild_pair_history(session, subscription):
+    specs = [MeetingSpec(meeting_subscription=subscription, datetime=datetime.now() - timedelta(weeks=week)) for week in range(3)]
+    users = [User(email=f"{i}@yelp.com", meta_data={"department": f"dept{i}"}) for i in range(4)]
+    session.add_all([*specs, *users])
+    session.commit()
+    save_meetings([(users[0], users[1], users[2])], specs[2])
+    save_meetings([(users[0], users[1]), (users[2], users[3])], specs[1])
+    save_meetings([(users[1], users[0])], specs[0])
+
+    def snapshot():
+        return {
+            (row.subscription_id, row.user_a_id, row.user_b_id, row.met): row.count
+            for row in session.execute(db.select(PairHistory)).scalars()
+        }
+
+    saved = snapshot()
+    session.execute(delete(PairHistory))
+    session.commit()
+
+    assert rebuild_pair_history() == len(saved) == 6
+    assert snapshot() == saved
@@ -0,0 +1,94 @@
+import itertools
+import random
+from types import SimpleNamespace
+
+from yelp_beans.matching.pair_match import construct_graph
+from yelp_beans.matching.pair_match import get_allowed_meetings
+from yelp_beans.matching.pair_match import greedy_matching
+
+
+def _spec(*rule_names):
+    rules = [SimpleNamespace(name=name) for name in rule_names]
+    return SimpleNamespace(meeting_subscription=SimpleNamespace(dept_rules=rules))
+
+
+def _users(*meta_datas):
+    return [SimpleNamespace(id=user_id, meta_data=meta_data) for user_id, meta_data in enumerate(meta_datas, start=1)]
+
+
+def test_get_allowed_meetings_no_rules():
+    users = _users({}, {}, {}, {})
+    allowed = set(get_allowed_meetings(users, set(), _spec()))
+    assert allowed == set(itertools.combinations([1, 2, 3, 4], 2))
+
+
+def test_get_allowed_meetings_skips_previous_meetings():
+    users = _users({}, {}, {})
+    allowed = set(get_allowed_meetings(users, {(1, 2), (3, 2)}, _spec()))
+    assert allowed == {(1, 3)}
+
+
+def test_get_allowed_meetings_dept_rules():
+    users = _users(
+        {"department": "eng", "floor": "1"},
+        {"department": "eng", "floor": "2"},
+        {"department": "sales", "floor": "1"},
+        {"department": "sales", "floor": "3"},
+        {"department": "design", "floor": "2"},
+    )
+    allowed = set(get_allowed_meetings(users, set(), _spec("department")))
+    assert allowed == {(1, 3), (1, 4), (1, 5), (2, 3), (2, 4), (2, 5), (3, 5), (4, 5)}
+
+    allowed = set(get_allowed_meetings(users, {(2, 4)}, _spec("department", "floor")))
+    assert allowed == {(1, 4), (1, 5), (2, 3), (3, 5), (4, 5)}
+
+
+def test_get_allowed_meetings_list_metadata():
+    users = _users({"teams": ["a", "b"]}, {"teams": ["a", "b"]}, {"teams": ["a"]})
+    allowed = set(get_allowed_meetings(users, set(), _spec("teams")))
+    assert allowed == {(1, 3), (2, 3)}
+
+
+def test_construct_graph():
+    matches = construct_graph([1, 2, 3, 4, 5], iter([(1, 2), (2, 3), (3, 4)]))
+    assert {tuple(sorted(match)) for match in matches} == {(1, 2), (3, 4)}
+
+
+def test_construct_graph_components():
+    # two triangles and a square, plus someone with no allowed meetings
+    allowed = [(1, 2), (2, 3), (1, 3), (4, 5), (5, 6), (4, 6), (7, 8), (8, 9), (9, 10), (7, 10)]
+    matches = construct_graph(list(range(1, 12)), allowed)
+    assert len(matches) == 4
+    matched = [user for match in matches for user in match]
+    assert len(matched) == len(set(matched))
+    assert {tuple(sorted(match)) for match in matches} <= set(allowed)
+
+
+def test_construct_graph_process_pool():
+    allowed = [(1, 2), (2, 3), (1, 3), (4, 5), (5, 6), (4, 6), (7, 8), (8, 9), (9, 10), (7, 10)]
+    assert len(construct_graph(list(range(1, 12)), allowed, processes=2)) == 4
+
+
+def test_greedy_matching():
+    # a path where pairing the middle first would leave two people out
+    matches = greedy_matching([1, 2, 3, 4], [(1, 2), (2, 3), (3, 4)])
+    assert matches == {(1, 2), (3, 4)}
+
+
+def test_greedy_matching_augmenting_path():
+    # 2-3 and 4-5 are matched first, only a path through both can match 1 and 6
+    allowed = [(2, 3), (4, 5), (1, 2), (3, 4), (5, 6), (2, 7), (3, 7), (4, 8), (5, 8)]
+    short = greedy_matching(list(range(1, 9)), allowed)
+    full = greedy_matching(list(range(1, 9)), allowed, max_path_length=None, time_budget=5)
+    assert len(full) == len(construct_graph(list(range(1, 9)), allowed))
+    assert len(full) >= len(short)
+    matched = [user for match in full for user in match]
+    assert len(matched) == len(set(matched))
+    assert full <= set(allowed)
+
+
+def test_greedy_matching_random_graph():
+    rng = random.Random(0)
+    allowed = [pair for pair in itertools.combinations(range(60), 2) if rng.random() < 0.05]
+    matches = greedy_matching(list(range(60)), allowed, max_path_length=None)
+    assert len(matches) == len(construct_graph(list(range(60)), allowed))
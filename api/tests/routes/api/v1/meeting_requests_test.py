@@ -25,6 +25,35 @@ def test_create_meeting_request(app, monkeypatch, database, fake_user):
     assert requests[0].meeting_spec == database.specs[0]
 
 
+def test_create_meeting_request_created_meanwhile(app, monkeypatch, database, fake_user, session):
+    monkeypatch.setattr(meeting_requests, "get_user", lambda x: fake_user)
+    existing = MeetingRequest(meeting_spec=database.specs[0], user=fake_user)
+    session.add(existing)
+    session.commit()
+    existing_key = existing.id
+    # the request is created between the check and the insert, e.g. by a double click
+    query_meeting_request = meeting_requests.query_meeting_request
+    checks = []
+
+    def query_after_first_check(meeting_spec, user):
+        checks.append(meeting_spec)
+        return query_meeting_request(meeting_spec, user) if len(checks) > 1 else None
+
+    monkeypatch.setattr(meeting_requests, "query_meeting_request", query_after_first_check)
+
+    with app.test_request_context(
+        "/v1/meeting_request/",
+        method="POST",
+        data=json.dumps({"meeting_spec_key": database.specs[0].id, "meeting_request_key": "", "email": fake_user.email}),
+        content_type="application/json",
+    ):
+        response = create_delete_meeting_request().json
+
+    assert response["key"] == existing_key
+    assert len(checks) == 2
+    assert MeetingRequest.query.count() == 1
+
+
 def test_delete_meeting_request(app, monkeypatch, database, fake_user, session):
     monkeypatch.setattr(meeting_requests, "get_user", lambda x: fake_user)
 
@@ -120,6 +120,10 @@ def test_subscribe_api_post_user_has_existing(client, session):
         "subscription": {
             "id": subscription.id,
             "default_auto_opt_in": False,
+            "matching_engine": "exact",
+            "matching_time_budget": None,
+            "annealing_iterations": None,
+            "annealing_chains": None,
             "location": "test place",
             "name": "Test",
             "office": "tester",
@@ -172,6 +176,10 @@ def test_subscribe_api_post_user_new_subscription(client, session, default_auto_
         "subscription": {
             "id": subscription.id,
             "default_auto_opt_in": default_auto_opt_in,
+            "matching_engine": "exact",
+            "matching_time_budget": None,
+            "annealing_iterations": None,
+            "annealing_chains": None,
             "location": "test place",
             "name": "Test",
             "office": "tester",
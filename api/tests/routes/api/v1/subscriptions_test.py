@@ -95,6 +95,10 @@ def test_get_subscriptions(client, session):
             "time_slots": [{"day": "thursday", "hour": 6, "minute": 0}],
             "timezone": "America/Los_Angeles",
             "default_auto_opt_in": False,
+            "matching_engine": "exact",
+            "matching_time_budget": None,
+            "annealing_iterations": None,
+            "annealing_chains": None,
         },
     ]
 
@@ -131,6 +135,10 @@ def test_get_subscriptions_has_rule(client, session):
             "time_slots": [{"day": "thursday", "hour": 6, "minute": 0}],
             "timezone": "America/Los_Angeles",
             "default_auto_opt_in": True,
+            "matching_engine": "exact",
+            "matching_time_budget": None,
+            "annealing_iterations": None,
+            "annealing_chains": None,
         },
     ]
 
@@ -165,6 +173,10 @@ def test_get_subscription(client, session):
         "time_slots": [{"day": "thursday", "hour": 6, "minute": 0}],
         "timezone": "America/Los_Angeles",
         "default_auto_opt_in": False,
+        "matching_engine": "exact",
+        "matching_time_budget": None,
+        "annealing_iterations": None,
+        "annealing_chains": None,
     }
 
 
@@ -248,6 +260,26 @@ def test_update_subscription_no_changes(client, session, mock_cur_time):
     assert row.datetime == [sub_time]
 
 
+def test_update_subscription_keeps_evening_time_slot(client, session, mock_cur_time):
+    # thursday 18:00 in Los Angeles is already friday in utc
+    sub_time = SubscriptionDateTime(datetime=datetime(2017, 7, 21, 1, 0))
+    subscription = MeetingSubscription(timezone="America/Los_Angeles", datetime=[sub_time], title="Test", size=2)
+    session.add(subscription)
+    session.commit()
+    data = {
+        "name": "Test",
+        "size": 2,
+        "time_slots": [{"day": "thursday", "hour": 18, "minute": 0}],
+        "timezone": "America/Los_Angeles",
+    }
+    resp = client.put(f"v1/subscriptions/{subscription.id}", json=data)
+    assert resp.json == {}
+
+    row = session.query(MeetingSubscription).filter(MeetingSubscription.id == subscription.id).one()
+    assert row.datetime == [sub_time]
+    assert (sub_time.local_weekday, sub_time.local_minute) == (3, 18 * 60)
+
+
 def test_update_subscription_add_rule_datatime(client, session, mock_cur_time):
     sub_time = SubscriptionDateTime(datetime=datetime(2017, 7, 20, 13, 0))
     rule = Rule(name="field", value="value")
@@ -392,3 +424,31 @@ def test_update_subscription_update_timezone_still_same_time(client, session):
     row = session.query(MeetingSubscription).filter(MeetingSubscription.id == subscription.id).one()
 
     assert row.datetime == [sub_time]
+
+
+def test_create_subscription_matching_engine(client, session, mock_cur_time):
+    resp = client.post(
+        "v1/subscriptions/",
+        json={
+            "name": "test",
+            "time_slots": [{"day": "monday", "hour": 9}],
+            "matching_engine": "budgeted",
+            "matching_time_budget": 30,
+            "annealing_iterations": 500000,
+            "annealing_chains": 4,
+        },
+    )
+    row = session.query(MeetingSubscription).filter(MeetingSubscription.id == resp.json["id"]).one()
+
+    assert row.matching_engine == "budgeted"
+    assert row.matching_time_budget == 30
+    assert row.annealing_iterations == 500000
+    assert row.annealing_chains == 4
+
+
+def test_create_subscription_invalid_matching_engine(client, session, mock_cur_time):
+    resp = client.post(
+        "v1/subscriptions/",
+        json={"name": "test", "time_slots": [{"day": "monday", "hour": 9}], "matching_engine": "magic"},
+    )
+    assert resp.status_code == 400
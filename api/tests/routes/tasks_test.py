@@ -1,13 +1,24 @@
 from datetime import datetime
+from unittest import mock
 
+from yelp_beans.data_providers.data_provider import SourceUnchanged
+from yelp_beans.models import Meeting
+from yelp_beans.models import MeetingParticipant
+from yelp_beans.models import MeetingRequest
 from yelp_beans.models import MeetingSpec
 from yelp_beans.models import MeetingSubscription
 from yelp_beans.models import Rule
 from yelp_beans.models import SubscriptionDateTime
 from yelp_beans.models import User
 from yelp_beans.models import UserSubscriptionPreferences
+from yelp_beans.routes import tasks
 from yelp_beans.routes.tasks import clean_user_subscriptions
+from yelp_beans.routes.tasks import generate_meeting_requests_for_auto_opt_in_preferences
 from yelp_beans.routes.tasks import generate_meeting_specs
+from yelp_beans.routes.tasks import match_employees
+from yelp_beans.routes.tasks import populate_employees
+from yelp_beans.routes.tasks import send_match_emails
+from yelp_beans.routes.tasks import send_outbox_emails
 from yelp_beans.routes.tasks import weekly_opt_in
 
 
@@ -82,3 +93,96 @@ def test_clean_user_subscriptions(session):
 
     user_sub_prefs = UserSubscriptionPreferences.query.all()
     assert len(user_sub_prefs) == 1
+
+
+def test_match_employees(session, database):
+    spec = database.specs[0]
+    users = [User(email=f"{i}@yelp.com", meta_data={"department": f"dept{i}"}) for i in range(5)]
+    session.add_all(users)
+    session.add_all([MeetingRequest(user=user, meeting_spec=spec) for user in users])
+    session.commit()
+
+    with mock.patch.object(tasks, "send_batch_unmatched_email") as unmatched_email, mock.patch.object(
+        tasks, "send_batch_meeting_confirmation_email"
+    ) as confirmation_email:
+        assert match_employees() == "OK"
+
+    matches = {call_spec.id: call_matches for (call_matches, call_spec), _ in confirmation_email.call_args_list}
+    unmatched = {call_spec.id: call_unmatched for (call_unmatched, call_spec), _ in unmatched_email.call_args_list}
+    assert len(matches[spec.id]) == 2
+    assert len(unmatched[spec.id]) == 1
+
+    meetings = Meeting.query.filter(Meeting.meeting_spec_id == spec.id).all()
+    assert len(meetings) == 2
+    participants = MeetingParticipant.query.filter(MeetingParticipant.meeting_id.in_([meeting.id for meeting in meetings])).all()
+    assert len({participant.user_id for participant in participants}) == 4
+
+
+def test_send_match_emails(session, database):
+    spec = database.specs[0]
+    users = [User(email=f"{i}@yelp.com", meta_data={"department": f"dept{i}"}) for i in range(5)]
+    meetings = [Meeting(meeting_spec=spec), Meeting(meeting_spec=spec)]
+    session.add_all([*users, *meetings])
+    session.add_all([MeetingParticipant(meeting=meetings[0], user=user) for user in users[:3]])
+    session.add_all([MeetingParticipant(meeting=meetings[1], user=user) for user in users[3:]])
+    session.commit()
+
+    with mock.patch.object(tasks, "send_batch_meeting_confirmation_email") as confirmation_email:
+        assert send_match_emails() == "OK"
+
+    calls = {call.args[1].id: call for call in confirmation_email.call_args_list}
+    assert sorted(sorted(user.id for user in match) for match in calls[spec.id].args[0]) == [
+        [user.id for user in users[:3]],
+        [user.id for user in users[3:]],
+    ]
+    assert calls[spec.id].kwargs == {"resend_failed": True}
+
+
+def test_generate_meeting_requests_for_auto_opt_in_preferences(session, database):
+    users = []
+    for i, (preference, auto_opt_in) in enumerate(
+        [(database.prefs[0], True), (database.prefs[1], True), (database.prefs[0], False)]
+    ):
+        user_pref = UserSubscriptionPreferences(subscription_id=database.sub.id, preference=preference, auto_opt_in=auto_opt_in)
+        user = User(email=f"{i}@yelp.com", meta_data={"department": "dept"}, subscription_preferences=[user_pref])
+        session.add_all([user_pref, user])
+        users.append(user)
+    session.commit()
+
+    assert generate_meeting_requests_for_auto_opt_in_preferences() == "OK"
+    # running it again does not add duplicates
+    assert generate_meeting_requests_for_auto_opt_in_preferences() == "OK"
+
+    spec_by_preference = {
+        preference.id: spec
+        for spec in database.specs
+        for preference in database.prefs
+        if (spec.local_weekday, spec.local_minute) == (preference.local_weekday, preference.local_minute)
+    }
+    requests = {(request.user_id, request.meeting_spec_id) for request in MeetingRequest.query.all()}
+    assert requests == {
+        (users[0].id, spec_by_preference[database.prefs[0].id].id),
+        (users[1].id, spec_by_preference[database.prefs[1].id].id),
+    }
+
+
+def test_send_outbox_emails(session):
+    with mock.patch.object(tasks, "send_queued_emails", return_value=3) as send_queued_emails:
+        assert send_outbox_emails() == "OK"
+    send_queued_emails.assert_called_once_with(chunk_size=1000, time_budget=300)
+
+
+def test_populate_employees_skips_unchanged_data(session):
+    def unchanged():
+        raise SourceUnchanged("employees.json")
+        yield
+
+    with mock.patch.object(tasks, "DataIngestion") as data_ingestion:
+        data_ingestion.return_value.stream.return_value = unchanged()
+        assert populate_employees() == "OK"
+    data_ingestion.return_value.mark_synced.assert_not_called()
+    assert User.query.count() == 0
+
+    with mock.patch.object(tasks, "DataIngestion") as data_ingestion:
+        assert populate_employees() == "OK"
+    data_ingestion.return_value.mark_synced.assert_called_once_with()
@@ -1,18 +1,36 @@
 import datetime
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
 from urllib.parse import parse_qs
 from urllib.parse import urlparse
 
 import pytest
 import pytz
+import requests
+from sqlalchemy import false
+from sqlalchemy import select
+from yelp_beans import send_email
 from yelp_beans.logic.meeting_spec import get_specs_for_current_week
 from yelp_beans.matching.match import generate_meetings
+from yelp_beans.models import EmailOutbox
 from yelp_beans.models import User
 from yelp_beans.models import UserSubscriptionPreferences
+from yelp_beans.send_email import EmailSender
+from yelp_beans.send_email import RateLimiter
+from yelp_beans.send_email import build_message
 from yelp_beans.send_email import create_google_calendar_invitation_link
+from yelp_beans.send_email import get_email_template
+from yelp_beans.send_email import render_email
 from yelp_beans.send_email import send_batch_initial_opt_in_email
 from yelp_beans.send_email import send_batch_meeting_confirmation_email
 from yelp_beans.send_email import send_batch_unmatched_email
 from yelp_beans.send_email import send_batch_weekly_opt_in_email
+from yelp_beans.send_email import send_emails
+from yelp_beans.send_email import send_personalized_emails
+from yelp_beans.send_email import send_queued_emails
 
 
 @pytest.mark.skip(reason="Testing Emails should be run locally with client_secrets.json present")
@@ -87,3 +105,304 @@ def test_create_google_calendar_invitation_link(test_datetime, expected_link_ctz
     ctz_param = parse_qs(parsed_url.query).get("ctz", None)
     ctz_value = ctz_param[0] if ctz_param else None
     assert ctz_value == expected_link_ctz
+
+
+@pytest.fixture
+def template_cache():
+    send_email.get_template_environment.cache_clear()
+    send_email.get_email_template.cache_clear()
+    yield
+    send_email.get_template_environment.cache_clear()
+    send_email.get_email_template.cache_clear()
+
+
+def test_render_email(template_cache):
+    html = render_email("unmatched_email.html", {"first_name": "Darwin", "project": "beans", "meeting_title": "Coffee"})
+
+    assert "Darwin" in html
+    assert "Coffee" in html
+    assert get_email_template("unmatched_email.html") is get_email_template("unmatched_email.html")
+
+
+def test_render_email_with_bytecode_cache(template_cache, monkeypatch, tmp_path):
+    cache_dir = tmp_path / "templates"
+    monkeypatch.setattr(send_email, "get_config", lambda: {"email_template_cache_dir": str(cache_dir)})
+    arguments = {"first_name": "Darwin", "project": "beans"}
+
+    html = render_email("welcome_email.html", arguments)
+    assert list(cache_dir.iterdir())
+
+    # a new process would load the compiled templates instead of compiling them again
+    send_email.get_template_environment.cache_clear()
+    send_email.get_email_template.cache_clear()
+    assert render_email("welcome_email.html", arguments) == html
+
+
+class FakeSendGridHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, self.headers["Authorization"], body, self.client_address[1]))
+            status = server.statuses.pop(0) if server.statuses else 202
+        recipient = body["personalizations"][0]["to"][0]["email"]
+        if recipient in server.failing_recipients:
+            status = 400
+        self.send_response(status)
+        if status == 429:
+            self.send_header("Retry-After", "0")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def sendgrid_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeSendGridHandler)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.statuses = []
+    server.failing_recipients = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _sender(server, **kwargs):
+    return EmailSender(api_key="key", host=f"http://127.0.0.1:{server.server_port}", backoff=0, **kwargs)
+
+
+def test_email_sender_retries_throttled_and_failed_requests(sendgrid_server):
+    sendgrid_server.statuses = [429, 503]
+
+    response = _sender(sendgrid_server).send(build_message("a@yelp.com", "Hi", "<p>Hi A</p>"))
+
+    assert response.status_code == 202
+    assert len(sendgrid_server.requests) == 3
+    path, authorization, body, _ = sendgrid_server.requests[-1]
+    assert path == "/v3/mail/send"
+    assert authorization == "Bearer key"
+    assert body["personalizations"][0]["to"] == [{"email": "a@yelp.com"}]
+
+
+def test_email_sender_gives_up(sendgrid_server):
+    sendgrid_server.statuses = [500, 500, 500]
+
+    with pytest.raises(requests.HTTPError):
+        _sender(sendgrid_server, retries=1).send(build_message("a@yelp.com", "Hi", "<p>Hi</p>"))
+    assert len(sendgrid_server.requests) == 2
+
+
+def test_rate_limiter():
+    rate_limiter = RateLimiter(rate=100)
+    start = time.monotonic()
+    for _ in range(11):
+        rate_limiter.wait()
+    assert time.monotonic() - start >= 0.09
+
+
+@pytest.fixture
+def outbox_sender(sendgrid_server, monkeypatch):
+    sender = _sender(sendgrid_server)
+    monkeypatch.setattr(send_email, "get_email_sender", lambda: sender)
+    monkeypatch.setattr(send_email, "get_config", lambda: {})
+    return sendgrid_server
+
+
+def test_batch_emails_are_queued_once(session, outbox_sender):
+    users = [User(email=f"{i}@yelp.com", first_name=f"User{i}") for i in range(3)]
+
+    send_batch_initial_opt_in_email(users)
+    send_batch_initial_opt_in_email(users)
+
+    assert outbox_sender.requests == []
+    emails = EmailOutbox.query.order_by(EmailOutbox.id).all()
+    assert [email.recipient for email in emails] == [user.email for user in users]
+    assert {email.status for email in emails} == {"pending"}
+    assert emails[0].substitutions == {"-first_name-": "User0"}
+    assert "-first_name-" in emails[0].content
+
+
+def test_send_queued_emails(session, outbox_sender):
+    users = [User(email=f"{i}@yelp.com", first_name=f"User{i}") for i in range(3)]
+    send_batch_initial_opt_in_email(users)
+    send_email.queue_emails("test", [("a@yelp.com", "Hi", "welcome_email.html", {"first_name": "A"})])
+
+    assert send_queued_emails(chunk_size=2) == 4
+    assert send_queued_emails() == 0
+
+    bodies = [body for _, _, body, _ in outbox_sender.requests]
+    # the opt-in emails go out as personalizations, in as many requests as chunks they were leased in
+    assert sorted(len(body["personalizations"]) for body in bodies) == [1, 1, 2]
+    assert {email.status for email in EmailOutbox.query.all()} == {"sent"}
+
+
+def test_send_queued_emails_retries_failures(session, outbox_sender):
+    outbox_sender.statuses = [400]
+    outbox_sender.failing_recipients = {"1@yelp.com"}
+    users = [User(email=f"{i}@yelp.com", first_name=f"User{i}") for i in range(3)]
+    send_batch_initial_opt_in_email(users)
+
+    # the batch fails and is sent one email at a time instead
+    assert send_queued_emails() == 2
+    failed = EmailOutbox.query.filter(EmailOutbox.recipient == "1@yelp.com").one()
+    assert (failed.status, failed.attempts) == ("pending", 1)
+    assert failed.leased_until > datetime.datetime.now()
+    contents = {
+        body["personalizations"][0]["to"][0]["email"]: body["content"][0]["value"] for _, _, body, _ in outbox_sender.requests[1:]
+    }
+    assert "User0" in contents["0@yelp.com"]
+    assert "-first_name-" not in contents["0@yelp.com"]
+
+    # nothing is sent again until the retry backoff has passed
+    assert send_queued_emails() == 0
+    for attempt in range(2, send_email.MAX_EMAIL_ATTEMPTS + 1):
+        failed.leased_until = None
+        session.commit()
+        assert send_queued_emails() == 0
+        session.refresh(failed)
+        assert failed.attempts == attempt
+    assert failed.status == "failed"
+
+
+def test_send_queued_emails_takes_over_expired_leases(session, outbox_sender):
+    send_email.queue_emails(
+        "test",
+        [(f"{i}@yelp.com", "Hi", "welcome_email.html", {"first_name": f"User{i}"}) for i in range(2)],
+    )
+    now = datetime.datetime.now()
+    leased, expired = EmailOutbox.query.order_by(EmailOutbox.id).all()
+    leased.status = expired.status = "sending"
+    leased.leased_until = now + datetime.timedelta(minutes=5)
+    expired.leased_until = now - datetime.timedelta(minutes=5)
+    session.commit()
+
+    assert send_queued_emails() == 1
+    assert [body["personalizations"][0]["to"][0]["email"] for _, _, body, _ in outbox_sender.requests] == ["1@yelp.com"]
+    assert EmailOutbox.query.filter(EmailOutbox.status == "sent").one().recipient == "1@yelp.com"
+
+
+def test_send_queued_emails_concurrently(session, sendgrid_server, monkeypatch):
+    sender = _sender(sendgrid_server, pool_size=4)
+    monkeypatch.setattr(send_email, "get_email_sender", lambda: sender)
+    monkeypatch.setattr(send_email, "get_config", lambda: {"email_workers": 4})
+    sendgrid_server.failing_recipients = {"3@yelp.com"}
+    users = [User(email=f"{i}@yelp.com", first_name=f"User{i}") for i in range(20)]
+    send_email.queue_emails("test", [(user.email, "Hi", "welcome_email.html", {"first_name": user.first_name}) for user in users])
+
+    assert send_queued_emails() == 19
+
+    recipients = [body["personalizations"][0]["to"][0]["email"] for _, _, body, _ in sendgrid_server.requests]
+    assert sorted(recipients) == sorted(user.email for user in users)
+    # the keep-alive pool reuses at most one connection per worker
+    assert len({port for _, _, _, port in sendgrid_server.requests}) <= 4
+
+
+def test_send_queued_emails_in_personalization_batches(session, outbox_sender):
+    users = [User(email=f"{i}@yelp.com", first_name=f"User{i}") for i in range(2500)]
+    send_batch_initial_opt_in_email(users)
+
+    assert send_queued_emails(chunk_size=2500) == 2500
+
+    assert len(outbox_sender.requests) == 3
+    bodies = [body for _, _, body, _ in outbox_sender.requests]
+    assert sorted(len(body["personalizations"]) for body in bodies) == [500, 1000, 1000]
+    assert all("-first_name-" in body["content"][0]["value"] for body in bodies)
+    substitutions = {
+        personalization["to"][0]["email"]: personalization["substitutions"]["-first_name-"]
+        for body in bodies
+        for personalization in body["personalizations"]
+    }
+    assert substitutions == {user.email: user.first_name for user in users}
+
+
+def test_send_queued_emails_without_personalizations(session, outbox_sender, monkeypatch):
+    monkeypatch.setattr(send_email, "get_config", lambda: {"email_personalizations": False})
+    users = [User(email=f"{i}@yelp.com", first_name=f"User{i}") for i in range(3)]
+    send_batch_initial_opt_in_email(users)
+
+    assert send_queued_emails() == 3
+
+    contents = {
+        body["personalizations"][0]["to"][0]["email"]: body["content"][0]["value"] for _, _, body, _ in outbox_sender.requests
+    }
+    assert len(contents) == 3
+    for user in users:
+        assert user.first_name in contents[user.email]
+        assert "-first_name-" not in contents[user.email]
+
+
+def test_send_emails_right_away(sendgrid_server, monkeypatch):
+    sender = _sender(sendgrid_server)
+    monkeypatch.setattr(send_email, "get_email_sender", lambda: sender)
+    monkeypatch.setattr(send_email, "get_config", lambda: {"email_workers": 2})
+    sendgrid_server.failing_recipients = {"1@yelp.com"}
+
+    assert send_emails([(f"{i}@yelp.com", "Hi", "welcome_email.html", {"first_name": f"User{i}"}) for i in range(3)]) == 2
+    assert len(sendgrid_server.requests) == 3
+
+
+def test_send_personalized_emails_falls_back_to_single_sends(sendgrid_server, monkeypatch):
+    sender = _sender(sendgrid_server)
+    monkeypatch.setattr(send_email, "get_email_sender", lambda: sender)
+    monkeypatch.setattr(send_email, "get_config", lambda: {})
+    sendgrid_server.statuses = [400]
+    users = [User(email=f"{i}@yelp.com", first_name=f"User{i}") for i in range(3)]
+
+    sent = send_personalized_emails(
+        [(user.email, {"first_name": user.first_name}) for user in users],
+        "Hi",
+        "welcome_email.html",
+        {"project": "beans"},
+    )
+
+    assert sent == 3
+    bodies = [body for _, _, body, _ in sendgrid_server.requests]
+    assert len(bodies) == 4
+    assert len(bodies[0]["personalizations"]) == 3
+    for body, user in zip(sorted(bodies[1:], key=lambda body: body["personalizations"][0]["to"][0]["email"]), users):
+        assert user.first_name in body["content"][0]["value"]
+        assert "-first_name-" not in body["content"][0]["value"]
+
+
+def test_queue_emails_queued_by_another_run(session, outbox_sender, monkeypatch):
+    emails = [(f"{i}@yelp.com", "Hi", "welcome_email.html", {"first_name": f"User{i}"}) for i in range(2)]
+    assert send_email.queue_emails("test", emails[:1]) == 1
+    # the other run queued its emails after this one checked what was queued
+    monkeypatch.setattr(send_email, "select", lambda *columns: select(*columns).where(false()))
+
+    assert send_email.queue_emails("test", emails) == 1
+    assert sorted(email.recipient for email in EmailOutbox.query.all()) == ["0@yelp.com", "1@yelp.com"]
+
+
+def test_resend_failed_match_emails(session, outbox_sender, database):
+    users = [User(email=f"{i}@yelp.com", first_name=f"User{i}", last_name="Yelp") for i in range(2)]
+    session.add_all(users)
+    session.commit()
+    spec = database.specs[0]
+    outbox_sender.failing_recipients = {"0@yelp.com"}
+    send_batch_meeting_confirmation_email([users], spec)
+    for _ in range(send_email.MAX_EMAIL_ATTEMPTS):
+        EmailOutbox.query.filter(EmailOutbox.status == "pending").update({"leased_until": None})
+        session.commit()
+        send_queued_emails()
+    assert {email.recipient: email.status for email in EmailOutbox.query.all()} == {"0@yelp.com": "failed", "1@yelp.com": "sent"}
+
+    # queueing the batch again leaves failed emails alone, unless asked to resend them
+    send_batch_meeting_confirmation_email([users], spec)
+    assert send_queued_emails() == 0
+    outbox_sender.failing_recipients = set()
+    send_batch_meeting_confirmation_email([users], spec, resend_failed=True)
+    failed = EmailOutbox.query.filter(EmailOutbox.recipient == "0@yelp.com").one()
+    assert (failed.status, failed.attempts) == ("pending", 0)
+
+    requests = len(outbox_sender.requests)
+    assert send_queued_emails() == 1
+    assert len(outbox_sender.requests) == requests + 1
+    assert {email.status for email in EmailOutbox.query.all()} == {"sent"}
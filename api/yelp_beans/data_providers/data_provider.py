@@ -1,21 +1,243 @@
+import codecs
+import hashlib
+import itertools
+import json
+import os
+import re
+import sys
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
+
+USER_FIELDS = ("email", "first_name", "last_name", "photo_url")
+# bytes read from a file or the network at a time when streaming employee data
+CHUNK_SIZE = 64 * 1024
+# metadata pairs shared between employees, the least recently seen are dropped past it
+MAX_INTERNED_PAIRS = 10000
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# a number, true, false or null runs until the whitespace, , or ] after it
+_SCALAR = re.compile(r"[^ \t\n\r,\]]*")
+
+
+@dataclass(frozen=True, slots=True)
+class Employee:
+    """
+    An employee as parsed by a data provider. Directories repeat the same metadata, e.g.
+    department and title, for thousands of employees, so metadata is kept as a tuple of
+    (key, value) pairs shared by every employee with that pair rather than as a dict per
+    employee. Employees are read like the dicts sync_employees takes, employee["metadata"]
+    building the metadata dict.
+    """
+
+    email: str | None
+    first_name: str | None
+    last_name: str | None
+    photo_url: str | None
+    metadata_items: tuple[tuple[str, Any], ...] = ()
+
+    @property
+    def metadata(self):
+        return dict(self.metadata_items)
+
+    def __getitem__(self, key):
+        if key in USER_FIELDS or key == "metadata":
+            return getattr(self, key)
+        raise KeyError(key)
+
+
+class InternTable:
+    """
+    The metadata pairs employees share, holding at most size pairs. Pairs repeated across
+    the directory, e.g. departments, stay in the table while pairs seen once, e.g. a desk
+    number, are dropped as new ones come in, so a long stream does not keep every value.
+    """
+
+    def __init__(self, size=MAX_INTERNED_PAIRS):
+        self.size = size
+        self.pairs = OrderedDict()
+
+    def intern(self, item):
+        # keyed by type too, True == 1 == 1.0 and must not share a pair
+        key = (item, type(item[1]))
+        shared = self.pairs.get(key)
+        if shared is not None:
+            self.pairs.move_to_end(key)
+            return shared
+        self.pairs[key] = item
+        if len(self.pairs) > self.size:
+            self.pairs.popitem(last=False)
+        return item
+
+
 class DataProvider:
+    """
+    Fetches employee data for sync_employees. Providers implement _fetch_records, yielding
+    the records of the directory as they are read so it never has to be in memory at once,
+    or _fetch, returning all of them.
+    """
+
+    def mark_synced(self):
+        """Called once the employees streamed by the provider have been synced"""
+
     def ingest(self, data=None):
-        raw_data = self._fetch(data)
-        return self._parse(raw_data)
+        return list(self.stream(data))
+
+    def stream(self, data=None):
+        interned = InternTable()
+        for employee in self._fetch_records(data):
+            yield self._parse_employee(employee, interned)
+
+    def _fetch_records(self, data):
+        return iter(self._fetch(data))
 
     def _fetch(self, data):
-        raise NotImplementedError
+        if type(self)._fetch_records is DataProvider._fetch_records:
+            raise NotImplementedError
+        return list(self._fetch_records(data))
 
     def _parse(self, data):
-        employees = []
-        for employee in data:
-            user = {
-                "email": employee.get("email"),
-                "first_name": employee.get("first_name"),
-                "last_name": employee.get("last_name"),
-                "photo_url": employee.get("photo_url"),
-            }
-            remaining_keys = set(employee.keys()) - set(user.keys())
-            user["metadata"] = {attr: employee[attr] for attr in remaining_keys}
-            employees.append(user)
-        return employees
+        interned = InternTable()
+        return [self._parse_employee(employee, interned) for employee in data]
+
+    def _parse_employee(self, employee, interned=None):
+        """An Employee, with metadata pairs already in interned shared instead of copied"""
+        if interned is None:
+            interned = InternTable()
+        metadata_items = []
+        for attr, value in employee.items():
+            if attr in USER_FIELDS:
+                continue
+            item = (sys.intern(attr), value)
+            try:
+                item = interned.intern(item)
+            except TypeError:
+                # lists and dicts are not hashable, they are kept as they are
+                pass
+            metadata_items.append(item)
+        return Employee(
+            employee.get("email"),
+            employee.get("first_name"),
+            employee.get("last_name"),
+            employee.get("photo_url"),
+            tuple(metadata_items),
+        )
+
+
+class SourceUnchanged(Exception):
+    """Raised by a provider when the employee data has not changed since it was last synced"""
+
+
+class SnapshotCache:
+    """
+    Keeps the last employee data a provider downloaded in cache_dir, with the ETag and
+    Last-Modified it was served with, so the provider can ask for the data only if it changed.
+    A snapshot that was downloaded but not synced yet is read again instead of downloading it.
+    """
+
+    def __init__(self, cache_dir, source):
+        os.makedirs(cache_dir, exist_ok=True)
+        name = hashlib.sha1(source.encode()).hexdigest()
+        self.path = os.path.join(cache_dir, f"{name}.json")
+        self.meta_path = os.path.join(cache_dir, f"{name}.meta.json")
+
+    def meta(self):
+        """The validators of the snapshot and whether it was synced, empty without a snapshot"""
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.meta_path) as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, chunks, etag=None, last_modified=None):
+        """Yields chunks while writing them to the snapshot, which is replaced once all were read"""
+        partial_path = f"{self.path}.partial"
+        with open(partial_path, "wb") as snapshot:
+            for chunk in chunks:
+                snapshot.write(chunk)
+                yield chunk
+        os.replace(partial_path, self.path)
+        self._write_meta({"etag": etag, "last_modified": last_modified, "synced": False})
+
+    def records(self, meta):
+        """Records of the unchanged snapshot, SourceUnchanged when they were synced already"""
+        if meta.get("synced"):
+            raise SourceUnchanged(self.path)
+        with open(self.path, "rb") as snapshot:
+            yield from iter_json_array(read_chunks(snapshot))
+
+    def mark_synced(self):
+        meta = self.meta()
+        if meta:
+            self._write_meta({**meta, "synced": True})
+
+    def _write_meta(self, meta):
+        partial_path = f"{self.meta_path}.partial"
+        with open(partial_path, "w") as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(partial_path, self.meta_path)
+
+
+def read_chunks(file):
+    while chunk := file.read(CHUNK_SIZE):
+        yield chunk
+
+
+def iter_json_array(chunks):
+    """
+    Yields the items of a JSON array as its text, or utf-8 bytes, is read in chunks.
+    Only the item being read is held in memory, not the whole array.
+    ValueError is raised when the chunks are not a JSON array.
+    """
+    decoder = json.JSONDecoder()
+    decode = codecs.getincrementaldecoder("utf-8")().decode
+    buffer = ""
+    # start: expecting [, first: an item or ], item: an item, separator: , or ], end: nothing
+    state = "start"
+    for chunk in itertools.chain(chunks, [None]):
+        final = chunk is None
+        if final:
+            chunk = decode(b"", final=True)
+        elif isinstance(chunk, bytes):
+            chunk = decode(chunk)
+        buffer += chunk
+        position = 0
+        while True:
+            position = _WHITESPACE.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            char = buffer[position]
+            if state == "start":
+                if char != "[":
+                    raise ValueError("Expected a JSON array")
+                state = "first"
+                position += 1
+            elif state == "end":
+                raise ValueError("Unexpected data after the JSON array")
+            elif char == "]" and state in ("first", "separator"):
+                state = "end"
+                position += 1
+            elif state == "separator":
+                if char != ",":
+                    raise ValueError(f"Expected , or ] at {char!r}")
+                state = "item"
+                position += 1
+            else:
+                # a number may go on in the next chunk, e.g. [1. then 5], so it is only
+                # decoded once what follows it has been read
+                if char not in '{["' and _SCALAR.match(buffer, position).end() == len(buffer) and not final:
+                    break
+                try:
+                    item, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if final:
+                        raise
+                    break
+                yield item
+                state = "separator"
+                position = end
+        buffer = buffer[position:]
+    if state != "end":
+        raise ValueError("Unterminated JSON array")
@@ -1,13 +1,12 @@
-import json
-
 from yelp_beans.data_providers.data_provider import DataProvider
+from yelp_beans.data_providers.data_provider import iter_json_array
+from yelp_beans.data_providers.data_provider import read_chunks
 
 
 class JSONFileDataProvider(DataProvider):
     def __init__(self, path=None):
         self.path = path
 
-    def _fetch(self, data):
+    def _fetch_records(self, data):
         with open(self.path, "rb") as json_file:
-            data = json.load(json_file)
-            return data
+            yield from iter_json_array(read_chunks(json_file))
@@ -1,25 +1,168 @@
+import collections
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util import Retry
+from urllib3.util import make_headers
 
+from yelp_beans.data_providers.data_provider import CHUNK_SIZE
 from yelp_beans.data_providers.data_provider import DataProvider
+from yelp_beans.data_providers.data_provider import SnapshotCache
+from yelp_beans.data_providers.data_provider import iter_json_array
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
 
 
 class RestfulJSONDataProvider(DataProvider):
-    def __init__(self, url, username=None, password=None, timeout=60.0):
+    """
+    Fetches employees from a JSON endpoint, over a pool of keep-alive connections that retries
+    failed requests and accepts compressed responses (gzip, and brotli when it is installed).
+    By default the endpoint returns one JSON array of every employee. Paginated directory APIs
+    are read by setting pagination, each page then being a JSON object with its employees
+    under records_key:
+        - page: pages page_param=1, 2, ... of page_size_param=page_size employees are fetched
+          up to workers at a time, until a page has no employees, or, with total_key, until
+          as many employees as the page gives under total_key were read. A short page is not
+          taken as the last one, servers may cap pages below page_size
+        - cursor: a page has the cursor of the next one under cursor_key, passed back as
+          cursor_param, the next page is fetched while the employees of the last are read
+    Employees are streamed out in page order as their page arrives. cache_dir only applies
+    when the endpoint is not paginated.
+    """
+
+    def __init__(
+        self,
+        url,
+        username=None,
+        password=None,
+        timeout=60.0,
+        cache_dir=None,
+        pagination=None,
+        records_key="results",
+        page_param="page",
+        page_size_param="page_size",
+        page_size=500,
+        total_key=None,
+        cursor_param="cursor",
+        cursor_key="next_cursor",
+        workers=4,
+        retries=3,
+    ):
+        if pagination not in (None, "page", "cursor"):
+            raise ValueError(f"Unknown pagination {pagination}, expected page or cursor")
         self.url = url
         self.username = username
         self.password = password
         self.timeout = timeout
+        self.snapshot = SnapshotCache(cache_dir, url) if cache_dir and not pagination else None
+        self.pagination = pagination
+        self.records_key = records_key
+        self.page_param = page_param
+        self.page_size_param = page_size_param
+        self.page_size = page_size
+        self.total_key = total_key
+        self.cursor_param = cursor_param
+        self.cursor_key = cursor_key
+        self.workers = workers
+        self.retries = retries
+        self._session = None
 
     def _authentication(self):
         if self.username and self.password:
             return HTTPBasicAuth(self.username, self.password)
 
-    def _fetch(self, data):
-        result = requests.get(
+    def session(self):
+        if self._session is None:
+            session = requests.Session()
+            session.auth = self._authentication()
+            session.headers["Accept-Encoding"] = make_headers(accept_encoding=True)["accept-encoding"]
+            retry = Retry(
+                total=self.retries,
+                backoff_factor=0.5,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=["GET"],
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers, max_retries=retry)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._session = session
+        return self._session
+
+    def mark_synced(self):
+        if self.snapshot:
+            self.snapshot.mark_synced()
+
+    def _fetch_records(self, data):
+        if self.pagination == "page":
+            return self._fetch_numbered_pages()
+        if self.pagination == "cursor":
+            return self._fetch_cursor_pages()
+        return self._fetch_document()
+
+    def _fetch_document(self):
+        meta = self.snapshot.meta() if self.snapshot else {}
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+        with self.session().get(
             self.url,
-            auth=self._authentication(),
             timeout=self.timeout,
-        )
+            headers=headers,
+            stream=True,
+        ) as result:
+            if result.status_code == 304 and self.snapshot:
+                yield from self.snapshot.records(meta)
+                return
+            result.raise_for_status()
+            chunks = result.iter_content(chunk_size=CHUNK_SIZE)
+            if self.snapshot:
+                chunks = self.snapshot.save(chunks, result.headers.get("ETag"), result.headers.get("Last-Modified"))
+            yield from iter_json_array(chunks)
+
+    def _fetch_page(self, params):
+        result = self.session().get(self.url, params=params, timeout=self.timeout)
         result.raise_for_status()
         return result.json()
+
+    def _fetch_numbered_pages(self):
+        pages = itertools.count(1)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+
+            def fetch_next_page():
+                return executor.submit(self._fetch_page, {self.page_param: next(pages), self.page_size_param: self.page_size})
+
+            pending = collections.deque(fetch_next_page() for _ in range(self.workers))
+            read = 0
+            try:
+                while pending:
+                    page = pending.popleft().result()
+                    records = page[self.records_key]
+                    if not records:
+                        # past the last page, the pages after it that are being fetched are empty
+                        break
+                    yield from records
+                    read += len(records)
+                    total = page.get(self.total_key) if self.total_key else None
+                    if total is not None and read >= total:
+                        break
+                    pending.append(fetch_next_page())
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _fetch_cursor_pages(self):
+        params = {self.page_size_param: self.page_size}
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(self._fetch_page, params)
+            while future is not None:
+                page = future.result()
+                cursor = page.get(self.cursor_key)
+                future = executor.submit(self._fetch_page, {**params, self.cursor_param: cursor}) if cursor else None
+                yield from page[self.records_key]
@@ -1,24 +1,46 @@
-import json
-
 import boto3
+from botocore.exceptions import ClientError
 
+from yelp_beans.data_providers.data_provider import CHUNK_SIZE
 from yelp_beans.data_providers.data_provider import DataProvider
+from yelp_beans.data_providers.data_provider import SnapshotCache
+from yelp_beans.data_providers.data_provider import iter_json_array
 
 
 class S3DataProvider(DataProvider):
-    def __init__(self, access_key_id=None, secret_access_key=None, bucket_name=None, key=None):
+    def __init__(self, access_key_id=None, secret_access_key=None, bucket_name=None, key=None, cache_dir=None):
         self.access_key_id = access_key_id
         self.secret_access_key = secret_access_key
         self.bucket_name = bucket_name
         self.key = key
+        self.snapshot = SnapshotCache(cache_dir, f"s3://{bucket_name}/{key}") if cache_dir else None
+
+    def mark_synced(self):
+        if self.snapshot:
+            self.snapshot.mark_synced()
 
-    def _fetch(self, data):
+    def _fetch_records(self, data):
         bucket = self._obtain_s3_connection(
             self.access_key_id,
             self.secret_access_key,
         ).Object(self.bucket_name, self.key)
-        contents = bucket.get()["Body"].read().decode("utf-8")
-        return json.loads(contents)
+        meta = self.snapshot.meta() if self.snapshot else {}
+        try:
+            response = bucket.get(**({"IfNoneMatch": meta["etag"]} if meta.get("etag") else {}))
+        except ClientError as e:
+            if e.response["ResponseMetadata"].get("HTTPStatusCode") != 304:
+                raise
+            yield from self.snapshot.records(meta)
+            return
+
+        body = response["Body"]
+        try:
+            chunks = body.iter_chunks(chunk_size=CHUNK_SIZE)
+            if self.snapshot:
+                chunks = self.snapshot.save(chunks, response.get("ETag"))
+            yield from iter_json_array(chunks)
+        finally:
+            body.close()
 
     def _obtain_s3_connection(self, access_key_id, secret_access_key):
         return boto3.resource(
@@ -18,3 +18,15 @@ class DataIngestion:
         for provider in self.data_providers:
             data = provider.ingest(data)
         return data
+
+    def stream(self):
+        """Like ingest, but employees are yielded as the providers read them"""
+        data = None
+        for provider in self.data_providers:
+            data = provider.stream(data)
+        return data
+
+    def mark_synced(self):
+        """Lets the providers skip the next sync when their data is unchanged by then"""
+        for provider in self.data_providers:
+            provider.mark_synced()
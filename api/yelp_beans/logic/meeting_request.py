@@ -1,8 +1,15 @@
 from database import db
+from sqlalchemy import delete
+from sqlalchemy import func
+from sqlalchemy import insert
+from sqlalchemy.orm import joinedload
 
+from yelp_beans.logic.meeting_spec import same_local_slot
 from yelp_beans.models import MeetingRequest
 from yelp_beans.models import MeetingSpec
+from yelp_beans.models import SubscriptionDateTime
 from yelp_beans.models import User
+from yelp_beans.models import UserSubscriptionPreferences
 
 
 def store_meeting_request(meeting_request: MeetingRequest) -> int:
@@ -37,3 +44,98 @@ def query_meeting_request(meeting_spec: MeetingSpec, user: User) -> MeetingReque
     return MeetingRequest.query.filter(
         MeetingRequest.meeting_spec_id == meeting_spec.id, MeetingRequest.user_id == user.id
     ).first()
+
+
+def query_users_for_matching(meeting_spec: MeetingSpec) -> list[User]:
+    """
+    Loads everyone who requested a meeting for the spec together with their subscription
+    preferences, which matching reads for every user. Takes two queries however many
+    people opted in.
+
+    Parameters
+    ----------
+    meeting_spec - MeetingSpec
+
+    Returns
+    -------
+    list of User, one per MeetingRequest
+    """
+
+    requests = (
+        MeetingRequest.query.filter(MeetingRequest.meeting_spec_id == meeting_spec.id)
+        .options(joinedload(MeetingRequest.user).selectinload(User.subscription_preferences))
+        .all()
+    )
+    return [request.user for request in requests]
+
+
+def create_auto_opt_in_meeting_requests(meeting_specs: list[MeetingSpec]) -> int:
+    """
+    Creates the missing MeetingRequests for everyone with auto opt in enabled on the time
+    slot of each spec, with a single INSERT .. SELECT. Users who already have a request for
+    a spec are left out, so running it again only adds what is missing.
+
+    Parameters
+    ----------
+    meeting_specs - list of MeetingSpec
+
+    Returns
+    -------
+    number of MeetingRequests created
+    """
+    if not meeting_specs:
+        return 0
+
+    existing_request = (
+        db.select(MeetingRequest.id)
+        .filter(MeetingRequest.meeting_spec_id == MeetingSpec.id, MeetingRequest.user_id == UserSubscriptionPreferences.user_id)
+        .exists()
+    )
+    missing_requests = (
+        db.select(MeetingSpec.id, UserSubscriptionPreferences.user_id)
+        .join(UserSubscriptionPreferences, UserSubscriptionPreferences.subscription_id == MeetingSpec.meeting_subscription_id)
+        .join(SubscriptionDateTime, UserSubscriptionPreferences.preference_id == SubscriptionDateTime.id)
+        .filter(
+            MeetingSpec.id.in_([meeting_spec.id for meeting_spec in meeting_specs]),
+            UserSubscriptionPreferences.auto_opt_in.is_(True),
+            UserSubscriptionPreferences.user_id.is_not(None),
+            *same_local_slot(MeetingSpec),
+            ~existing_request,
+        )
+        .distinct()
+    )
+    result = db.session.execute(insert(MeetingRequest).from_select(["meeting_spec_id", "user_id"], missing_requests))
+    db.session.commit()
+    return result.rowcount
+
+
+def dedupe_meeting_requests() -> int:
+    """
+    Deletes every MeetingRequest but the first of a user for a spec, then adds the unique
+    index on (meeting_spec_id, user_id) if the database was created without it, which fails
+    while duplicates are left. Run by the dedupe-meeting-requests command.
+
+    Returns
+    -------
+    number of MeetingRequests deleted
+    """
+    first_requests = (
+        db.select(func.min(MeetingRequest.id))
+        .filter(MeetingRequest.meeting_spec_id.is_not(None), MeetingRequest.user_id.is_not(None))
+        .group_by(MeetingRequest.meeting_spec_id, MeetingRequest.user_id)
+    )
+    result = db.session.execute(
+        delete(MeetingRequest)
+        .where(
+            MeetingRequest.meeting_spec_id.is_not(None),
+            MeetingRequest.user_id.is_not(None),
+            MeetingRequest.id.not_in(first_requests),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+    for index in MeetingRequest.__table__.indexes:
+        if index.unique:
+            index.create(db.session.get_bind(), checkfirst=True)
+    return result.rowcount
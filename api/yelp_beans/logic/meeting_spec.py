@@ -2,12 +2,16 @@ import logging
 from datetime import datetime
 from datetime import timedelta
 
+from database import db
 from pytz import timezone
 from pytz import utc
+from sqlalchemy import false
 
 from yelp_beans.models import MeetingSpec
+from yelp_beans.models import SubscriptionDateTime
 from yelp_beans.models import User
 from yelp_beans.models import UserSubscriptionPreferences
+from yelp_beans.models import get_local_slot
 
 
 def get_specs_for_current_week_query():
@@ -21,45 +25,54 @@ def get_specs_for_current_week():
 
 
 def get_users_from_spec(meeting_spec, exclude_user_prefs_with_auto_opt_in=False):
-    logging.info("Meeting subscription for spec:")
-    logging.info(meeting_spec.meeting_subscription)
-    logging.info("All Preferences")
-    logging.info(UserSubscriptionPreferences.query.all())
-
-    user_sub_preferences = UserSubscriptionPreferences.query.filter(
-        UserSubscriptionPreferences.subscription_id == meeting_spec.meeting_subscription_id
+    """
+    Returns the users subscribed to the time slot of the meeting spec, i.e. whose preference
+    falls on the same weekday, hour and minute in the subscription timezone.
+    :param meeting_spec: models.meeting_spec
+    :param exclude_user_prefs_with_auto_opt_in: leave out users who are opted in automatically
+    :return: list of models.user
+    """
+    user_ids = (
+        db.select(UserSubscriptionPreferences.user_id)
+        .join(SubscriptionDateTime, UserSubscriptionPreferences.preference_id == SubscriptionDateTime.id)
+        .filter(
+            UserSubscriptionPreferences.subscription_id == meeting_spec.meeting_subscription_id,
+            *same_local_slot(meeting_spec),
+        )
     )
-
     if exclude_user_prefs_with_auto_opt_in:
-        user_sub_preferences = user_sub_preferences.filter(UserSubscriptionPreferences.auto_opt_in.is_(False)).all()
-        logging.info("User Preferences with auto_opt_in == False")
-    else:
-        user_sub_preferences = user_sub_preferences.all()
-        logging.info("User Preferences")
+        user_ids = user_ids.filter(UserSubscriptionPreferences.auto_opt_in.is_(False))
 
-    logging.info(user_sub_preferences)
-    meeting_timezone = timezone(meeting_spec.meeting_subscription.timezone)
-    users = []
-    for user_preference in user_sub_preferences:
-        if user_preference.preference:
-            logging.info("User Preference")
-            logging.info(user_preference.preference)
-            logging.info(user_preference.preference.__dict__)
-            preference_dt = user_preference.preference.datetime.replace(tzinfo=utc).astimezone(meeting_timezone)
-            meeting_spec_dt = meeting_spec.datetime.replace(tzinfo=utc).astimezone(meeting_timezone)
+    users = User.query.filter(User.id.in_(user_ids)).all()
+    logging.info(f"Users for {meeting_spec}: {[user.get_username() for user in users]}")
+    return users
 
-            if (
-                preference_dt.hour == meeting_spec_dt.hour
-                and preference_dt.minute == meeting_spec_dt.minute
-                and preference_dt.weekday() == meeting_spec_dt.weekday()
-            ):
-                user = User.query.filter(User.id == user_preference.user_id).first()
-                if user is not None:
-                    logging.info("user added: ")
-                    logging.info(user)
-                    users.append(user)
 
-    return users
+def same_local_slot(meeting_spec):
+    """
+    Filter on SubscriptionDateTime for the preferences that fall on the spec's weekly slot.
+    Given the MeetingSpec class instead of a spec it compares the columns, for joins.
+    The slot of a spec is worked out from its datetime and subscription timezone rather than
+    read from its local slot columns, which are not filled in for specs saved before they
+    were backfilled. A spec without a datetime or timezone has no slot and matches nothing.
+    """
+    if not isinstance(meeting_spec, MeetingSpec):
+        return (
+            SubscriptionDateTime.local_weekday == meeting_spec.local_weekday,
+            SubscriptionDateTime.local_minute == meeting_spec.local_minute,
+            SubscriptionDateTime.local_timezone == meeting_spec.local_timezone,
+        )
+
+    subscription = meeting_spec.meeting_subscription
+    subscription_timezone = subscription.timezone if subscription is not None else None
+    if meeting_spec.datetime is None or subscription_timezone is None:
+        return (false(),)
+    local_weekday, local_minute = get_local_slot(meeting_spec.datetime, subscription_timezone)
+    return (
+        SubscriptionDateTime.local_weekday == local_weekday,
+        SubscriptionDateTime.local_minute == local_minute,
+        SubscriptionDateTime.local_timezone == subscription_timezone,
+    )
 
 
 def get_meeting_datetime(meeting_spec: MeetingSpec, subscription_timezone: str | None = None) -> datetime:
@@ -10,8 +10,10 @@ from sqlalchemy import func
 from yelp_beans.models import MeetingSpec
 from yelp_beans.models import MeetingSubscription
 from yelp_beans.models import Rule
+from yelp_beans.models import SubscriptionDateTime
 from yelp_beans.models import User
 from yelp_beans.models import UserSubscriptionPreferences
+from yelp_beans.models import set_local_slot
 
 
 def filter_subscriptions_by_user_data(subscriptions, user):
@@ -154,3 +156,16 @@ def get_subscriber_counts(subscription_id: int) -> dict[int, int]:
 
 def get_subscription(subscription_id: int) -> MeetingSubscription:
     return MeetingSubscription.query.filter(MeetingSubscription.id == subscription_id).one()
+
+
+def backfill_local_slots() -> int:
+    """
+    Fills in the local slot of every SubscriptionDateTime and MeetingSpec, for rows saved
+    before the columns existed. New and updated rows get theirs when they are flushed.
+    """
+    models = [*SubscriptionDateTime.query.all(), *MeetingSpec.query.all()]
+    for model in models:
+        subscription = model.meeting_subscription
+        set_local_slot(model, subscription.timezone if subscription is not None else None)
+    db.session.commit()
+    return len(models)
@@ -1,9 +1,20 @@
+import hashlib
+import itertools
+import json
 import logging
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from dataclasses import field
 from typing import NotRequired
 from typing import TypedDict
 
 from database import db
+from sqlalchemy import insert
+from sqlalchemy import select
+from sqlalchemy import update
 
+from yelp_beans.logic.config import get_config
 from yelp_beans.logic.subscription import apply_rules
 from yelp_beans.models import MeetingSubscription
 from yelp_beans.models import User
@@ -14,12 +25,27 @@ def get_user(email):
     return User.query.filter(User.email == email).first()
 
 
-def bulk_insert(data):
-    db.session.add_all(data)
-    db.session.commit()
+DEFAULT_SYNC_BATCH_SIZE = 1000
+
+
+@dataclass
+class SyncResult:
+    """Counts of employees by what sync_employees did with them, and seconds spent in each phase"""
+
+    unchanged: int = 0
+    updated: int = 0
+    added: int = 0
+    termed: int = 0
+    timings: dict[str, float] = field(default_factory=dict)
+
+    @contextmanager
+    def timed(self, phase):
+        start = time.perf_counter()
+        yield
+        self.timings[phase] = self.timings.get(phase, 0.0) + time.perf_counter() - start
 
 
-def sync_employees(employee_data):
+def sync_employees(employee_data, batch_size=None):
     """
     Employee data must include:
         - email
@@ -29,47 +55,115 @@ def sync_employees(employee_data):
     All other information will be included in the data store as
     metadata.
 
+    Employee data may be any iterable, e.g. DataIngestion().stream(), it is read
+    batch_size (employee_sync_batch_size in the config) employees at a time, so
+    only the emails of the whole directory are held in memory.
+
+    Only employees whose data changed since the last sync are written, found by
+    comparing the fingerprint of their data with the one stored on the user. New,
+    changed and termed employees are written with bulk statements, a batch at a time.
+
+    The whole sync is one transaction. Employees are validated as their batch is
+    read, and an invalid employee late in the data rolls back the batches written
+    before it, so a bad directory never leaves users partly synced or termed.
+
     Parameters
     ----------
     remote_data = json
+    batch_size = int
 
     Returns
     -------
-    success: integer, 0 successful, 1 failure
+    SyncResult
     """
-    validate_employee_data(employee_data)
-    remote_employee_data = hash_employee_data(employee_data)
-
-    # get data from local database
-    local_employee_data = {employee.email: employee for employee in User.query.all()}
-
-    local_employees = set(local_employee_data.keys())
-    remote_employees = set(remote_employee_data.keys())
-
-    new_employees = remote_employees - local_employees
-    if new_employees:
-        logging.info("Creating new employees.")
-        new_employees_list = [remote_employee_data[employee] for employee in new_employees]
-        create_new_employees_from_list(new_employees_list)
-        logging.info(f"{len(new_employees)} employees added")
-        logging.info(new_employees)
-
-    termed_employees = local_employees - remote_employees
-    if termed_employees:
-        logging.info("Marking termed employees")
-        termed_employees_db = [local_employee_data[employee] for employee in termed_employees]
-        mark_termed_employees(termed_employees_db)
-        logging.info(f"{len(termed_employees)} employees marked as termed")
-        logging.info(termed_employees)
-
-    current_employees = remote_employees.intersection(local_employees)
-    if current_employees:
-        logging.info("Updating current employees")
-        remote_employee_data = {employee: remote_employee_data[employee] for employee in current_employees}
-        local_employee_data = {employee: local_employee_data[employee] for employee in current_employees}
-        update_current_employees(local_employee_data, remote_employee_data)
-        logging.info(f"{len(current_employees)} employees updated")
-        logging.info(current_employees)
+    if batch_size is None:
+        batch_size = get_config().get("employee_sync_batch_size", DEFAULT_SYNC_BATCH_SIZE)
+    result = SyncResult()
+    remote_employees = set()
+
+    try:
+        for employees in _batches(employee_data, batch_size):
+            with result.timed("validate"):
+                validate_employee_data(employees)
+                remote_employee_data = hash_employee_data(employees)
+                remote_employees.update(remote_employee_data)
+
+            with result.timed("load"):
+                # only the columns needed to compare, loading User objects is slow
+                local_employee_data = {
+                    row.email: row
+                    for row in db.session.execute(
+                        select(User.id, User.email, User.fingerprint, User.terminated).where(User.email.in_(remote_employee_data))
+                    )
+                }
+
+            with result.timed("add"):
+                new_employees = [
+                    _employee_row(employee) for email, employee in remote_employee_data.items() if email not in local_employee_data
+                ]
+                if new_employees:
+                    db.session.execute(insert(User), new_employees)
+                result.added += len(new_employees)
+
+            with result.timed("update"):
+                changed_employees = []
+                for email, local_employee in local_employee_data.items():
+                    row = _employee_row(remote_employee_data[email])
+                    if local_employee.fingerprint == row["fingerprint"] and not local_employee.terminated:
+                        result.unchanged += 1
+                    else:
+                        changed_employees.append({"id": local_employee.id, **row})
+                if changed_employees:
+                    db.session.execute(update(User), changed_employees)
+                result.updated += len(changed_employees)
+
+        with result.timed("terminate"):
+            termed_employees = [
+                row.id
+                for row in db.session.execute(select(User.id, User.email).where(User.terminated.is_(False)))
+                if row.email not in remote_employees
+            ]
+            for batch in _batches(termed_employees, batch_size):
+                db.session.execute(
+                    update(User).where(User.id.in_(batch)).values(terminated=True).execution_options(synchronize_session=False)
+                )
+            result.termed = len(termed_employees)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    logging.info(
+        f"Synced employees: {result.unchanged} unchanged, {result.updated} updated, "
+        f"{result.added} added, {result.termed} termed"
+    )
+    logging.info(", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in result.timings.items()))
+    return result
+
+
+def _fingerprint(first_name, last_name, photo_url, metadata):
+    data = [first_name, last_name, photo_url, metadata]
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _employee_row(employee):
+    # employee is a dict or a data provider Employee, which builds its metadata dict when read
+    metadata = employee["metadata"]
+    return {
+        "email": employee["email"],
+        "first_name": employee["first_name"],
+        "last_name": employee["last_name"],
+        "photo_url": employee["photo_url"],
+        "meta_data": metadata,
+        "terminated": False,
+        "fingerprint": _fingerprint(employee["first_name"], employee["last_name"], employee["photo_url"], metadata),
+    }
+
+
+def _batches(rows, batch_size):
+    rows = iter(rows)
+    while batch := list(itertools.islice(rows, batch_size)):
+        yield batch
 
 
 def hash_employee_data(employee_data):
@@ -106,43 +200,6 @@ def validate_employee_data(employee_data):
         employee["photo_url"]
 
 
-def create_new_employees_from_list(new_employees):
-    user_list = []
-    for new_employee in new_employees:
-        user = User(
-            email=new_employee["email"],
-            first_name=new_employee["first_name"],
-            last_name=new_employee["last_name"],
-            photo_url=new_employee["photo_url"],
-            meta_data=new_employee["metadata"],
-            subscription_preferences=[],
-        )
-        user_list.append(user)
-    bulk_insert(user_list)
-
-
-def update_current_employees(local_data_employee, remote_data_employee):
-    users = set(local_data_employee.keys())
-    for user in users:
-        local_employee = local_data_employee[user]
-        remote_employee = remote_data_employee[user]
-
-        local_employee.first_name = remote_employee["first_name"]
-        local_employee.last_name = remote_employee["last_name"]
-        local_employee.photo_url = remote_employee["photo_url"]
-        local_employee.meta_data = remote_employee["metadata"]
-        local_employee.terminated = False
-
-    db.session.commit()
-
-
-def mark_termed_employees(termed_employees):
-    for employee in termed_employees:
-        employee.terminated = True
-
-    db.session.commit()
-
-
 def user_preference(user, meeting_spec):
     preference_for_spec = [
         user_sub_pref
@@ -0,0 +1,98 @@
+"""Registry of the engines used to match people for a MeetingSubscription.
+
+Every engine takes (users, spec, prev_meeting_tuples, group_size) and returns
+(matches, unmatched, weight). Subscriptions pick one by name through
+MeetingSubscription.matching_engine.
+"""
+import logging
+import time
+from dataclasses import dataclass
+from functools import partial
+
+from yelp_beans.matching.group_match import match_groups
+from yelp_beans.matching.pair_match import generate_pair_meetings
+from yelp_beans.matching.pair_match import greedy_matching
+
+DEFAULT_ENGINE = "exact"
+DEFAULT_TIME_BUDGET = 10.0
+
+# starting and negative weight used to score groups
+GROUP_STARTING_WEIGHT = 10
+GROUP_NEGATIVE_WEIGHT = 5
+
+MATCHING_ENGINES = {}
+
+
+@dataclass
+class MatchingResult:
+    engine: str
+    matches: list
+    unmatched: list
+    size: int
+    weight: float
+    elapsed: float
+
+
+def register_engine(name):
+    def decorator(engine):
+        MATCHING_ENGINES[name] = engine
+        return engine
+
+    return decorator
+
+
+def get_engine_name(spec):
+    return spec.meeting_subscription.matching_engine or DEFAULT_ENGINE
+
+
+def run_engine(name, users, spec, prev_meeting_tuples=None, group_size=2):
+    if name not in MATCHING_ENGINES:
+        raise ValueError(f"Unknown matching engine {name}, expected one of {', '.join(sorted(MATCHING_ENGINES))}.")
+
+    start = time.perf_counter()
+    matches, unmatched, weight = MATCHING_ENGINES[name](users, spec, prev_meeting_tuples, group_size)
+    result = MatchingResult(
+        engine=name,
+        matches=matches,
+        unmatched=unmatched,
+        size=len(matches),
+        weight=weight,
+        elapsed=time.perf_counter() - start,
+    )
+    logging.info(f"Matching engine {name}: {result.size} meetings, weight {result.weight}, {result.elapsed:.3f}s")
+    return result
+
+
+def _match(users, spec, prev_meeting_tuples, group_size, matcher=None, group_method="annealing"):
+    if group_size > 2:
+        return match_groups(users, spec, group_size, GROUP_STARTING_WEIGHT, GROUP_NEGATIVE_WEIGHT, group_method)
+
+    matches, unmatched = generate_pair_meetings(users, spec, prev_meeting_tuples, matcher)
+    # every allowed pair has a weight of 1.0
+    return matches, unmatched, float(len(matches))
+
+
+@register_engine("exact")
+def exact_engine(users, spec, prev_meeting_tuples, group_size):
+    """Maximum matching with the blossom algorithm, best for small and medium subscriptions"""
+    return _match(users, spec, prev_meeting_tuples, group_size)
+
+
+@register_engine("greedy")
+def greedy_engine(users, spec, prev_meeting_tuples, group_size):
+    """Greedy maximal matching improved with short augmenting paths, for very large subscriptions"""
+    return _match(users, spec, prev_meeting_tuples, group_size, greedy_matching)
+
+
+@register_engine("budgeted")
+def budgeted_engine(users, spec, prev_meeting_tuples, group_size):
+    """Greedy matching that keeps searching for augmenting paths until the time budget runs out"""
+    time_budget = spec.meeting_subscription.matching_time_budget or DEFAULT_TIME_BUDGET
+    matcher = partial(greedy_matching, max_path_length=None, time_budget=time_budget)
+    return _match(users, spec, prev_meeting_tuples, group_size, matcher)
+
+
+@register_engine("local_search")
+def local_search_engine(users, spec, prev_meeting_tuples, group_size):
+    """Kernighan-Lin style swaps between groups instead of annealing, exact matching for pairs"""
+    return _match(users, spec, prev_meeting_tuples, group_size, group_method="local_search")
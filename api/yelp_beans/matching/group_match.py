@@ -1,9 +1,16 @@
-import itertools
 import logging
+import math
 import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
-from yelp_beans.matching.match_utils import get_counts_for_pairs
-from yelp_beans.matching.match_utils import get_previous_meetings
+import numpy as np
+
+from yelp_beans.logic.config import get_config
+from yelp_beans.matching.match_utils import get_pair_history
+
+DEFAULT_ANNEALING_ITERATIONS = 100000
 
 
 def get_previous_meetings_counts(users, subscription_key):
@@ -11,15 +18,12 @@ def get_previous_meetings_counts(users, subscription_key):
     Given users for a subscription, return the number of times two people have matched
     :param users: id of user
     :param subscription_key: Key referencing the subscription model entity
-    :return: Tuple of user id's matched to count ie. {(4L, 5L): 5}
+    :return: Tuple of user id's matched to count ie. {(4L, 5L): 5}, pairs that never met are left out
     """
-    previous_meetings = get_previous_meetings(subscription_key)
-    counts_for_pairs = get_counts_for_pairs(previous_meetings)
-    user_ids = sorted([user.id for user in users])
-    all_pairs_counts = {pair: 0 for pair in itertools.combinations(user_ids, 2)}
-    for pair in counts_for_pairs:
-        all_pairs_counts[pair] = counts_for_pairs[pair]
-    return all_pairs_counts
+    user_ids = {user.id for user in users}
+    return {
+        pair: count for pair, count in get_pair_history(subscription_key).items() if pair[0] in user_ids and pair[1] in user_ids
+    }
 
 
 def get_user_weights(users, previous_meetings_counts, starting_weight, negative_weight):
@@ -30,18 +34,21 @@ def get_user_weights(users, previous_meetings_counts, starting_weight, negative_
     :param previous_meetings_counts: tuple of user id's matched to count
     :param starting_weight: initial weight between users
     :param negative_weight: amount to subtract from initial weight based on previous meetings
-    :return: adjacency matrix from user to user
+    :return: adjacency matrix from user to user as a numpy array, indexed by position in users
     """
-    user_user_weights = []
-    for idx1, user1 in enumerate(users):
-        user_user_weights.append([])
-        for idx2, user2 in enumerate(users):
-            pair_tuple = tuple(sorted((user1.id, user2.id)))
-            if pair_tuple not in previous_meetings_counts:
-                user_user_weights[idx1].append(0)
-                continue
-            weight = starting_weight - (negative_weight * previous_meetings_counts[pair_tuple])
-            user_user_weights[idx1].append(weight)
+    user_id_to_index = {user.id: index for index, user in enumerate(users)}
+    user_user_weights = np.full((len(users), len(users)), starting_weight, dtype=float)
+    np.fill_diagonal(user_user_weights, 0)
+
+    pairs = [
+        (user_id_to_index[pair[0]], user_id_to_index[pair[1]], count)
+        for pair, count in previous_meetings_counts.items()
+        if pair[0] in user_id_to_index and pair[1] in user_id_to_index
+    ]
+    if pairs:
+        rows, columns, counts = np.array(pairs).T
+        user_user_weights[rows, columns] -= negative_weight * counts
+        user_user_weights[columns, rows] = user_user_weights[rows, columns]
     return user_user_weights
 
 
@@ -58,28 +65,55 @@ def generate_groups(group, partition_size):
 
 
 def generate_group_meetings(users, spec, group_size, starting_weight, negative_weight):
+    matches, unmatched, _ = match_groups(users, spec, group_size, starting_weight, negative_weight)
+    return matches, unmatched
+
+
+def match_groups(users, spec, group_size, starting_weight, negative_weight, method="annealing"):
+    """
+    Same as generate_group_meetings, but also returns the total weight of the groups
+    that were formed, as scored by the annealing cost. method is either annealing or
+    local_search, see local_search_groups.
+    """
     population_size = len(users)
 
     # For group meetings we must have more than 2 users
     if population_size == 0:
-        return [], []
+        return [], [], 0
 
     if population_size in (1, 2):
-        return [], users
+        return [], users, 0
 
     previous_meetings_counts = get_previous_meetings_counts(users, spec.meeting_subscription)
     adj_matrix = get_user_weights(users, previous_meetings_counts, starting_weight, negative_weight)
-    annealing = Annealing(population_size, group_size, adj_matrix)
-    grouped_ids = generate_groups(annealing.simulated_annealing(), group_size)
+    if method == "local_search":
+        _, ids = local_search_groups(population_size, group_size, adj_matrix, seed=spec.id)
+    else:
+        subscription = spec.meeting_subscription
+        ids = run_annealing_chains(
+            population_size,
+            group_size,
+            adj_matrix,
+            chains=subscription.annealing_chains or 1,
+            processes=get_config().get("matching_processes", 1),
+            # a new spec every week, so groups change from week to week but a rerun is reproducible
+            seed=spec.id,
+            max_iterations=subscription.annealing_iterations or DEFAULT_ANNEALING_ITERATIONS,
+            time_budget=subscription.matching_time_budget,
+            schedule=get_config().get("annealing_schedule", "exponential"),
+        )
+    grouped_ids = generate_groups(ids, group_size)
 
     matches = []
     unmatched = []
+    weight = 0
     for group in grouped_ids:
         grouped_users = [users[index] for index in group]
         if len(grouped_users) < group_size:
             unmatched.extend(grouped_users)
         else:
             matches.append(grouped_users)
+            weight += float(adj_matrix[np.ix_(group, group)].sum()) / 2
     logging.info("{} employees matched".format(len(matches) * group_size))
     for group in matches:
         username_tuple = tuple([user.get_username() for user in group[:-1]])
@@ -88,45 +122,236 @@ def generate_group_meetings(users, spec, group_size, starting_weight, negative_w
     logging.info(f"{len(unmatched)} employees unmatched")
     logging.info([user.get_username() for user in unmatched])
 
-    return matches, unmatched
+    return matches, unmatched, weight
+
+
+def run_annealing_chains(population_size, group_size, adj_matrix, chains=1, processes=1, seed=None, **kwargs):
+    """
+    Runs independent annealing chains from different random starts and returns the ids
+    of the best one. Every chain gets its own seed derived from seed, so the same seed
+    always gives the same groups. With processes > 1 the chains run in a process pool.
+    kwargs are passed on to Annealing.
+    """
+    chain_seeds = [int(sequence.generate_state(1)[0]) for sequence in np.random.SeedSequence(seed).spawn(chains)]
+    run_chain = partial(_run_annealing_chain, population_size, group_size, adj_matrix, **kwargs)
+
+    if processes > 1 and chains > 1:
+        with ProcessPoolExecutor(max_workers=min(processes, chains)) as executor:
+            results = list(executor.map(run_chain, chain_seeds))
+    else:
+        results = [run_chain(chain_seed) for chain_seed in chain_seeds]
+
+    # max keeps the first chain on ties, so the result does not depend on scheduling
+    best_cost, best_ids = max(results, key=lambda result: result[0])
+    logging.info(f"Best of {chains} annealing chains: {best_cost}")
+    return best_ids
+
+
+def _run_annealing_chain(population_size, group_size, adj_matrix, seed, **kwargs):
+    annealing = Annealing(population_size, group_size, adj_matrix, seed=seed, **kwargs)
+    ids = annealing.simulated_annealing()
+    logging.info(f"Annealing chain stopped after {annealing.iterations} iterations with cost {annealing.best_cost}")
+    return annealing.best_cost, ids
+
+
+def local_search_groups(population_size, group_size, adj_matrix, seed=None, max_passes=100):
+    """
+    Kernighan-Lin style local search over swaps between groups, an alternative to annealing
+    that reaches a local optimum far faster on large populations.
+
+    A gain table holds the total weight from every user to every group. Each pass visits
+    the users in turn and makes the steepest improving swap with someone in another group,
+    updating the two affected columns of the table. Passes repeat until no swap improves
+    the cost. The population_size % group_size users left over form a bucket whose weights
+    do not count, so the search also picks who is left unmatched.
+    :return: tuple of the cost and the ids ordered like Annealing.simulated_annealing
+    """
+    rng = np.random.default_rng(seed)
+    num_groups = population_size // group_size
+    users = np.arange(population_size)
+
+    order = rng.permutation(population_size)
+    group_of = np.empty(population_size, dtype=int)
+    group_of[order] = np.minimum(users // group_size, num_groups)
+    # the leftover bucket is the last group and never counts
+    counted = np.ones(num_groups + 1)
+    counted[num_groups] = 0
+    counted_of = counted[group_of]
+
+    # affinity[user, group] is the total weight from user to the members of group, it is
+    # kept in both layouts so rows and columns can be read contiguously
+    affinity = np.add.reduceat(adj_matrix[:, order], np.arange(0, population_size, group_size), axis=1)
+    if affinity.shape[1] == num_groups:
+        affinity = np.hstack((affinity, np.zeros((population_size, 1))))
+    affinity[:, num_groups] = 0
+    affinity_by_group = np.ascontiguousarray(affinity.T)
+    own_affinity = affinity[users, group_of]
+
+    for _ in range(max_passes):
+        improved = False
+        for user in rng.permutation(population_size):
+            group = group_of[user]
+            weights = adj_matrix[user]
+            # gain of swapping user with every other user, split by the group each side leaves
+            gains = counted[group] * (affinity_by_group[group] - own_affinity[user] - weights)
+            gains += counted_of * (affinity[user][group_of] - own_affinity - weights)
+            gains[group_of == group] = -np.inf
+
+            other = int(np.argmax(gains))
+            if gains[other] <= 1e-9:
+                continue
+
+            other_group = group_of[other]
+            change = adj_matrix[other] - weights
+            if counted[group]:
+                affinity[:, group] += change
+                affinity_by_group[group] += change
+            if counted[other_group]:
+                affinity[:, other_group] -= change
+                affinity_by_group[other_group] -= change
+            group_of[user], group_of[other] = other_group, group
+            counted_of[user], counted_of[other] = counted[other_group], counted[group]
+            changed = (group_of == group) | (group_of == other_group)
+            own_affinity[changed] = affinity[users[changed], group_of[changed]]
+            improved = True
+
+        if not improved:
+            break
+
+    cost = float((own_affinity * counted_of).sum()) / 2
+    return cost, np.argsort(group_of, kind="stable").tolist()
 
 
 class Annealing:
-    def __init__(self, population_size, group_size, adj_matrix, max_iterations=100):
+    """
+    Simulated annealing over orderings of the population, where every group_size
+    consecutive ids form a group and the cost to maximize is the sum of the weights
+    inside the groups.
+
+    Swaps are accepted with the Metropolis criterion. The starting temperature is set
+    so that an average worsening swap is accepted half the time and is then lowered by
+    the cooling schedule:
+    - exponential: decays to FINAL_TEMP_RATIO of the start over the run
+    - adaptive: every CHECK_INTERVAL iterations the temperature is nudged so the share
+      of worsening swaps accepted follows a target that decays exponentially from 50%
+    The run stops early once the best cost has not improved for patience iterations.
+    Every CHECK_INTERVAL iterations (iteration, cost, best cost, temperature) is appended
+    to trace.
+    """
+
+    SCHEDULES = ("exponential", "adaptive")
+    CHECK_INTERVAL = 1000
+    FINAL_TEMP_RATIO = 1e-3
+    INITIAL_ACCEPTANCE = 0.5
+    ADAPTIVE_STEP = 0.8
+
+    def __init__(
+        self,
+        population_size,
+        group_size,
+        adj_matrix,
+        max_iterations=DEFAULT_ANNEALING_ITERATIONS,
+        time_budget=None,
+        seed=None,
+        schedule="exponential",
+        patience=None,
+    ):
+        if schedule not in self.SCHEDULES:
+            raise ValueError(f"Unknown annealing schedule {schedule}, expected one of {', '.join(self.SCHEDULES)}.")
         self.population_size = population_size
         self.group_size = group_size
         self.adj_matrix = adj_matrix
         self.max_iterations = max_iterations
+        self.time_budget = time_budget
+        self.random = random.Random(seed)
+        self.schedule = schedule
+        self.patience = max_iterations // 5 if patience is None else patience
+        self.best_cost = None
+        self.iterations = 0
+        self.trace = []
 
     def get_initial_state(self):
         ids = [i for i in range(self.population_size)]
-        random.shuffle(ids)
+        self.random.shuffle(ids)
         return State(self.population_size, self.group_size, ids)
 
-    def get_temp(self, iteration):
-        return 1.0 - (self.max_iterations - iteration) / (self.max_iterations + iteration)
+    def get_initial_temp(self, state, weights, samples=100):
+        """Temperature at which the average worsening swap is accepted half the time"""
+        worsening = []
+        for _ in range(samples):
+            delta_x, delta_y = state.get_swap_delta(*state.get_random_swap(self.random), weights)
+            if delta_x + delta_y < 0:
+                worsening.append(-(delta_x + delta_y))
+        if not worsening:
+            return 1.0
+        return sum(worsening) / len(worsening) / -math.log(self.INITIAL_ACCEPTANCE)
 
-    def simulated_annealing(self):
-        prev_state = self.get_initial_state()
-        best_state = prev_state.copy()
-
-        best_cost = prev_cost = prev_state.get_cost(self.adj_matrix)
+    def get_temp(self, initial_temp, progress):
+        return initial_temp * self.FINAL_TEMP_RATIO**progress
 
+    def simulated_annealing(self):
+        start = time.monotonic()
+        state = self.get_initial_state()
+        state.track_group_costs(self.adj_matrix)
+        # indexing nested lists one cell at a time is much faster than indexing numpy
+        weights = self.adj_matrix.tolist()
+
+        best_cost = prev_cost = sum(state.group_costs)
+        best_ids = state.ids[:]
+        best_iteration = 0
+
+        initial_temp = temp = self.get_initial_temp(state, weights)
+        # the adaptive schedule only moves the temperature at check points
+        cooling = 1.0 if self.schedule == "adaptive" else self.FINAL_TEMP_RATIO ** (1 / max(self.max_iterations, 1))
+        worsening = accepted_worsening = 0
+        self.trace = []
+
+        iteration = 0
         for iteration in range(self.max_iterations):
-            temp = self.get_temp(iteration)
-
-            curr_state = prev_state.get_mutated_state()
-            curr_cost = curr_state.get_cost(self.adj_matrix)
-
-            if curr_cost > best_cost:
-                best_cost = curr_cost
-                best_state = curr_state
-
-            if curr_cost > prev_cost or 1.0 * curr_cost / (prev_cost + 1) * temp < random.random():
-                prev_cost = curr_cost
-                prev_state = curr_state
-
-        return best_state.ids
+            if iteration % self.CHECK_INTERVAL == 0 and iteration:
+                self.trace.append((iteration, prev_cost, best_cost, temp))
+                if iteration - best_iteration > self.patience:
+                    break
+                progress = iteration / self.max_iterations
+                if self.time_budget is not None:
+                    progress = max(progress, (time.monotonic() - start) / self.time_budget)
+                    if progress >= 1:
+                        break
+
+                if self.schedule == "adaptive":
+                    target = self.INITIAL_ACCEPTANCE * self.FINAL_TEMP_RATIO**progress
+                    if worsening and accepted_worsening / worsening > target:
+                        temp *= self.ADAPTIVE_STEP
+                    else:
+                        temp /= self.ADAPTIVE_STEP
+                    worsening = accepted_worsening = 0
+                else:
+                    # catches up with the schedule when the time budget runs out before the iterations
+                    temp = min(temp, self.get_temp(initial_temp, progress))
+
+            x, y = state.get_random_swap(self.random)
+            delta_x, delta_y = state.get_swap_delta(x, y, weights)
+            delta = delta_x + delta_y
+
+            if delta < 0:
+                worsening += 1
+                if self.random.random() >= math.exp(delta / temp):
+                    temp *= cooling
+                    continue
+                accepted_worsening += 1
+
+            state.swap(x, y, delta_x, delta_y)
+            prev_cost += delta
+            if prev_cost > best_cost:
+                best_cost = prev_cost
+                best_ids = state.ids[:]
+                best_iteration = iteration
+            temp *= cooling
+
+        self.iterations = iteration + 1
+        self.trace.append((self.iterations, prev_cost, best_cost, temp))
+        self.best_cost = best_cost
+        return best_ids
 
 
 class State:
@@ -134,22 +359,69 @@ class State:
         self.population_size = population_size
         self.group_size = group_size
         self.ids = ids
+        self.group_costs = None
 
     def copy(self):
-        return State(self.population_size, self.group_size, self.ids[:])
+        state = State(self.population_size, self.group_size, self.ids[:])
+        if self.group_costs is not None:
+            state.group_costs = self.group_costs[:]
+        return state
 
     def get_cost(self, adj_matrix):
-        cost = 0
-        for i in range(0, len(self.ids), self.group_size):
-            cost += sum([adj_matrix[edge[0]][edge[1]] for edge in itertools.combinations(self.ids[i : i + self.group_size], 2)])
-        return cost
-
-    def get_mutated_state(self):
-        x = random.randint(0, len(self.ids) - 1)
-        y = random.randint(0, len(self.ids) - 2)
+        ids = np.asarray(self.ids)
+        full_groups = len(ids) // self.group_size * self.group_size
+        groups = ids[:full_groups].reshape(-1, self.group_size)
+        # the matrix is symmetric with a zero diagonal, so every pair is counted twice
+        cost = adj_matrix[groups[:, :, None], groups[:, None, :]].sum()
+        remainder = ids[full_groups:]
+        cost += adj_matrix[np.ix_(remainder, remainder)].sum()
+        return float(cost) / 2
+
+    def track_group_costs(self, adj_matrix):
+        """Scores every group once, swap keeps the scores up to date from then on"""
+        self.group_costs = [
+            float(adj_matrix[np.ix_(group, group)].sum()) / 2 for group in generate_groups(self.ids, self.group_size)
+        ]
+
+    def get_random_swap(self, rng=random):
+        # randint is several times slower and this runs once per iteration
+        x = int(rng.random() * len(self.ids))
+        y = int(rng.random() * (len(self.ids) - 1))
         if y >= x:
             y += 1
-
-        ids = self.ids[:]
-        ids[x], ids[y] = ids[y], ids[x]
-        return State(self.population_size, self.group_size, ids)
+        return x, y
+
+    def get_swap_delta(self, x, y, weights):
+        """
+        Change in the cost of the groups holding positions x and y if they were swapped.
+        Only the two groups involved are looked at, so this is O(group size).
+        :return: tuple of the change for the group of x and the group of y
+        """
+        group_x = x // self.group_size
+        group_y = y // self.group_size
+        if group_x == group_y:
+            return 0, 0
+
+        user_x = self.ids[x]
+        user_y = self.ids[y]
+        weights_x = weights[user_x]
+        weights_y = weights[user_y]
+
+        delta_x = 0
+        for user in self.ids[group_x * self.group_size : (group_x + 1) * self.group_size]:
+            if user != user_x:
+                delta_x += weights_y[user] - weights_x[user]
+
+        delta_y = 0
+        for user in self.ids[group_y * self.group_size : (group_y + 1) * self.group_size]:
+            if user != user_y:
+                delta_y += weights_x[user] - weights_y[user]
+
+        return delta_x, delta_y
+
+    def swap(self, x, y, delta_x=0, delta_y=0):
+        """Swaps positions x and y in place, applying the deltas from get_swap_delta to the group costs"""
+        self.ids[x], self.ids[y] = self.ids[y], self.ids[x]
+        if self.group_costs is not None:
+            self.group_costs[x // self.group_size] += delta_x
+            self.group_costs[y // self.group_size] += delta_y
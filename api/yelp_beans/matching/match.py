@@ -1,11 +1,89 @@
-from yelp_beans.matching.group_match import generate_group_meetings
-from yelp_beans.matching.pair_match import generate_pair_meetings
+import logging
+from concurrent.futures import ProcessPoolExecutor
 
+from database import db
+from flask import Flask
 
-def generate_meetings(users, spec, prev_meeting_tuples=None, group_size=2):
-    if group_size == 2:
-        return generate_pair_meetings(users, spec, prev_meeting_tuples)
-    elif group_size > 2:
-        return generate_group_meetings(users, spec, group_size, 10, 5)
-    else:
+from yelp_beans.logic.meeting_request import query_users_for_matching
+from yelp_beans.logic.meeting_spec import get_meeting_datetime
+from yelp_beans.matching.engines import get_engine_name
+from yelp_beans.matching.engines import run_engine
+from yelp_beans.models import MeetingSpec
+from yelp_beans.models import User
+
+
+def generate_meetings(users, spec, prev_meeting_tuples=None, group_size=2, engine=None):
+    if group_size < 2:
         raise ValueError("Group size must be greater than 1.")
+
+    if engine is None:
+        engine = get_engine_name(spec)
+    result = run_engine(engine, users, spec, prev_meeting_tuples, group_size)
+    return result.matches, result.unmatched
+
+
+def match_spec(spec):
+    """
+    Matches everyone who requested a meeting for the spec, nothing is saved.
+    :return: (matches, unmatched) as returned by generate_meetings
+    """
+    logging.info("Spec Datetime: ")
+    logging.info(get_meeting_datetime(spec).strftime("%Y-%m-%d %H:%M"))
+
+    users = query_users_for_matching(spec)
+    logging.info("Users: ")
+    logging.info([user.get_username() for user in users])
+
+    return generate_meetings(users, spec, prev_meeting_tuples=None, group_size=spec.meeting_subscription.size)
+
+
+def match_specs(specs, processes=1):
+    """
+    Runs match_spec for every spec. Specs are independent, so with processes > 1 they are
+    matched concurrently in a process pool, each worker with its own database session,
+    and the weekly run takes as long as the largest spec instead of the sum of them.
+    :return: list of (matches, unmatched), in the order of specs, with users loaded in
+        this session so they can be saved and emailed
+    """
+    database_url = db.engine.url
+    # every connection to an in memory sqlite database gets a new, empty database
+    in_memory = database_url.get_backend_name() == "sqlite" and database_url.database in (None, "", ":memory:")
+    if processes <= 1 or len(specs) < 2 or in_memory:
+        return [match_spec(spec) for spec in specs]
+
+    with ProcessPoolExecutor(
+        max_workers=min(processes, len(specs)),
+        initializer=_init_match_spec_worker,
+        initargs=(database_url.render_as_string(hide_password=False),),
+    ) as executor:
+        results = list(executor.map(_match_spec_worker, [spec.id for spec in specs]))
+
+    user_ids = {user_id for matches, unmatched in results for group in [*matches, unmatched] for user_id in group}
+    id_to_user = {user.id: user for user in User.query.filter(User.id.in_(user_ids)).all()}
+    return [
+        ([tuple(id_to_user[user_id] for user_id in match) for match in matches], [id_to_user[user_id] for user_id in unmatched])
+        for matches, unmatched in results
+    ]
+
+
+def _init_match_spec_worker(database_url):
+    # a fresh app gets its own engine, connections inherited from the parent are never used
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+    db.init_app(app)
+    app.app_context().push()
+
+
+def _match_spec_worker(spec_id):
+    try:
+        spec = MeetingSpec.query.filter(MeetingSpec.id == spec_id).one()
+        matches, unmatched = match_spec(spec)
+        # only ids cross the process boundary, the meeting time element is dropped as
+        # saving and emailing only look at the users in a match
+        return (
+            [[user.id for user in match if isinstance(user, User)] for match in matches],
+            [user.id for user in unmatched],
+        )
+    finally:
+        db.session.remove()
@@ -1,88 +1,169 @@
+import itertools
 import logging
-from collections import defaultdict
 from datetime import datetime
 from datetime import timedelta
 
 from database import db
+from sqlalchemy import delete
+from sqlalchemy import func
+from sqlalchemy import insert
+from sqlalchemy import update
+from sqlalchemy.orm import aliased
 
 from yelp_beans.logic.config import get_config
 from yelp_beans.models import Meeting
 from yelp_beans.models import MeetingParticipant
 from yelp_beans.models import MeetingSpec
+from yelp_beans.models import PairHistory
 from yelp_beans.models import User
 
 
 def save_meetings(matches, spec):
-    for match in matches:
-        # Last element in match may be the key for meeting time
-        matched_users = [user for user in match if isinstance(user, User)]
-        meeting_key = Meeting(meeting_spec=spec)
-        db.session.add(meeting_key)
-        for user in matched_users:
-            mp = MeetingParticipant(meeting=meeting_key, user=user)
-            db.session.add(mp)
+    """
+    Saves every meeting and its participants in a single transaction, so either the
+    whole week is saved or none of it is. Meetings and participants are each written
+    with one bulk insert, and the pair history is updated in the same transaction.
+    :return: list of the new meeting ids, in the order of matches
+    """
+    # Last element in match may be the key for meeting time
+    matched_users = [[user for user in match if isinstance(user, User)] for match in matches]
+    if not matched_users:
+        return []
+
+    try:
+        meeting_ids = db.session.scalars(
+            insert(Meeting).returning(Meeting.id, sort_by_parameter_order=True),
+            [{"meeting_spec_id": spec.id} for _ in matched_users],
+        ).all()
+        db.session.execute(
+            insert(MeetingParticipant),
+            [
+                {"meeting_id": meeting_id, "user_id": user.id}
+                for meeting_id, users in zip(meeting_ids, matched_users)
+                for user in users
+            ],
+        )
+        update_pair_history(spec, [[user.id for user in users] for users in matched_users])
+        # read before the commit expires the users
+        usernames = [", ".join(user.get_username() for user in users) for users in matched_users]
         db.session.commit()
-        username_list = [user.get_username() for user in matched_users]
-        logging.info(meeting_key)
-        logging.info(", ".join(username_list))
-
-
-def get_counts_for_pairs(pairs):
-    counts = {}
-    for pair in pairs:
-        if pair in counts:
-            counts[pair] += 1
+    except Exception:
+        db.session.rollback()
+        raise
+
+    for meeting_id, names in zip(meeting_ids, usernames):
+        logging.info(f"Meeting {meeting_id}: {names}")
+    return meeting_ids
+
+
+def update_pair_history(spec, meetings):
+    """
+    Adds the pairs met in this spec to PairHistory, without committing.
+    :param spec: MeetingSpec the meetings were matched for
+    :param meetings: list of lists of user ids, one per meeting
+    """
+    met_pairs = {pair for user_ids in meetings for pair in itertools.combinations(sorted(set(user_ids)), 2)}
+    if not met_pairs:
+        return
+
+    user_ids = {user_id for pair in met_pairs for user_id in pair}
+    subscription_id = spec.meeting_subscription_id
+    # pairs already saved for this datetime, when a spec's meetings are saved in more than one go
+    existing = {
+        (history.user_a_id, history.user_b_id): history.count
+        for history in db.session.execute(
+            db.select(PairHistory.user_a_id, PairHistory.user_b_id, PairHistory.count).filter(
+                PairHistory.subscription_id == subscription_id,
+                PairHistory.met == spec.datetime,
+                PairHistory.user_a_id.in_(user_ids),
+                PairHistory.user_b_id.in_(user_ids),
+            )
+        )
+    }
+
+    updated = []
+    added = []
+    for user_a_id, user_b_id in met_pairs:
+        row = {"subscription_id": subscription_id, "user_a_id": user_a_id, "user_b_id": user_b_id, "met": spec.datetime}
+        count = existing.get((user_a_id, user_b_id))
+        if count is None:
+            added.append({**row, "count": 1})
         else:
-            counts[pair] = 1
-    return counts
+            updated.append({**row, "count": count + 1})
 
+    if updated:
+        db.session.execute(update(PairHistory), updated)
+    if added:
+        db.session.execute(insert(PairHistory), added)
 
-def get_previous_meetings(subscription, cooldown=None):
+
+def get_pair_history(subscription, cooldown=None):
+    """
+    Counts the meetings of every pair that met in the subscription during the cooldown window,
+    with a single range scan over PairHistory. Meetings before the window are not counted.
+    :return: dict of (smaller user id, larger user id) to the number of times the pair met
+    """
     if cooldown is None:
         cooldown = get_config()["meeting_cooldown_weeks"]
 
-    meetings = defaultdict(list)
-
-    # get all meeting specs from x weeks ago til now
+    # get all meetings from x weeks ago til now
     time_threshold_for_meetings = datetime.now() - timedelta(weeks=cooldown)
-
-    meeting_specs = [
-        spec
-        for spec in MeetingSpec.query.filter(
-            MeetingSpec.datetime > time_threshold_for_meetings, MeetingSpec.meeting_subscription_id == subscription.id
-        ).all()
-    ]
-
-    logging.info("Previous Meeting History: ")
-    logging.info([meeting.datetime.strftime("%Y-%m-%d %H:%M") for meeting in meeting_specs])
-
-    if meeting_specs == []:
-        return set([])
-
-    # get all meetings from meeting specs
-    meeting_keys = [
-        meeting.id for meeting in Meeting.query.filter(Meeting.meeting_spec_id.in_([meet.id for meet in meeting_specs])).all()
-    ]
-
-    if meeting_keys == []:
-        return set([])
-
-    # get all participants from meetings
-    participants = MeetingParticipant.query.filter(MeetingParticipant.meeting_id.in_(meeting_keys)).all()
-
-    if participants == []:
-        return set([])
-
-    # group by meeting Id
-    for participant in participants:
-        meetings[participant.meeting.id].append(participant.user)
-
-    # ids are sorted, all matches should be in increasing order by id for the matching algorithm to work
-    disallowed_meetings = set([tuple(sorted(meeting, key=lambda Key: Key.id)) for meeting in meetings.values()])
-
-    logging.info("Past Meetings")
-    logging.info([tuple([meeting.get_username() for meeting in meeting]) for meeting in disallowed_meetings])
-
-    disallowed_meetings = {tuple([meeting.id for meeting in meeting]) for meeting in disallowed_meetings}
-
-    return disallowed_meetings
+    history_query = (
+        db.select(PairHistory.user_a_id, PairHistory.user_b_id, func.sum(PairHistory.count))
+        .filter(
+            PairHistory.subscription_id == subscription.id,
+            PairHistory.met > time_threshold_for_meetings,
+        )
+        .group_by(PairHistory.user_a_id, PairHistory.user_b_id)
+    )
+    pair_history = {(user_a_id, user_b_id): count for user_a_id, user_b_id, count in db.session.execute(history_query)}
+
+    logging.info(f"Previous Meeting History: {len(pair_history)} pairs in the last {cooldown} weeks")
+
+    return pair_history
+
+
+def rebuild_pair_history():
+    """
+    Rebuilds PairHistory from every saved meeting, replacing whatever is in the table.
+    Used to backfill the table, see the backfill-pair-history command.
+    :return: number of rows written
+    """
+    participant_a = aliased(MeetingParticipant)
+    participant_b = aliased(MeetingParticipant)
+    pairs_query = (
+        db.select(
+            MeetingSpec.meeting_subscription_id,
+            participant_a.user_id,
+            participant_b.user_id,
+            MeetingSpec.datetime,
+            func.count(func.distinct(Meeting.id)),
+        )
+        .join(Meeting, Meeting.meeting_spec_id == MeetingSpec.id)
+        .join(participant_a, participant_a.meeting_id == Meeting.id)
+        .join(
+            participant_b,
+            (participant_b.meeting_id == Meeting.id) & (participant_a.user_id < participant_b.user_id),
+        )
+        .filter(MeetingSpec.meeting_subscription_id.is_not(None))
+        .group_by(
+            MeetingSpec.meeting_subscription_id,
+            participant_a.user_id,
+            participant_b.user_id,
+            MeetingSpec.datetime,
+        )
+    )
+    try:
+        db.session.execute(delete(PairHistory))
+        result = db.session.execute(
+            insert(PairHistory).from_select(
+                ["subscription_id", "user_a_id", "user_b_id", "met", "count"],
+                pairs_query,
+            )
+        )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    logging.info(f"Rebuilt pair history with {result.rowcount} rows")
+    return result.rowcount
@@ -1,49 +1,82 @@
 import itertools
 import logging
+import operator
+import time
+from collections import defaultdict
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 import networkx as nx
 
+from yelp_beans.logic.config import get_config
 from yelp_beans.logic.user import user_preference
-from yelp_beans.matching.match_utils import get_previous_meetings
+from yelp_beans.matching.match_utils import get_pair_history
 
 
-def get_disallowed_meetings(users, prev_meeting_tuples, spec):
-    """Returns set of matches that are not allowed
+def get_allowed_meetings(users, prev_meeting_tuples, spec):
+    """Yields the pairs of user ids that are allowed to meet
+    Users are bucketed by the value of their first dept rule field, so pairs that share
+    that value are never generated. The remaining rule fields and the meeting history
+    are checked per candidate, which means the set of all possible pairs is never built.
     Returns:
-        Set of tuples
+        Generator of (smaller id, larger id) tuples
     """
-    # don't match users with previous meetings
-    pairs = prev_meeting_tuples
+    fields = list(dict.fromkeys(rule.name for rule in spec.meeting_subscription.dept_rules))
+    disallowed_meetings = {tuple(sorted(pair)) for pair in prev_meeting_tuples}
 
-    userids = sorted([user.id for user in users])
-    id_to_user = {user.id: user for user in users}
-    all_pairs = {pair for pair in itertools.combinations(userids, 2)}
+    buckets = defaultdict(list)
+    for user in sorted(users, key=lambda user: user.id):
+        rule_values = tuple(_hashable(user.meta_data[field]) for field in fields)
+        buckets[rule_values[:1]].append((user.id, rule_values[1:]))
 
-    for rule in spec.meeting_subscription.dept_rules:
-        pairs = pairs.union({pair for pair in all_pairs if is_same(rule.name, pair, id_to_user)})
-    return pairs
+    if fields:
+        bucket_pairs = itertools.combinations(buckets.values(), 2)
+    else:
+        bucket_pairs = _pairs_within(buckets[()])
 
+    for bucket_a, bucket_b in bucket_pairs:
+        for id_a, values_a in bucket_a:
+            for id_b, values_b in bucket_b:
+                if values_a and any(map(operator.eq, values_a, values_b)):
+                    continue
+                meeting = (id_a, id_b) if id_a < id_b else (id_b, id_a)
+                if meeting not in disallowed_meetings:
+                    yield meeting
 
-def is_same(field, match, users):
-    return users[match[0]].meta_data[field] == users[match[1]].meta_data[field]
 
+def _pairs_within(bucket):
+    # pairs every user with everyone after them, without building the pairs up front
+    for index, user in enumerate(bucket):
+        yield [user], bucket[index + 1 :]
 
-def generate_pair_meetings(users, spec, prev_meeting_tuples=None):
+
+def _hashable(value):
+    # metadata comes from json, so lists are the only unhashable values we expect
+    return tuple(value) if isinstance(value, list) else value
+
+
+def generate_pair_meetings(users, spec, prev_meeting_tuples=None, matcher=None):
     """
     Returns 2 tuples:
     - meetings: list of dicts of the same type as prev_meetings, to indicate
       this iteration's found meetings
     - unmatched_user_ids: users with no matches.
+
+    matcher takes the user ids and the allowed meetings and returns the matched
+    pairs, it defaults to the exact blossom matching in construct_graph.
     """
     if prev_meeting_tuples is None:
-        prev_meeting_tuples = get_previous_meetings(spec.meeting_subscription)
+        prev_meeting_tuples = set(get_pair_history(spec.meeting_subscription))
 
     uid_to_users = {user.id: user for user in users}
     user_ids = sorted(uid_to_users.keys())
 
-    # Determine matches that should not happen
-    disallowed_meeting_set = get_disallowed_meetings(users, prev_meeting_tuples, spec)
-    graph_matches = construct_graph(user_ids, disallowed_meeting_set)
+    # Only the matches that are allowed to happen are handed to the graph
+    allowed_meetings = get_allowed_meetings(users, prev_meeting_tuples, spec)
+    if matcher is None:
+        graph_matches = construct_graph(user_ids, allowed_meetings, get_config().get("matching_processes", 1))
+    else:
+        graph_matches = matcher(user_ids, allowed_meetings)
 
     # matching returns (1,4) and (4,1) this de-dupes
     graph_matches = dict((a, b) if a <= b else (b, a) for a, b in graph_matches)
@@ -58,12 +91,8 @@ def generate_pair_meetings(users, spec, prev_meeting_tuples=None):
     logging.info("{} employees matched".format(len(matches) * 2))
     logging.info([(meeting[0].get_username(), meeting[1].get_username()) for meeting in matches])
 
-    unmatched = [
-        uid_to_users[user]
-        for user in user_ids
-        if user not in list(graph_matches.keys())
-        if user not in list(graph_matches.values())
-    ]
+    matched_ids = set(graph_matches.keys()) | set(graph_matches.values())
+    unmatched = [uid_to_users[user] for user in user_ids if user not in matched_ids]
 
     logging.info(f"{len(unmatched)} employees unmatched")
     logging.info([user.get_username() for user in unmatched])
@@ -71,11 +100,15 @@ def generate_pair_meetings(users, spec, prev_meeting_tuples=None):
     return matches, unmatched
 
 
-def construct_graph(user_ids, disallowed_meetings):
+def construct_graph(user_ids, allowed_meetings, processes=1):
     """
     We can use a maximum matching algorithm for this:
     https://en.wikipedia.org/wiki/Blossom_algorithm
     Yay graphs! Networkx will do all the work for us.
+
+    Blossom is roughly cubic in the number of nodes, so each connected component
+    is matched on its own and the results are merged. With processes > 1 the
+    components are matched in a process pool.
     """
 
     # special weights that be put on the matching potential of each meeting,
@@ -84,16 +117,95 @@ def construct_graph(user_ids, disallowed_meetings):
 
     # This creates the graph and the maximal matching set is returned.
     # It does not return anyone who didn't get matched.
-    meetings = []
-    possible_meetings = {meeting for meeting in itertools.combinations(user_ids, 2)}
-    allowed_meetings = possible_meetings - disallowed_meetings
-
-    for meeting in allowed_meetings:
-        weight = meeting_to_weight.get(meeting, 1.0)
-        meetings.append((*meeting, {"weight": weight}))
-
     graph = nx.Graph()
     graph.add_nodes_from(user_ids)
-    graph.add_edges_from(meetings)
+    graph.add_edges_from((*meeting, {"weight": meeting_to_weight.get(meeting, 1.0)}) for meeting in allowed_meetings)
+
+    # largest first so the pool starts on the slowest components
+    components = sorted((c for c in nx.connected_components(graph) if len(c) > 1), key=len, reverse=True)
+    subgraphs = [graph.subgraph(component).copy() for component in components]
+    logging.info(f"Matching {len(subgraphs)} connected components")
 
-    return nx.max_weight_matching(graph)
+    if processes > 1 and len(subgraphs) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            component_matches = list(executor.map(nx.max_weight_matching, subgraphs))
+    else:
+        component_matches = [nx.max_weight_matching(subgraph) for subgraph in subgraphs]
+
+    return {match for matches in component_matches for match in matches}
+
+
+def greedy_matching(user_ids, allowed_meetings, max_path_length=3, time_budget=None):
+    """
+    Near-linear alternative to construct_graph for very large specs. A maximal
+    matching is built greedily, pairing the people with the fewest options first,
+    and is then grown with augmenting paths of at most max_path_length edges
+    (None for any length) until none are left or time_budget seconds have passed.
+    The result is not guaranteed to be maximum.
+    """
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+
+    adjacency = defaultdict(list)
+    for user_a, user_b in allowed_meetings:
+        adjacency[user_a].append(user_b)
+        adjacency[user_b].append(user_a)
+
+    mates = {}
+    for user in sorted(adjacency, key=lambda user: len(adjacency[user])):
+        if user in mates:
+            continue
+        partners = [partner for partner in adjacency[user] if partner not in mates]
+        if partners:
+            partner = min(partners, key=lambda partner: len(adjacency[partner]))
+            mates[user] = partner
+            mates[partner] = user
+
+    improved = True
+    while improved and (deadline is None or time.monotonic() < deadline):
+        improved = False
+        for user in adjacency:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            if user in mates:
+                continue
+            path = _find_augmenting_path(user, adjacency, mates, max_path_length)
+            if path:
+                for user_a, user_b in zip(path[::2], path[1::2]):
+                    mates[user_a] = user_b
+                    mates[user_b] = user_a
+                improved = True
+
+    return {(user, mate) for user, mate in mates.items() if user < mate}
+
+
+def _find_augmenting_path(root, adjacency, mates, max_path_length):
+    """
+    Breadth first search for an alternating path from the unmatched root to another
+    unmatched user. Blossoms are not contracted, so some paths can be missed, but
+    every path returned is simple and can be flipped to grow the matching by one.
+    Returns the path from the far end back to the root, or None.
+    """
+    parents = {root: None}
+    depths = {root: 0}
+    queue = deque([root])
+    while queue:
+        user = queue.popleft()
+        if max_path_length is not None and 2 * depths[user] + 1 > max_path_length:
+            continue
+        for neighbor in adjacency[user]:
+            if neighbor in parents:
+                continue
+            parents[neighbor] = user
+            if neighbor not in mates:
+                path = [neighbor]
+                while user is not None:
+                    path.append(user)
+                    user = parents[user]
+                return path
+            mate = mates[neighbor]
+            if mate in parents:
+                continue
+            parents[mate] = neighbor
+            depths[mate] = depths[user] + 1
+            queue.append(mate)
+    return None
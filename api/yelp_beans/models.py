@@ -1,4 +1,8 @@
+import pytz
 from database import db
+from sqlalchemy import event
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session
 
 
 class User(db.Model):
@@ -9,6 +13,7 @@ class User(db.Model):
         - last_name:        self-explanatory
         - photo_url:        url to user photo
         - terminated:       TRUE when user has left the company
+        - fingerprint:      hash of the employee data the user was last synced from
 
     Unfortunately, metadata is an attribute already used by sqlalchemy so we use meta_data in
     the table. Note, however, that the json from the frontend uses metadata for the same column.
@@ -21,6 +26,7 @@ class User(db.Model):
     photo_url = db.Column(db.Text)
     meta_data = db.Column(db.JSON)
     terminated = db.Column(db.Boolean, nullable=False, default=False)
+    fingerprint = db.Column(db.String())
     subscription_preferences = db.relationship("UserSubscriptionPreferences")
 
     def get_username(self):
@@ -39,6 +45,10 @@ class MeetingSubscription(db.Model):
         - user_rules:               rules set for allowing people to see a subscription
         - dept_rules:               rules set for matching people
         - default_auto_opt_in:      represents default value for auto opt in to meeting requests for a given meeting subscription
+        - matching_engine:          name of the engine in yelp_beans.matching.engines used to match people
+        - matching_time_budget:     seconds the matching may spend improving matches, per annealing chain for groups
+        - annealing_iterations:     iterations each annealing chain runs for group meetings
+        - annealing_chains:         number of independent annealing chains run for group meetings, the best one is kept
 
     """
 
@@ -51,6 +61,10 @@ class MeetingSubscription(db.Model):
     timezone = db.Column(db.String())
     rule_logic = db.Column(db.String())
     default_auto_opt_in = db.Column(db.Boolean, nullable=False, default=False)
+    matching_engine = db.Column(db.String(), nullable=False, default="exact")
+    matching_time_budget = db.Column(db.Float)
+    annealing_iterations = db.Column(db.Integer)
+    annealing_chains = db.Column(db.Integer)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
     user_list = db.relationship("User")
     user_rules = db.relationship("Rule", foreign_keys="Rule.user_subscription_id")
@@ -91,11 +105,19 @@ class SubscriptionDateTime(db.Model):
     """A datetime object used to normalize datetimes in different entities
     Schema:
         - datetime:                 shared time value
+        - local_weekday:            weekday of datetime in the subscription timezone
+        - local_minute:             minute of the day of datetime in the subscription timezone
+        - local_timezone:           the subscription timezone the local slot was computed for
     """
 
     id = db.Column(db.Integer, primary_key=True)
     datetime = db.Column(db.DateTime)
     meeting_subscription_id = db.Column(db.Integer, db.ForeignKey("meeting_subscription.id"))
+    local_weekday = db.Column(db.Integer)
+    local_minute = db.Column(db.Integer)
+    local_timezone = db.Column(db.String())
+
+    __table_args__ = (db.Index("ix_subscription_date_time_local_slot", "local_weekday", "local_minute", "local_timezone"),)
 
 
 class MeetingSpec(db.Model):
@@ -103,12 +125,20 @@ class MeetingSpec(db.Model):
     Schema:
         - datetime:                 the time that the meeting will take place
         - meeting_subscription:     the meeting subscription the spec is attached to
+        - local_weekday:            weekday of datetime in the subscription timezone
+        - local_minute:             minute of the day of datetime in the subscription timezone
+        - local_timezone:           the subscription timezone the local slot was computed for
     """
 
     id = db.Column(db.Integer, primary_key=True)
     datetime = db.Column(db.DateTime)
     meeting_subscription_id = db.Column(db.Integer, db.ForeignKey("meeting_subscription.id"))
     meeting_subscription = db.relationship("MeetingSubscription")
+    local_weekday = db.Column(db.Integer)
+    local_minute = db.Column(db.Integer)
+    local_timezone = db.Column(db.String())
+
+    __table_args__ = (db.Index("ix_meeting_spec_local_slot", "local_weekday", "local_minute", "local_timezone"),)
 
 
 class MeetingRequest(db.Model):
@@ -126,6 +156,10 @@ class MeetingRequest(db.Model):
     meeting_spec_id = db.Column(db.Integer, db.ForeignKey("meeting_spec.id"))
     meeting_spec = db.relationship("MeetingSpec")
 
+    # an index rather than a table constraint so it can be added to an existing table, see
+    # dedupe_meeting_requests
+    __table_args__ = (db.Index("uq_meeting_request_meeting_spec_id_user_id", "meeting_spec_id", "user_id", unique=True),)
+
 
 class Meeting(db.Model):
     """Models a single meeting.
@@ -153,3 +187,104 @@ class MeetingParticipant(db.Model):
     meeting = db.relationship("Meeting")
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     user = db.relationship("User")
+
+
+class PairHistory(db.Model):
+    """Records when two users have met in a subscription, maintained by save_meetings
+    so matching does not have to rebuild it from Meeting and MeetingParticipant rows.
+    There is a row per pair and meeting spec datetime, so the meetings of a cooldown window
+    are counted with a range scan over (subscription_id, met).
+    Schema:
+        - subscription:     References a MeetingSubscription item.
+        - user_a_id:        Smaller of the two user ids.
+        - user_b_id:        Larger of the two user ids.
+        - met:              Datetime of the meeting spec the pair was matched for.
+        - count:            Number of meetings the pair has been matched in for that datetime.
+    """
+
+    subscription_id = db.Column(db.Integer, db.ForeignKey("meeting_subscription.id"), primary_key=True)
+    user_a_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    user_b_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    met = db.Column(db.DateTime, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (db.Index("ix_pair_history_subscription_id_met", "subscription_id", "met"),)
+
+
+class EmailOutbox(db.Model):
+    """An email waiting to be sent, or already sent, by the send_emails task. Cron handlers
+    only add rows here so they return quickly, and a send cut short is picked up again.
+    Schema:
+        - key:              Identifies the batch the email belongs to, e.g. the template and
+                            meeting spec, an email is queued once per key and recipient.
+        - recipient:        Email address the email is sent to.
+        - subject:          Subject line of the email.
+        - template:         Template file the email was rendered from.
+        - content:          Rendered html of the email.
+        - substitutions:    SendGrid substitution tags in content and their value for the
+                            recipient, emails with the same content are sent together.
+        - status:           pending, sending, sent or failed.
+        - attempts:         Number of times sending the email failed.
+        - lease_id:         Identifies the run of the task sending the email.
+        - leased_until:     Another run may send the email after this time.
+        - error:            Why the last attempt failed.
+        - created:          When the email was queued.
+        - sent:             When the email was sent.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(), nullable=False)
+    recipient = db.Column(db.String(), nullable=False)
+    subject = db.Column(db.String(), nullable=False)
+    template = db.Column(db.String(), nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    substitutions = db.Column(db.JSON)
+    status = db.Column(db.String(), nullable=False, default="pending")
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    lease_id = db.Column(db.String())
+    leased_until = db.Column(db.DateTime)
+    error = db.Column(db.Text)
+    created = db.Column(db.DateTime, nullable=False)
+    sent = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.UniqueConstraint("key", "recipient", name="uq_email_outbox_key_recipient"),
+        db.Index("ix_email_outbox_status_id", "status", "id"),
+    )
+
+
+def get_local_slot(utc_datetime, timezone):
+    """
+    The weekly slot a naive utc datetime falls on in a timezone, as (weekday, minute of day).
+    The conversion uses the offset in effect on that date, so a slot created in winter
+    still means the same local time in summer.
+    """
+    local_datetime = utc_datetime.replace(tzinfo=pytz.utc).astimezone(pytz.timezone(timezone))
+    return local_datetime.weekday(), local_datetime.hour * 60 + local_datetime.minute
+
+
+def set_local_slot(model, timezone):
+    """Fills in the local slot columns of a SubscriptionDateTime or MeetingSpec"""
+    if model.datetime is None or timezone is None:
+        model.local_weekday, model.local_minute, model.local_timezone = None, None, None
+    else:
+        model.local_weekday, model.local_minute = get_local_slot(model.datetime, timezone)
+        model.local_timezone = timezone
+
+
+@event.listens_for(Session, "before_flush")
+def _update_local_slots(session, flush_context, instances):
+    """Keeps the local slots in step with datetimes and subscription timezones as they are saved"""
+    with session.no_autoflush:
+        for instance in [*session.new, *session.dirty]:
+            if isinstance(instance, SubscriptionDateTime | MeetingSpec):
+                subscription = instance.meeting_subscription
+                if subscription is None and instance.meeting_subscription_id is not None:
+                    subscription = session.get(MeetingSubscription, instance.meeting_subscription_id)
+                set_local_slot(instance, subscription.timezone if subscription is not None else None)
+
+        for instance in session.dirty:
+            if isinstance(instance, MeetingSubscription) and inspect(instance).attrs.timezone.history.has_changes():
+                specs = session.query(MeetingSpec).filter(MeetingSpec.meeting_subscription_id == instance.id).all()
+                for model in [*instance.datetime, *specs]:
+                    set_local_slot(model, instance.timezone)
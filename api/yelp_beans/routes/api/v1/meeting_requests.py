@@ -2,6 +2,7 @@ from database import db
 from flask import Blueprint
 from flask import jsonify
 from flask import request
+from sqlalchemy.exc import IntegrityError
 
 from yelp_beans.logic.meeting_request import query_meeting_request
 from yelp_beans.logic.user import get_user
@@ -25,9 +26,14 @@ def create_delete_meeting_request():
         meeting_request = query_meeting_request(meeting_spec, user)
 
         if not meeting_request:
-            meeting_request = MeetingRequest(meeting_spec=meeting_spec, user=user)
-            db.session.add(meeting_request)
-            db.session.commit()
+            try:
+                meeting_request = MeetingRequest(meeting_spec=meeting_spec, user=user)
+                db.session.add(meeting_request)
+                db.session.commit()
+            except IntegrityError:
+                # created in the meantime, e.g. by a double click or auto opt in
+                db.session.rollback()
+                meeting_request = query_meeting_request(meeting_spec, user)
 
         return jsonify({"key": meeting_request.id})
     else:
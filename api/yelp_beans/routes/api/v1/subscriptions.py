@@ -14,6 +14,7 @@ from yelp_beans.logic.subscription import get_subscription as get_subscription_m
 from yelp_beans.models import MeetingSubscription
 from yelp_beans.models import Rule
 from yelp_beans.models import SubscriptionDateTime
+from yelp_beans.models import get_local_slot
 from yelp_beans.routes.api.v1.types import NewSubscription
 from yelp_beans.routes.api.v1.types import RuleModel
 from yelp_beans.routes.api.v1.types import Subscription
@@ -57,6 +58,10 @@ def create_subscription():
         rule_logic=data.rule_logic if rules else None,
         user_rules=rules,
         default_auto_opt_in=data.default_auto_opt_in,
+        matching_engine=data.matching_engine,
+        matching_time_budget=data.matching_time_budget,
+        annealing_iterations=data.annealing_iterations,
+        annealing_chains=data.annealing_chains,
     )
 
     db.session.add(subscription)
@@ -104,6 +109,10 @@ def update_subscription(sub_id: int):
     sub_model.location = data.location
     sub_model.timezone = data.timezone
     sub_model.default_auto_opt_in = data.default_auto_opt_in
+    sub_model.matching_engine = data.matching_engine
+    sub_model.matching_time_budget = data.matching_time_budget
+    sub_model.annealing_iterations = data.annealing_iterations
+    sub_model.annealing_chains = data.annealing_chains
     sub_model.rule_logic = data.rule_logic if data.rules else None
 
     existing_rules = {RuleModel.from_sqlalchemy(r): r for r in sub_model.user_rules}
@@ -117,25 +126,22 @@ def update_subscription(sub_id: int):
     for rule in existing_rules.values():
         sub_model.user_rules.remove(rule)
 
-    # To account for daylight savings we have to make sure the utc datetimes
-    # are being compared at the same time of year
-    def normalize_datetime(dt: SubscriptionDateTime) -> tuple[int, int, int]:
-        time_slot = TimeSlot.from_sqlalchemy(dt, sub_model.timezone)
-        normalized = calculate_meeting_datetime(time_slot, sub_model.timezone)
-        # We only care that the weekday, hour, and minute now that we have normalized it
-        return (normalized.weekday(), normalized.hour, normalized.minute)
+    # Slots are compared as local weekday and minute of the day in the subscription timezone.
+    # The stored local slot is computed on the datetime's own date, so daylight savings
+    # does not move it, and it only has to be recomputed when the timezone is changing
+    def local_slot(dt: SubscriptionDateTime) -> tuple[int, int]:
+        if dt.local_timezone == sub_model.timezone:
+            return (dt.local_weekday, dt.local_minute)
+        return get_local_slot(dt.datetime, sub_model.timezone)
 
-    existing_datetimes = {normalize_datetime(ts): ts for ts in sub_model.datetime}
+    existing_datetimes = {local_slot(ts): ts for ts in sub_model.datetime}
 
     for time_slot in data.time_slots:
-        # we have to compare based on the meeting datetime, so that the timezone
-        # being changed is accounted for since we store utc
-        time_slot_dt = calculate_meeting_datetime(time_slot, data.timezone)
-        time_slot_key = (time_slot_dt.weekday(), time_slot_dt.hour, time_slot_dt.minute)
+        time_slot_key = (time_slot.day.to_day_number(), time_slot.hour * 60 + time_slot.minute)
         if time_slot_key in existing_datetimes:
             del existing_datetimes[time_slot_key]
         else:
-            sub_model.datetime.append(SubscriptionDateTime(datetime=time_slot_dt))
+            sub_model.datetime.append(SubscriptionDateTime(datetime=calculate_meeting_datetime(time_slot, data.timezone)))
 
     # Remaining datetimes weren't in the list of updated time_slots
     for dt in existing_datetimes.values():
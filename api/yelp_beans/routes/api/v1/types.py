@@ -11,6 +11,8 @@ from pydantic import field_validator
 from pytz import all_timezones
 from pytz import utc
 
+from yelp_beans.matching.engines import DEFAULT_ENGINE
+from yelp_beans.matching.engines import MATCHING_ENGINES
 from yelp_beans.models import MeetingSubscription
 from yelp_beans.models import Rule
 from yelp_beans.models import SubscriptionDateTime
@@ -82,6 +84,10 @@ class NewSubscription(BaseModel):
     time_slots: list[TimeSlot] = Field(min_length=1)
     timezone: str = "America/Los_Angeles"
     default_auto_opt_in: bool = False
+    matching_engine: str = DEFAULT_ENGINE
+    matching_time_budget: float | None = Field(None, gt=0)
+    annealing_iterations: int | None = Field(None, gt=0)
+    annealing_chains: int | None = Field(None, gt=0)
 
     @field_validator("timezone")
     @classmethod
@@ -90,6 +96,13 @@ class NewSubscription(BaseModel):
             raise ValueError(f"{value} is not a valid timezone")
         return value
 
+    @field_validator("matching_engine")
+    @classmethod
+    def is_valid_matching_engine(cls, value: str) -> str:
+        if value not in MATCHING_ENGINES:
+            raise ValueError(f"{value} is not a valid matching engine")
+        return value
+
 
 class Subscription(NewSubscription):
     id: int
@@ -109,4 +122,8 @@ class Subscription(NewSubscription):
             time_slots=time_slots,
             timezone=model.timezone,
             default_auto_opt_in=model.default_auto_opt_in,
+            matching_engine=model.matching_engine,
+            matching_time_budget=model.matching_time_budget,
+            annealing_iterations=model.annealing_iterations,
+            annealing_chains=model.annealing_chains,
         )
@@ -1,30 +1,29 @@
+import itertools
 import logging
 
 from flask import Blueprint
-from pytz import timezone
-from pytz import utc
 from sqlalchemy.orm import joinedload
 
+from yelp_beans.data_providers.data_provider import SourceUnchanged
+from yelp_beans.logic.config import get_config
 from yelp_beans.logic.data_ingestion import DataIngestion
-from yelp_beans.logic.meeting_request import query_meeting_request
-from yelp_beans.logic.meeting_request import store_meeting_request
-from yelp_beans.logic.meeting_spec import get_meeting_datetime
+from yelp_beans.logic.meeting_request import create_auto_opt_in_meeting_requests
 from yelp_beans.logic.meeting_spec import get_specs_for_current_week
 from yelp_beans.logic.subscription import get_specs_from_subscription
 from yelp_beans.logic.subscription import store_specs_from_subscription
 from yelp_beans.logic.user import delete_user_subscription_preference
 from yelp_beans.logic.user import is_valid_user_subscription_preference
 from yelp_beans.logic.user import sync_employees
-from yelp_beans.matching.match import generate_meetings
+from yelp_beans.matching.match import match_specs
 from yelp_beans.matching.match_utils import save_meetings
 from yelp_beans.models import Meeting
 from yelp_beans.models import MeetingParticipant
-from yelp_beans.models import MeetingRequest
 from yelp_beans.models import MeetingSubscription
 from yelp_beans.models import UserSubscriptionPreferences
 from yelp_beans.send_email import send_batch_meeting_confirmation_email
 from yelp_beans.send_email import send_batch_unmatched_email
 from yelp_beans.send_email import send_batch_weekly_opt_in_email
+from yelp_beans.send_email import send_queued_emails
 
 tasks = Blueprint("tasks", __name__)
 
@@ -48,8 +47,14 @@ def weekly_opt_in():
 
 @tasks.route("/populate_employees", methods=["GET"])
 def populate_employees():
-    employees = DataIngestion().ingest()
-    sync_employees([employee for employee in employees])
+    ingestion = DataIngestion()
+    try:
+        result = sync_employees(ingestion.stream())
+    except SourceUnchanged:
+        logging.info("Employee data has not changed since the last sync")
+        return "OK"
+    ingestion.mark_synced()
+    logging.info(result)
     return "OK"
 
 
@@ -57,16 +62,9 @@ def populate_employees():
 def match_employees():
     specs = get_specs_for_current_week()
 
-    for spec in specs:
-        logging.info("Spec Datetime: ")
-        logging.info(get_meeting_datetime(spec).strftime("%Y-%m-%d %H:%M"))
-
-        users = [request.user for request in MeetingRequest.query.filter(MeetingRequest.meeting_spec_id == spec.id).all()]
-        logging.info("Users: ")
-        logging.info([user.get_username() for user in users])
-
-        group_size = spec.meeting_subscription.size
-        matches, unmatched = generate_meetings(users, spec, prev_meeting_tuples=None, group_size=group_size)
+    # matching can run in parallel, saving and emailing happen here one spec at a time
+    results = match_specs(specs, get_config().get("spec_matching_processes", 1))
+    for spec, (matches, unmatched) in zip(specs, results):
         save_meetings(matches, spec)
 
         send_batch_unmatched_email(unmatched, spec)
@@ -76,16 +74,27 @@ def match_employees():
 
 @tasks.route("/send_match_email_for_week", methods=["GET"])
 def send_match_emails():
+    """
+    Queues the match emails of the week again, for when they need resending: emails that are
+    missing are queued and emails that failed to send are retried. Emails already sent, or
+    still waiting in the outbox, are not sent twice.
+    """
     specs = get_specs_for_current_week()
     for spec in specs:
-        matches = []
-        meetings = Meeting.query.filter(Meeting.meeting_spec_id == spec.id).all()
-        for meeting in meetings:
-            participants = MeetingParticipant.query.filter(MeetingParticipant.meeting_id == meeting.id).all()
-            matches.append((participants[0].user, participants[1].user))
+        participants = (
+            MeetingParticipant.query.join(Meeting, MeetingParticipant.meeting_id == Meeting.id)
+            .filter(Meeting.meeting_spec_id == spec.id)
+            .options(joinedload(MeetingParticipant.user))
+            .order_by(MeetingParticipant.meeting_id)
+            .all()
+        )
+        matches = [
+            [participant.user for participant in meeting_participants]
+            for _, meeting_participants in itertools.groupby(participants, key=lambda participant: participant.meeting_id)
+        ]
         logging.info(spec)
         logging.info(matches)
-        send_batch_meeting_confirmation_email(matches, spec)
+        send_batch_meeting_confirmation_email(matches, spec, resend_failed=True)
     return "OK"
 
 
@@ -117,32 +126,17 @@ def generate_meeting_requests_for_auto_opt_in_preferences():
     logging.info("All specs: ")
     logging.info(specs)
 
-    for spec in specs:
-        spec_dt = get_meeting_datetime(spec)
+    created = create_auto_opt_in_meeting_requests(specs)
+    logging.info(f"Generated {created} MeetingRequests for UserSubscriptionPreferences with auto_opt_in == True")
+    return "OK"
 
-        user_sub_preferences_with_auto_opt_in = (
-            UserSubscriptionPreferences.query.filter(UserSubscriptionPreferences.subscription_id == spec.meeting_subscription_id)
-            .filter(UserSubscriptionPreferences.auto_opt_in.is_(True))
-            .all()
-        )
 
-        logging.info(f"All UserSubscriptionPreferences with auto_opt_in == True for spec = {spec}:")
-        logging.info(user_sub_preferences_with_auto_opt_in)
-        for user_preference in user_sub_preferences_with_auto_opt_in:
-            preference_dt = user_preference.preference.datetime.replace(tzinfo=utc).astimezone(
-                timezone(spec.meeting_subscription.timezone)
-            )
-            if (
-                preference_dt.hour == spec_dt.hour
-                and preference_dt.minute == spec_dt.minute
-                and preference_dt.weekday() == spec_dt.weekday()
-            ):
-                logging.info(
-                    f"Generating MeetingRequest for UserSubscriptionPreferences = {user_preference} if one does not already exist"
-                )
-                if not query_meeting_request(spec, user_preference.user):
-                    meeting_request = MeetingRequest(meeting_spec=spec, user=user_preference.user)
-                    store_meeting_request(meeting_request)
-
-                    logging.info(f"Meeting request generated. MeetingRequest: {meeting_request}")
+@tasks.route("/send_emails", methods=["GET"])
+def send_outbox_emails():
+    config = get_config()
+    sent = send_queued_emails(
+        chunk_size=config.get("email_outbox_chunk_size", 1000),
+        time_budget=config.get("email_outbox_time_budget", 300),
+    )
+    logging.info(f"Sent {sent} emails from the outbox")
     return "OK"
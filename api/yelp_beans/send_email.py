@@ -1,25 +1,55 @@
 import datetime
 import json
 import logging
+import os
+import threading
+import time
 import urllib
+import uuid
+from collections import defaultdict
 from collections.abc import Collection
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
 from dataclasses import dataclass
 from functools import cache
 from typing import Any
 
+import requests
+from database import db
 from jinja2 import Environment
+from jinja2 import FileSystemBytecodeCache
 from jinja2 import PackageLoader
-from sendgrid import SendGridAPIClient
+from jinja2 import Template
+from requests.adapters import HTTPAdapter
 from sendgrid.helpers.mail import Content
 from sendgrid.helpers.mail import Email
 from sendgrid.helpers.mail import Mail
+from sendgrid.helpers.mail import Personalization
+from sendgrid.helpers.mail import Substitution
 from sendgrid.helpers.mail import To
+from sqlalchemy import insert
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy import update
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects import sqlite
 
+from yelp_beans.logic.config import get_config
 from yelp_beans.logic.meeting_spec import get_meeting_datetime
 from yelp_beans.logic.meeting_spec import get_users_from_spec
+from yelp_beans.models import EmailOutbox
 from yelp_beans.models import MeetingSpec
 from yelp_beans.models import User
 
+DEFAULT_EMAIL_WORKERS = 8
+# SendGrid accepts at most this many personalizations in one request
+MAX_PERSONALIZATIONS = 1000
+# a run of the send_emails task that has not finished with its emails by then is presumed dead
+EMAIL_LEASE = datetime.timedelta(minutes=10)
+# failed emails are retried after EMAIL_RETRY_BACKOFF, doubling with every attempt
+EMAIL_RETRY_BACKOFF = datetime.timedelta(minutes=1)
+MAX_EMAIL_ATTEMPTS = 5
+
 
 @dataclass
 class Secrets:
@@ -41,14 +71,207 @@ def get_secrets() -> Secrets:
     )
 
 
+class RateLimiter:
+    """Spaces out calls so no more than rate happen per second, shared between threads"""
+
+    def __init__(self, rate: float | None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_call = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            call_at = max(now, self.next_call)
+            self.next_call = call_at + self.interval
+        time.sleep(call_at - now)
+
+
+class EmailSender:
+    """
+    Posts messages to the SendGrid mail send API over one keep-alive connection pool,
+    safe to share between the threads sending a batch. Requests are rate limited and
+    retried with exponential backoff when SendGrid is throttling or failing.
+    """
+
+    RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+    def __init__(
+        self,
+        api_key: str,
+        host: str = "https://api.sendgrid.com",
+        pool_size: int = 8,
+        rate: float | None = None,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 30.0,
+    ):
+        self.url = f"{host.rstrip('/')}/v3/mail/send"
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(rate)
+        self.session = requests.Session()
+        self.session.headers.update({"Authorization": f"Bearer {api_key}"})
+        self.session.mount(host, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def send(self, request_body: dict[str, Any]) -> requests.Response:
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.wait()
+            try:
+                response = self.session.post(self.url, json=request_body, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2**attempt
+            else:
+                if response.status_code not in self.RETRY_STATUSES or attempt == self.retries:
+                    response.raise_for_status()
+                    return response
+                retry_after = response.headers.get("Retry-After", "")
+                delay = float(retry_after) if retry_after.isdigit() else self.backoff * 2**attempt
+            logging.warning(f"Retrying email in {delay:.1f}s, attempt {attempt + 1} of {self.retries}")
+            time.sleep(delay)
+
+
 @cache
-def get_sendgrid_client() -> SendGridAPIClient:
+def get_email_sender() -> EmailSender:
     secrets = get_secrets()
-    return SendGridAPIClient(api_key=secrets.send_grid_api_key)
+    config = get_config()
+    return EmailSender(
+        api_key=secrets.send_grid_api_key,
+        host=config.get("sendgrid_host", "https://api.sendgrid.com"),
+        pool_size=config.get("email_workers", DEFAULT_EMAIL_WORKERS),
+        rate=config.get("email_rate_limit"),
+    )
+
+
+@cache
+def get_template_environment() -> Environment:
+    """
+    The Jinja environment for the email templates, shared by every email. Templates are not
+    checked for changes on disk once loaded. When email_template_cache_dir is configured the
+    compiled templates are also kept there, so a new process skips compiling them.
+    """
+    cache_dir = get_config().get("email_template_cache_dir")
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    return Environment(
+        loader=PackageLoader("yelp_beans", "templates"),
+        auto_reload=False,
+        bytecode_cache=FileSystemBytecodeCache(cache_dir) if cache_dir else None,
+    )
+
+
+@cache
+def get_email_template(template_filename: str) -> Template:
+    """Loads and compiles a template from yelp_beans/templates once per process"""
+    return get_template_environment().get_template(template_filename)
+
+
+def render_email(template_filename: str, template_arguments: dict[str, Any]) -> str:
+    return get_email_template(template_filename).render(template_arguments)
+
+
+def build_message(email: str, subject: str, content: str) -> dict[str, Any]:
+    """The SendGrid request body of an email with already rendered content"""
+    message = Mail(Email(get_secrets().send_grid_sender), To(email), subject, Content("text/html", content))
+    return message.get()
+
+
+def build_personalized_message(subject: str, content: str, recipients: Collection[tuple[str, dict[str, str]]]) -> dict[str, Any]:
+    """
+    The SendGrid request body of one email sent to every recipient, with the substitution tags
+    in content replaced by the values given for each recipient
+        recipients - email and substitution tags to values of each recipient
+    """
+    message = Mail(from_email=Email(get_secrets().send_grid_sender), subject=subject)
+    message.add_content(Content("text/html", content))
+    for email, substitutions in recipients:
+        personalization = Personalization()
+        personalization.add_to(To(email))
+        for tag, value in substitutions.items():
+            personalization.add_substitution(Substitution(tag, value))
+        message.add_personalization(personalization)
+    return message.get()
+
+
+def _substitution_tags(keys: Collection[str]) -> dict[str, str]:
+    return {key: f"-{key}-" for key in keys}
+
+
+def _substitutions(keys: Collection[str], arguments: dict[str, Any]) -> dict[str, str]:
+    return {f"-{key}-": "" if arguments.get(key) is None else str(arguments[key]) for key in keys}
+
+
+def _send_messages(messages: list[tuple[str, dict[str, Any]]]) -> list[str | None]:
+    """
+    Posts (recipient, request body) messages from a bounded pool of threads sharing the EmailSender
+    Returns:
+        - the error of each message, None when it was sent
+    """
+    if not messages:
+        return []
+    sender = get_email_sender()
+    workers = min(get_config().get("email_workers", DEFAULT_EMAIL_WORKERS), len(messages))
+    errors = [None] * len(messages)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(sender.send, message): i for i, (_, message) in enumerate(messages)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                logging.exception(f"Failed to send email to {messages[i][0]}")
+                errors[i] = repr(e)
+    return errors
+
+
+def _send_rendered_emails(emails: list[tuple[str, str, str, dict[str, str] | None]]) -> list[str | None]:
+    """
+    Sends rendered (recipient, subject, content, substitutions) emails. Emails with
+    substitutions sharing their subject and content go out as SendGrid personalizations, up
+    to MAX_PERSONALIZATIONS recipients per request, unless email_personalizations is off. A
+    request that fails falls back to sending its emails one at a time, with the tags filled
+    in here, like the emails without substitutions.
+    Returns:
+        - the error of each email, None when it was sent
+    """
+    personalizations = get_config().get("email_personalizations", True)
+    singles = []
+    personalized = defaultdict(list)
+    for i, (_, subject, content, substitutions) in enumerate(emails):
+        if substitutions is not None and personalizations:
+            personalized[(subject, content)].append(i)
+        else:
+            singles.append(i)
+
+    errors = [None] * len(emails)
+    sender = get_email_sender()
+    for (subject, content), group in personalized.items():
+        for start in range(0, len(group), MAX_PERSONALIZATIONS):
+            batch = group[start : start + MAX_PERSONALIZATIONS]
+            try:
+                sender.send(build_personalized_message(subject, content, [(emails[i][0], emails[i][3]) for i in batch]))
+            except Exception:
+                logging.exception(f"Failed to send {subject!r} to {len(batch)} people at once, sending one at a time")
+                singles.extend(batch)
+
+    messages = []
+    for i in singles:
+        recipient, subject, content, substitutions = emails[i]
+        for tag, value in (substitutions or {}).items():
+            content = content.replace(tag, value)
+        messages.append((recipient, build_message(recipient, subject, content)))
+    for i, error in zip(singles, _send_messages(messages)):
+        errors[i] = error
+    return errors
 
 
 def send_single_email(email: str, subject: str, template_filename: str, template_arguments: dict[str, Any]):
-    """Send an email using the SendGrid API
+    """Send an email using the SendGrid API, right away rather than through the outbox
     Args:
         - email => the user's work email (ie username@company.com)
         - subject => the subject line for the email
@@ -57,31 +280,245 @@ def send_single_email(email: str, subject: str, template_filename: str, template
     Returns:
         - SendGrid response
     """
-    secrets = get_secrets()
-    send_grid_client = get_sendgrid_client()
-    env = Environment(loader=PackageLoader("yelp_beans", "templates"))
-    template = env.get_template(template_filename)
-    rendered_template = template.render(template_arguments)
+    return get_email_sender().send(build_message(email, subject, render_email(template_filename, template_arguments)))
+
+
+def send_emails(emails: Collection[tuple[str, str, str, dict[str, Any]]]) -> int:
+    """
+    Sends many emails right away, from a bounded pool of threads. A failed email is logged
+    and does not stop the rest. The batch emails go through the outbox instead, see queue_emails.
+        emails - send_single_email arguments, one tuple per email
+    Returns:
+        - number of emails sent
+    """
+    errors = _send_rendered_emails(
+        [
+            (email, subject, render_email(template_filename, template_arguments), None)
+            for email, subject, template_filename, template_arguments in emails
+        ]
+    )
+    sent = errors.count(None)
+    logging.info(f"Sent {sent} of {len(errors)} emails")
+    return sent
+
+
+def send_personalized_emails(
+    recipients: Collection[tuple[str, dict[str, Any]]],
+    subject: str,
+    template_filename: str,
+    template_arguments: dict[str, Any],
+) -> int:
+    """
+    Sends one template to many people right away, as SendGrid personalizations, see
+    queue_personalized_emails for the arguments.
+    Returns:
+        - number of emails sent
+    """
+    names = {name for _, arguments in recipients for name in arguments}
+    content = render_email(template_filename, {**template_arguments, **_substitution_tags(names)})
+    errors = _send_rendered_emails(
+        [(email, subject, content, _substitutions(names, arguments)) for email, arguments in recipients]
+    )
+    sent = errors.count(None)
+    logging.info(f"Sent {sent} of {len(errors)} {template_filename} emails")
+    return sent
+
+
+def queue_emails(key: str, emails: Collection[tuple[str, str, str, dict[str, Any]]]) -> int:
+    """
+    Renders emails and adds them to the outbox, the send_emails task sends them later.
+    An email is queued once per key and recipient, so queueing a batch again is a no-op,
+    emails that failed to send are queued again by requeue_failed_emails.
+        key - identifies the batch, e.g. the template and meeting spec
+        emails - send_single_email arguments, one tuple per email
+    Returns:
+        - number of emails queued
+    """
+    return _queue(
+        key,
+        [
+            {
+                "recipient": email,
+                "subject": subject,
+                "template": template_filename,
+                "content": render_email(template_filename, template_arguments),
+                "substitutions": None,
+            }
+            for email, subject, template_filename, template_arguments in emails
+        ],
+    )
+
+
+def queue_personalized_emails(
+    key: str,
+    recipients: Collection[tuple[str, dict[str, Any]]],
+    subject: str,
+    template_filename: str,
+    template_arguments: dict[str, Any],
+) -> int:
+    """
+    Adds emails that differ only by a few arguments to the outbox, see queue_emails. The
+    template is rendered once with a -name- substitution tag in place of each differing
+    argument, and the send_emails task sends emails sharing it as SendGrid personalizations,
+    SendGrid filling the tags in for each recipient.
+        recipients - email and the differing template arguments of each recipient
+        subject - the subject line for the emails
+        template_filename - the template file, corresponding to the email sent
+        template_arguments - template arguments shared by every recipient
+    """
+    names = {name for _, arguments in recipients for name in arguments}
+    content = render_email(template_filename, {**template_arguments, **_substitution_tags(names)})
+    return _queue(
+        key,
+        [
+            {
+                "recipient": email,
+                "subject": subject,
+                "template": template_filename,
+                "content": content,
+                "substitutions": _substitutions(names, arguments),
+            }
+            for email, arguments in recipients
+        ],
+    )
+
+
+def _queue(key: str, rows: list[dict[str, Any]]) -> int:
+    queued = set(db.session.scalars(select(EmailOutbox.recipient).where(EmailOutbox.key == key)))
+    new_rows = {}
+    for row in rows:
+        if row["recipient"] not in queued:
+            new_rows.setdefault(row["recipient"], row)
+    added = 0
+    if new_rows:
+        created = datetime.datetime.now()
+        # another run may queue the same batch at the same time, its emails are skipped
+        # counted from the ids returned, the rowcount of a many row insert is not reliable
+        added = len(
+            db.session.execute(
+                _insert_ignoring_duplicates(EmailOutbox.__table__).returning(EmailOutbox.id),
+                [{**row, "key": key, "created": created} for row in new_rows.values()],
+            ).all()
+        )
+        db.session.commit()
+    logging.info(f"Queued {added} {key} emails, {len(rows) - added} were already queued")
+    return added
 
-    message = Mail(Email(secrets.send_grid_sender), To(email), subject, Content("text/html", rendered_template))
 
-    return send_grid_client.client.mail.send.post(request_body=message.get())
+def _insert_ignoring_duplicates(table):
+    """An INSERT leaving out the rows a unique constraint already has, where the database supports it"""
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect == "sqlite":
+        return sqlite.insert(table).on_conflict_do_nothing()
+    return insert(table)
+
+
+def requeue_failed_emails(key: str) -> int:
+    """
+    Queues the emails of a batch that failed to send MAX_EMAIL_ATTEMPTS times once more,
+    with their attempts reset. Sent and pending emails are left alone.
+    Returns:
+        - number of emails queued again
+    """
+    result = db.session.execute(
+        update(EmailOutbox)
+        .where(EmailOutbox.key == key, EmailOutbox.status == "failed")
+        .values(status="pending", attempts=0, error=None, lease_id=None, leased_until=None)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    logging.info(f"Queued {result.rowcount} failed {key} emails again")
+    return result.rowcount
+
+
+def send_queued_emails(chunk_size: int = 1000, time_budget: float | None = None) -> int:
+    """
+    Sends emails from the outbox in chunks, until none are left to send or time_budget
+    seconds have passed. Each chunk is leased before sending, so runs overlapping each other
+    send different emails and emails leased by a run that died are sent once the lease
+    expires. An email is only sent twice when a run dies between sending it and recording it.
+    Returns:
+        - number of emails sent
+    """
+    start = time.monotonic()
+    sent = 0
+    while time_budget is None or time.monotonic() - start < time_budget:
+        leased, chunk_sent = _send_queued_email_chunk(chunk_size)
+        sent += chunk_sent
+        if leased < chunk_size:
+            break
+    return sent
+
+
+def _send_queued_email_chunk(limit: int) -> tuple[int, int]:
+    emails = _lease_emails(limit)
+    if not emails:
+        return 0, 0
+
+    results = _send_rendered_emails([(email.recipient, email.subject, email.content, email.substitutions) for email in emails])
+    errors = {email.id: error for email, error in zip(emails, results)}
+
+    now = datetime.datetime.now()
+    sent_ids = [email_id for email_id, error in errors.items() if error is None]
+    if sent_ids:
+        db.session.execute(
+            update(EmailOutbox)
+            .where(EmailOutbox.id.in_(sent_ids))
+            .values(status="sent", sent=now, error=None, lease_id=None, leased_until=None)
+            .execution_options(synchronize_session=False)
+        )
+    for email in emails:
+        if errors[email.id] is not None:
+            email.attempts += 1
+            email.error = errors[email.id]
+            email.lease_id = None
+            if email.attempts < MAX_EMAIL_ATTEMPTS:
+                email.status = "pending"
+                email.leased_until = now + EMAIL_RETRY_BACKOFF * 2 ** (email.attempts - 1)
+            else:
+                email.status = "failed"
+                email.leased_until = None
+    db.session.commit()
+    logging.info(f"Sent {len(sent_ids)} of {len(emails)} queued emails")
+    return len(emails), len(sent_ids)
+
+
+def _lease_emails(limit: int) -> list[EmailOutbox]:
+    """Marks up to limit emails ready to send as sent by this run, oldest first, and loads them"""
+    now = datetime.datetime.now()
+    lease_id = uuid.uuid4().hex
+    # pending emails wait out their retry backoff in leased_until too
+    ready = (
+        EmailOutbox.status.in_(["pending", "sending"]),
+        or_(EmailOutbox.leased_until.is_(None), EmailOutbox.leased_until < now),
+    )
+    ids = select(EmailOutbox.id).where(*ready).order_by(EmailOutbox.id).limit(limit)
+    db.session.execute(
+        update(EmailOutbox)
+        .where(EmailOutbox.id.in_(ids), *ready)
+        .values(status="sending", lease_id=lease_id, leased_until=now + EMAIL_LEASE)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return EmailOutbox.query.filter(EmailOutbox.lease_id == lease_id).order_by(EmailOutbox.id).all()
 
 
 def send_batch_initial_opt_in_email(users: Collection[User]) -> None:
-    """Sends the initial batch email to ask if people want to join Beans"""
+    """Queues the initial batch email to ask if people want to join Beans"""
     secrets = get_secrets()
-    for user in users:
-        send_single_email(
-            user.email,
-            "Want to meet other employees through Beans?",
-            "welcome_email.html",
-            {"first_name": user.first_name, "project": secrets.project},
-        )
+    queue_personalized_emails(
+        f"welcome_email.html:{datetime.date.today()}",
+        [(user.email, {"first_name": user.first_name}) for user in users],
+        "Want to meet other employees through Beans?",
+        "welcome_email.html",
+        {"project": secrets.project},
+    )
 
 
 def send_batch_weekly_opt_in_email(meeting_spec: MeetingSpec) -> None:
-    """Sends an email for the week asking if members want a meeting"""
+    """Queues an email for the week asking if members want a meeting"""
     secrets = get_secrets()
     create_url = f"https://{secrets.project}.appspot.com/meeting_request/{meeting_spec.id}"
     logging.info("created url " + create_url)
@@ -95,58 +532,70 @@ def send_batch_weekly_opt_in_email(meeting_spec: MeetingSpec) -> None:
     subscription = meeting_spec.meeting_subscription
     logging.info(meeting_datetime.strftime("%I:%M %p %Z"))
 
+    recipients = []
     for user in users:
         if not user.terminated:
-            logging.info(user)
-            logging.info(meeting_datetime)
-            send_single_email(
-                user.email,
-                "Want a beans meeting this week?",
-                "weekly_opt_in_email.html",
-                {
-                    "first_name": user.first_name,
-                    "office": subscription.office,
-                    "location": subscription.location,
-                    "meeting_title": subscription.title,
-                    "meeting_day": meeting_datetime.strftime("%A"),
-                    "meeting_time": meeting_datetime.strftime("%I:%M %p %Z"),
-                    "meeting_url": create_url,
-                    "link_to_change_pref": f"https://{secrets.project}.appspot.com/",
-                    "project": secrets.project,
-                },
-            )
-            logging.info("sent email")
+            recipients.append((user.email, {"first_name": user.first_name}))
         else:
             logging.info(user)
             logging.info("terminated")
+    queue_personalized_emails(
+        f"weekly_opt_in_email.html:{meeting_spec.id}",
+        recipients,
+        "Want a beans meeting this week?",
+        "weekly_opt_in_email.html",
+        {
+            "office": subscription.office,
+            "location": subscription.location,
+            "meeting_title": subscription.title,
+            "meeting_day": meeting_datetime.strftime("%A"),
+            "meeting_time": meeting_datetime.strftime("%I:%M %p %Z"),
+            "meeting_url": create_url,
+            "link_to_change_pref": f"https://{secrets.project}.appspot.com/",
+            "project": secrets.project,
+        },
+    )
 
 
-def send_batch_meeting_confirmation_email(matches: Collection[Collection[User]], spec: MeetingSpec) -> None:
+def send_batch_meeting_confirmation_email(
+    matches: Collection[Collection[User]], spec: MeetingSpec, resend_failed: bool = False
+) -> None:
     """
-    Sends an email to all of the participants in a match for the week
+    Queues an email to all of the participants in a match for the week
         matches - list of meetings to participants
         spec - meeting spec
+        resend_failed - also queue again the emails of the spec that failed to send
     """
+    emails = []
     for match in matches:
         participants = {participant for participant in match if isinstance(participant, User)}
         for participant in participants:
             others = participants - {participant}
-            send_match_email(participant, [participant for participant in others], spec)
+            emails.append(get_match_email(participant, [participant for participant in others], spec))
+    key = f"match_email.html:{spec.id}"
+    queue_emails(key, emails)
+    if resend_failed:
+        requeue_failed_emails(key)
 
 
 def send_match_email(user: User, participants: Collection[User], meeting_spec: MeetingSpec) -> None:
     """
-    Sends an email to one of the matches for the week
+    Sends an email to one of the matches for the week, right away
         user - user receiving the email
         participants - other people in the meeting
         meeting_spec - meeting specification
     """
+    send_single_email(*get_match_email(user, participants, meeting_spec))
+
+
+def get_match_email(user: User, participants: Collection[User], meeting_spec: MeetingSpec) -> tuple[str, str, str, dict[str, Any]]:
+    """The send_single_email arguments of the match email for one of the matches"""
     secrets = get_secrets()
     meeting_datetime = get_meeting_datetime(meeting_spec)
     meeting_datetime_end = meeting_datetime + datetime.timedelta(minutes=30)
     subscription = meeting_spec.meeting_subscription
 
-    send_single_email(
+    return (
         user.email,
         "Yelp Beans Meeting",
         "match_email.html",
@@ -209,17 +658,13 @@ def create_google_calendar_invitation_link(
 
 
 def send_batch_unmatched_email(unmatched: Collection[User], spec: MeetingSpec) -> None:
-    """Sends an email to a person that couldn't be matched for the week"""
+    """Queues an email to a person that couldn't be matched for the week"""
     secrets = get_secrets()
     subscription = spec.meeting_subscription
-    for user in unmatched:
-        send_single_email(
-            user.email,
-            "Your Beans meeting this week",
-            "unmatched_email.html",
-            {
-                "first_name": user.first_name,
-                "project": secrets.project,
-                "meeting_title": subscription.title,
-            },
-        )
+    queue_personalized_emails(
+        f"unmatched_email.html:{spec.id}",
+        [(user.email, {"first_name": user.first_name}) for user in unmatched],
+        "Your Beans meeting this week",
+        "unmatched_email.html",
+        {"project": secrets.project, "meeting_title": subscription.title},
+    )